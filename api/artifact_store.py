@@ -0,0 +1,208 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+# <sha256>.<extension>
+ARTIFACT_ID = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+
+
+class ArtifactStore:
+    """
+    Content-addressed on-disk store for generated results ZIPs, images and PDFs.
+
+    Each artifact is a file named after the SHA-256 of its bytes plus its
+    extension, so an artifact ID never changes meaning: it doubles as a
+    strong ETag and responses for it can be cached forever. Files are
+    sharded by the first two hex digits of the hash. Artifacts not used for
+    max_age_seconds are dropped, and the least recently used ones once the
+    store grows past max_bytes; adding artifacts runs this at most every
+    gc_interval_seconds. Use is tracked in access times, modification times
+    are left alone since artifacts may be hard links to session files. The
+    store is indexed on first use, or by load().
+    """
+
+    def __init__(self, root, max_bytes, max_age_seconds, gc_interval_seconds=300):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+        self._last_gc = 0.0
+        self.stored = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        # artifact ID -> (size in bytes, last used), least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        # (path, inode, mtime, size) -> artifact ID of files added with put_file
+        self._file_ids = {}
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def is_valid_id(artifact_id):
+        return bool(ARTIFACT_ID.match(artifact_id))
+
+    def path(self, artifact_id):
+        return os.path.join(self.root, artifact_id[:2], artifact_id)
+
+    def load(self):
+        """Index the artifacts left by previous runs and collect garbage, once."""
+        with self._load_lock:
+            if self._loaded:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self._load_index()
+            self._loaded = True
+
+    def _load_index(self):
+        # Rebuild the LRU order from access times, which get() refreshes
+        entries = []
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for filename in os.listdir(shard_dir):
+                if self.is_valid_id(filename):
+                    stat = os.stat(os.path.join(shard_dir, filename))
+                    entries.append((stat.st_atime, filename, stat.st_size))
+        for used, artifact_id, size in sorted(entries):
+            self._entries[artifact_id] = (size, used)
+            self._total_bytes += size
+        self._gc()
+
+    @staticmethod
+    def _touch(path):
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+    def _add(self, artifact_id, size):
+        with self._lock:
+            if artifact_id in self._entries:
+                self._total_bytes -= self._entries.pop(artifact_id)[0]
+            self._entries[artifact_id] = (size, time.time())
+            self._total_bytes += size
+
+    def _forget(self, artifact_id):
+        with self._lock:
+            entry = self._entries.pop(artifact_id, None)
+            if entry is not None:
+                self._total_bytes -= entry[0]
+        try:
+            os.remove(self.path(artifact_id))
+        except FileNotFoundError:
+            pass
+
+    def _store(self, artifact_id, write):
+        """Write an artifact with write(tmp_path) unless it is already stored, return its ID."""
+        self.load()
+        path = self.path(artifact_id)
+        if os.path.exists(path):
+            self.deduplicated += 1
+            self._touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            write(tmp_path)
+            os.replace(tmp_path, path)
+            self.stored += 1
+        self._add(artifact_id, os.path.getsize(path))
+        if time.monotonic() - self._last_gc > self.gc_interval_seconds:
+            self._gc()
+        return artifact_id
+
+    def put_bytes(self, data, extension):
+        """Store data and return its artifact ID."""
+        artifact_id = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        return self._store(artifact_id, write)
+
+    def put_file(self, path, extension, link=False):
+        """
+        Store the file at path and return its artifact ID. The hash of a file
+        is remembered until it changes. With link the artifact is a hard link
+        to the file instead of a copy, only safe for files that are replaced
+        rather than rewritten in place.
+        """
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        artifact_id = self._file_ids.get(file_key)
+        if artifact_id is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+            artifact_id = f"{digest.hexdigest()}.{extension}"
+
+        def write(tmp_path):
+            if link:
+                try:
+                    os.link(path, tmp_path)
+                    return
+                except OSError:
+                    pass
+            shutil.copyfile(path, tmp_path)
+
+        self._store(artifact_id, write)
+        self._file_ids[file_key] = artifact_id
+        return artifact_id
+
+    def get(self, artifact_id):
+        """Return the path of a stored artifact and mark it used, or None."""
+        if not self.is_valid_id(artifact_id):
+            return None
+        self.load()
+        path = self.path(artifact_id)
+        try:
+            self._touch(path)
+        except FileNotFoundError:
+            self._forget(artifact_id)
+            return None
+        self._add(artifact_id, os.path.getsize(path))
+        return path
+
+    def gc(self):
+        """Drop artifacts unused for max_age_seconds, then the least recently used past max_bytes."""
+        self.load()
+        return self._gc()
+
+    def _gc(self):
+        self._last_gc = time.monotonic()
+        cutoff = time.time() - self.max_age_seconds
+        with self._lock:
+            expired = {artifact_id for artifact_id, (_, used) in self._entries.items() if used < cutoff}
+            over = []
+            total = self._total_bytes - sum(self._entries[artifact_id][0] for artifact_id in expired)
+            for artifact_id, (size, _) in self._entries.items():
+                if total <= self.max_bytes:
+                    break
+                if artifact_id not in expired:
+                    over.append(artifact_id)
+                    total -= size
+        for artifact_id in [*expired, *over]:
+            self._forget(artifact_id)
+        self.evictions += len(expired) + len(over)
+        # Forget the hashes of files whose artifacts are gone
+        self._file_ids = {key: artifact_id for key, artifact_id in self._file_ids.items()
+                          if artifact_id in self._entries}
+        return len(expired) + len(over)
+
+    def stats(self):
+        self.load()
+        return {
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age_seconds,
+        }
@@ -0,0 +1,73 @@
+import mimetypes
+import os
+import tempfile
+
+# Recordings up to this size stay in memory while they are read, larger ones spill to disk
+SPOOL_MAX_MEMORY = 4 * 1024 * 1024
+
+# Container magic numbers of the audio formats Gemini accepts
+_SIGNATURES = [
+    (0, b"ID3", "audio/mp3"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"\x1a\x45\xdf\xa3", "audio/webm"),
+]
+
+
+class AudioTooLarge(Exception):
+    pass
+
+
+def sniff_audio_mime_type(header, filename=None, content_type=None):
+    """
+    Return the MIME type of an audio file from its first bytes.
+
+    Falls back to the upload's content type, then its file extension, then
+    audio/mp3 when the bytes are not recognized.
+    """
+    for offset, magic, mime_type in _SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "audio/wav"
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return "audio/aiff"
+    if header[4:8] == b"ftyp":
+        # MP4 container, what phones record voice notes in (.m4a)
+        return "audio/mp4"
+    if len(header) >= 2 and header[0] == 0xFF:
+        # MPEG frame sync: ADTS AAC has layer bits 00, MP3 does not
+        return "audio/aac" if header[1] & 0xF6 == 0xF0 else "audio/mp3"
+
+    if content_type and content_type.startswith("audio/"):
+        return content_type
+    guessed, _ = mimetypes.guess_type(filename or "")
+    if guessed and guessed.startswith("audio/"):
+        return guessed
+    return "audio/mp3"
+
+
+async def spool_upload(file, max_bytes, chunk_size=1024 * 1024):
+    """
+    Copy an UploadFile into a SpooledTemporaryFile, chunk by chunk.
+
+    Returns (spooled file positioned at 0, size, MIME type). Raises
+    AudioTooLarge once more than max_bytes have been read.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    size = 0
+    header = b""
+    try:
+        while chunk := await file.read(chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise AudioTooLarge()
+            if len(header) < 16:
+                header += chunk[:16 - len(header)]
+            spooled.write(chunk)
+    except BaseException:
+        spooled.close()
+        raise
+
+    spooled.seek(0, os.SEEK_SET)
+    return spooled, size, sniff_audio_mime_type(header, file.filename, file.content_type)
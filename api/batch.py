@@ -0,0 +1,345 @@
+"""
+Batch assessments: run the /analyze_real/ pipeline over many homes, then
+build each home's PDF report.
+
+A home is either one image in a directory (its health problems read from a
+.txt file with the same name, if there is one) or a line of a JSON Lines
+manifest:
+
+    {"id": "smith-42", "images": ["smith/bath1.jpg", "smith/bath2.jpg"],
+     "problems": "knee pain, uses a walker", "room": "bathroom"}
+
+("image" for a single photo; "problems" and "room" are optional, image paths
+are relative to the manifest). Several images of one home are analyzed
+together, like the keyframes of a video walkthrough. Run from the api/
+directory with the usual server settings:
+
+    python batch.py homes/ --out batch_output --workers 4
+    python batch.py homes.jsonl --out batch_output --image-format webp
+
+Each home gets a directory under --out, named after its id. Finished stages
+are checkpointed there (recommendations.json, results.zip, report.pdf) and
+skipped when the command is run again, so after a crash or when the Gemini
+quota runs out (the run then stops starting new homes) the same command
+picks up where it stopped. Throughput and per-stage failures are printed at
+the end and written to summary.json. The images go to an artifact store of
+their own, --out/artifacts unless --artifact-dir says otherwise, so a large
+batch does not evict the artifacts of the API's users.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import zipfile
+from collections import defaultdict
+from pathlib import Path
+
+from artifact_store import ArtifactStore
+from dispatcher import BACKGROUND, request_priority
+from image_encoding import ImageEncoding, supported_format
+from lazy_imports import LazyModule
+from metrics import RequestMetrics, current_metrics, timed
+from preprocess import prepare_image
+from schemas import ROOM_TYPES
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+DEFAULT_PROBLEMS = "no specific problems reported"
+
+RECOMMENDATIONS_FILENAME = "recommendations.json"
+RESULTS_FILENAME = "results.zip"
+REPORT_FILENAME = "report.pdf"
+
+STAGES = ("preprocess", "recommendations", "results", "report")
+
+SUMMARY_FILENAME = "summary.json"
+ARTIFACTS_DIRNAME = "artifacts"
+
+errors = LazyModule("google.genai.errors")
+
+
+def load_homes(source):
+    """Return the homes of a directory or JSON Lines manifest as dicts with id, images, problems and room."""
+    source = Path(source)
+    homes = []
+    if source.is_dir():
+        for image in sorted(source.iterdir()):
+            if image.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            problems_file = image.with_suffix(".txt")
+            problems = problems_file.read_text().strip() if problems_file.exists() else None
+            homes.append({"id": image.stem, "images": [image], "problems": problems, "room": None})
+        return homes
+
+    with open(source) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            images = entry.get("images") or [entry["image"]]
+            homes.append({
+                "id": str(entry.get("id") or Path(images[0]).stem),
+                "images": [source.parent / image for image in images],
+                "problems": entry.get("problems"),
+                "room": entry.get("room"),
+            })
+    return homes
+
+
+def is_plain_id(home_id):
+    """Whether a home id can name its directory under --out: one path component, not hidden or reserved."""
+    return (bool(home_id) and not home_id.startswith(".") and "/" not in home_id and "\\" not in home_id
+            and home_id not in (SUMMARY_FILENAME, ARTIFACTS_DIRNAME))
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.partial"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+class BatchStats:
+    def __init__(self):
+        self.completed = 0
+        self.resumed = 0
+        self.failed = 0
+        self.not_started = 0
+        self.stages_skipped = defaultdict(int)
+        # stage -> error type -> count
+        self.failures = defaultdict(lambda: defaultdict(int))
+        self.timings = defaultdict(float)
+        self.tokens = defaultdict(lambda: defaultdict(int))
+
+    def add_metrics(self, request_metrics):
+        for stage, seconds in request_metrics.timings.items():
+            self.timings[stage] += seconds
+        for model, counts in request_metrics.tokens.items():
+            for kind, count in counts.items():
+                self.tokens[model][kind] += count
+
+    def summary(self, elapsed, total):
+        # Homes finished in earlier runs do not count towards throughput
+        processed = self.completed - self.resumed + self.failed
+        return {
+            "homes": total,
+            "completed": self.completed,
+            "resumed": self.resumed,
+            "failed": self.failed,
+            "not_started": self.not_started,
+            "elapsed_seconds": round(elapsed, 1),
+            "homes_per_hour": round(processed / elapsed * 3600, 1) if elapsed else 0.0,
+            "stages_skipped": dict(self.stages_skipped),
+            "failures": {stage: dict(errors) for stage, errors in self.failures.items()},
+            "timings_seconds": {stage: round(seconds, 1) for stage, seconds in self.timings.items()},
+            "tokens": {model: dict(counts) for model, counts in self.tokens.items()},
+        }
+
+
+def is_quota_error(error):
+    # Rate limits the dispatcher could not retry away, e.g. a daily quota
+    return isinstance(error, errors.APIError) and error.code == 429
+
+
+async def run_stage(stats, stage, home_id, coro):
+    try:
+        return await coro
+    except Exception as e:
+        stats.failures[stage][type(e).__name__] += 1
+        print(f"[{home_id}] {stage} failed: {' '.join(str(e).split())[:300]}")
+        if is_quota_error(e):
+            raise QuotaExhausted() from e
+        raise
+
+
+async def assess_home(pipeline, home, out_dir, args, stats):
+    """Run the stages of one home not checkpointed yet. Returns False when one of them failed."""
+    home_dir = out_dir / home["id"]
+    home_dir.mkdir(parents=True, exist_ok=True)
+    recs_path = home_dir / RECOMMENDATIONS_FILENAME
+    zip_path = home_dir / RESULTS_FILENAME
+    report_path = home_dir / REPORT_FILENAME
+
+    if zip_path.exists() and (report_path.exists() or args.no_report):
+        stats.resumed += 1
+        return True
+
+    try:
+        if not zip_path.exists():
+            async def preprocess():
+                return await asyncio.to_thread(
+                    lambda: [prepare_image(Path(image).read_bytes()) for image in home["images"]])
+
+            with timed("preprocess"):
+                frames = await run_stage(stats, "preprocess", home["id"], preprocess())
+
+            if recs_path.exists():
+                stats.stages_skipped["recommendations"] += 1
+                recs = json.loads(recs_path.read_text())["recommendations"]
+            else:
+                session_id = pipeline.session_store.create()
+                problems = home["problems"] or args.problems
+
+                async def recommend():
+                    return [rec async for rec in pipeline.stream_recommendations(
+                        session_id, frames, problems, args.box_mode, room=home["room"] or args.room)]
+
+                recs = await run_stage(stats, "recommendations", home["id"], recommend())
+                session = pipeline.session_store.get(session_id) or {}
+                write_atomic(recs_path, json.dumps({
+                    "problems": problems,
+                    "room": session.get("room"),
+                    "prompt_pack": session.get("prompt_pack"),
+                    "recommendations": recs,
+                }, indent=2).encode())
+
+            async def replay():
+                for rec in recs:
+                    yield rec
+
+            async def results():
+                encoding = ImageEncoding(
+                    format=supported_format(args.image_format or pipeline.IMAGE_FORMAT),
+                    quality=pipeline.IMAGE_QUALITY, max_bytes=pipeline.IMAGE_MAX_BYTES,
+                    thumbnail_size=pipeline.THUMBNAIL_SIZE)
+                members = pipeline.with_artifact_hashes(pipeline.iter_result_members(
+                    replay(), frames, overlay=args.overlay or pipeline.OVERLAY_MODE, encoding=encoding,
+                    originals_dir=pipeline.reset_originals(str(home_dir))))
+                with zipfile.ZipFile(f"{zip_path}.partial", "w", zipfile.ZIP_DEFLATED) as zip_file:
+                    async for filename, data in members:
+                        zip_file.writestr(filename, data)
+                os.replace(f"{zip_path}.partial", zip_path)
+
+            await run_stage(stats, "results", home["id"], results())
+        else:
+            stats.stages_skipped["results"] += 1
+            recs = json.loads(recs_path.read_text())["recommendations"]
+
+        if not args.no_report:
+            async def report():
+                # The report is built from the image model's originals next to the ZIP
+                indexes = list(range(1, len(recs) + 1))
+                write_atomic(report_path, await pipeline.build_report(str(zip_path), indexes))
+
+            with timed("pdf_render"):
+                await run_stage(stats, "report", home["id"], report())
+    except QuotaExhausted:
+        raise
+    except Exception:
+        return False
+
+    print(f"[{home['id']}] done")
+    return True
+
+
+async def run_batch(homes, out_dir, args):
+    # Imported here, report pool workers import this module and do not need the pipeline
+    import pipeline
+
+    # Same limits as the API's store, but its own directory
+    pipeline.artifact_store = ArtifactStore(
+        root=args.artifact_dir or str(out_dir / ARTIFACTS_DIRNAME),
+        max_bytes=pipeline.artifact_store.max_bytes,
+        max_age_seconds=pipeline.artifact_store.max_age_seconds,
+    )
+
+    stats = BatchStats()
+    queue = asyncio.Queue()
+    for home in homes:
+        queue.put_nowait(home)
+    stop = asyncio.Event()
+
+    async def worker():
+        while not stop.is_set() and not queue.empty():
+            home = queue.get_nowait()
+            request_metrics = RequestMetrics()
+            current_metrics.set(request_metrics)
+            # Batches give way to interactive requests and wait rather than being shed
+            request_priority.set(BACKGROUND)
+            try:
+                ok = await assess_home(pipeline, home, out_dir, args, stats)
+            except QuotaExhausted:
+                stats.failed += 1
+                if not stop.is_set():
+                    print("Gemini quota exhausted, not starting more homes; run again later to resume")
+                stop.set()
+                continue
+            stats.add_metrics(request_metrics)
+            if ok:
+                stats.completed += 1
+            else:
+                stats.failed += 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.workers)))
+    finally:
+        pipeline.shutdown_report_pool()
+    stats.not_started = queue.qsize()
+    return stats.summary(time.perf_counter() - start, len(homes))
+
+
+def print_summary(summary):
+    elapsed = summary["elapsed_seconds"]
+    print(f"\n{summary['homes']} homes in {elapsed:.1f}s ({summary['homes_per_hour']:.1f} homes/hour): "
+          f"{summary['completed']} completed ({summary['resumed']} already done), {summary['failed']} failed, "
+          f"{summary['not_started']} not started")
+    print(f"\n{'stage':<18}{'skipped':>8}{'failed':>8}  errors")
+    for stage in STAGES:
+        failures = summary["failures"].get(stage, {})
+        print(f"{stage:<18}{summary['stages_skipped'].get(stage, 0):>8}{sum(failures.values()):>8}  "
+              f"{', '.join(f'{error}: {count}' for error, count in failures.items())}")
+    if summary["timings_seconds"]:
+        print("\nTime per stage: " + ", ".join(f"{stage} {seconds:.1f}s"
+                                            for stage, seconds in summary["timings_seconds"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory of images or JSON Lines manifest")
+    parser.add_argument("--out", default="batch_output", help="output directory, also holds the checkpoints")
+    parser.add_argument("--workers", type=int, default=4, help="homes assessed at the same time")
+    parser.add_argument("--problems", default=DEFAULT_PROBLEMS, help="health problems of homes that list none")
+    parser.add_argument("--room", help="room type of homes that name none, skips the room classification")
+    parser.add_argument("--box-mode", help="two_phase or combined, BOX_MODE by default")
+    parser.add_argument("--overlay", help="png or manifest, OVERLAY_MODE by default")
+    parser.add_argument("--image-format", help="png, jpeg, webp or avif, IMAGE_FORMAT by default")
+    parser.add_argument("--no-report", action="store_true", help="skip the PDF reports")
+    parser.add_argument("--artifact-dir", help=f"artifact store of the images, --out/{ARTIFACTS_DIRNAME} by default")
+    args = parser.parse_args()
+
+    import pipeline
+    try:
+        pipeline.check_analysis_options(args.box_mode, args.overlay, args.image_format, args.room)
+    except ValueError as e:
+        parser.error(str(e))
+
+    homes = load_homes(args.source)
+    if not homes:
+        parser.error(f"no homes found in {args.source}")
+    ids = [home["id"] for home in homes]
+    unsafe = sorted({home_id for home_id in ids if not is_plain_id(home_id)})
+    if unsafe:
+        parser.error(f"home ids must be plain directory names: {', '.join(map(repr, unsafe))}")
+    duplicates = sorted({home_id for home_id in ids if ids.count(home_id) > 1})
+    if duplicates:
+        parser.error(f"duplicate home ids: {', '.join(duplicates)}")
+    unknown_rooms = sorted({home["room"] for home in homes if home["room"] and home["room"] not in ROOM_TYPES})
+    if unknown_rooms:
+        parser.error(f"unknown room types: {', '.join(unknown_rooms)}, expected one of {', '.join(ROOM_TYPES)}")
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    summary = asyncio.run(run_batch(homes, out_dir, args))
+    (out_dir / SUMMARY_FILENAME).write_text(json.dumps(summary, indent=2))
+    print_summary(summary)
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
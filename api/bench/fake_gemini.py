@@ -0,0 +1,182 @@
+"""
+Local stand-in for the Gemini API, for load tests that must not spend quota.
+
+Serves models/{model}:generateContent with canned replies shaped like the
+real ones: recommendation JSON (with box_2d / Frame when the response schema
+asks for them), a room type, bounding-box JSON, a generated image, or a
+problems list for audio. Latency is log-normal around a per-kind median and a share of calls
+fails with 429 or 503. models/{model}:streamGenerateContent sends text
+replies as server-sent events, spread evenly over the same latency.
+GET models/{model} answers at once, for the server's warm-up call.
+
+    python bench/fake_gemini.py --port 8765 --text-latency-ms 2000 --image-latency-ms 8000
+
+Point the API at it with GEMINI_BASE_URL=http://127.0.0.1:8765/
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+from pathlib import Path
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+
+IMAGES_DIR = Path(__file__).resolve().parent.parent / "images"
+
+RECOMMENDATIONS = [
+    {
+        "Modification": "Install an L-shaped grab bar on the wall beside the toilet",
+        "Rationale": "Supports sit-to-stand transfers and reduces fall risk",
+        "Cost": "$$",
+        "Installation": "Mount into studs with a 250 lb rated bracket",
+    },
+    {
+        "Modification": "Replace the bath mat with a low-profile non-slip mat",
+        "Rationale": "Loose rugs are a common trip hazard",
+        "Cost": "$",
+        "Installation": "Remove the old mat and lay the new one flat",
+    },
+    {
+        "Modification": "Add a fold-down shower seat on the back wall",
+        "Rationale": "Allows seated bathing for residents with poor balance",
+        "Cost": "$$$",
+        "Installation": "Anchor the seat frame to blocking behind the tile",
+    },
+]
+
+BOXES = [[420, 610, 700, 760], [780, 150, 980, 520], [250, 80, 640, 330]]
+
+# Streamed replies are sent in pieces of this many characters
+STREAM_CHUNK_CHARS = 80
+
+app = FastAPI()
+settings = argparse.Namespace(text_latency_ms=1000, image_latency_ms=5000, latency_sigma=0.3,
+                              error_rate=0.0, seed=None)
+generated_image = None
+
+
+def load_generated_image():
+    # A real photo re-encoded as PNG, so the API decodes and re-encodes realistic data
+    photo = sorted(IMAGES_DIR.glob("*.JPG"))[0]
+    image = Image.open(photo)
+    image.draft("RGB", (1024, 1024))
+    image = image.convert("RGB")
+    image.thumbnail([1024, 1024])
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def text_reply(text):
+    return {"role": "model", "parts": [{"text": text}]}
+
+
+def build_reply(body):
+    """Pick a canned reply from what the request asks for."""
+    config = body.get("generationConfig") or {}
+    modalities = [m.upper() for m in config.get("responseModalities") or []]
+    if "IMAGE" in modalities:
+        return "image", {"role": "model", "parts": [
+            {"text": "Here is the edited image."},
+            {"inlineData": {"mimeType": "image/png", "data": generated_image}},
+        ]}
+
+    if body.get("systemInstruction"):
+        box = random.choice(BOXES)
+        return "text", text_reply(json.dumps([{"box_2d": box, "label": "modification"}]))
+
+    schema = json.dumps(config.get("responseSchema") or {})
+    if '"room"' in schema:
+        return "text", text_reply(json.dumps({"room": "bathroom"}))
+    if config.get("responseMimeType") == "application/json" or "Modification" in schema:
+        recs = []
+        for idx, rec in enumerate(RECOMMENDATIONS):
+            rec = dict(rec)
+            if "box_2d" in schema:
+                rec["box_2d"] = BOXES[idx]
+            if "Frame" in schema:
+                rec["Frame"] = 1
+            recs.append(rec)
+        return "text", text_reply(json.dumps(recs))
+
+    return "text", text_reply("knee pain, poor balance, difficulty standing up, uses a walker")
+
+
+@app.post("/{api_version}/models/{model_action}")
+async def generate_content(api_version: str, model_action: str, request: Request):
+    body = await request.json()
+    kind, content = build_reply(body)
+
+    median = settings.image_latency_ms if kind == "image" else settings.text_latency_ms
+    latency = median * random.lognormvariate(0, settings.latency_sigma) / 1000
+
+    if random.random() < settings.error_rate:
+        await asyncio.sleep(latency)
+        code = random.choice([429, 503])
+        status = "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"
+        return JSONResponse(status_code=code, headers={"Retry-After": "1"},
+                            content={"error": {"code": code, "message": "fake error", "status": status}})
+
+    prompt_tokens = 1500 if kind == "image" else 1200
+    output_tokens = 1300 if kind == "image" else 300
+    usage = {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": output_tokens,
+        "totalTokenCount": prompt_tokens + output_tokens,
+    }
+    if model_action.endswith(":streamGenerateContent") and kind == "text":
+        return StreamingResponse(stream_reply(content["parts"][0]["text"], latency, usage),
+                                 media_type="text/event-stream")
+    await asyncio.sleep(latency)
+    return {
+        "candidates": [{"content": content, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": usage,
+    }
+
+
+@app.get("/{api_version}/models/{model}")
+async def get_model(api_version: str, model: str):
+    return {"name": f"models/{model}", "displayName": model, "supportedActions": ["generateContent"]}
+
+
+async def stream_reply(text, latency, usage):
+    pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+    for idx, piece in enumerate(pieces):
+        await asyncio.sleep(latency / len(pieces))
+        chunk = {"candidates": [{"content": text_reply(piece), "index": 0}]}
+        if idx == len(pieces) - 1:
+            chunk["candidates"][0]["finishReason"] = "STOP"
+            chunk["usageMetadata"] = usage
+        yield f"data: {json.dumps(chunk)}\r\n\r\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--text-latency-ms", type=float, default=1000,
+                        help="median latency of text replies")
+    parser.add_argument("--image-latency-ms", type=float, default=5000,
+                        help="median latency of generated images")
+    parser.add_argument("--latency-sigma", type=float, default=0.3,
+                        help="sigma of the log-normal latency distribution (0 = fixed)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of calls failing with 429/503")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    global generated_image
+    vars(settings).update(vars(args))
+    if args.seed is not None:
+        random.seed(args.seed)
+    generated_image = load_generated_image()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
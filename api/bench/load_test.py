@@ -0,0 +1,241 @@
+"""
+Load test for the API against the fake Gemini server.
+
+Each virtual user runs whole assessments: /analyze_audio/ with the sample
+recording, /analyze_real/ with one of the photos in images/, then
+/generate_report/ for the results, all in one session. Reports throughput,
+p50/p95/p99 latency per endpoint and the API's peak RSS.
+
+By default the fake Gemini server and the API (uvicorn server:app) are
+started as subprocesses, run from the api/ directory:
+
+    python bench/load_test.py --concurrency 8 --assessments 40
+
+The API runs with its default settings, including the per-model Gemini rate
+limits; pass --api-env GEMINI_RPM=600 etc. to measure without them. Use
+--api-url to test an already running API instead (peak RSS is then only
+reported with --api-pid).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+API_DIR = Path(__file__).resolve().parent.parent
+IMAGES_DIR = API_DIR / "images"
+AUDIO_FIXTURE = IMAGES_DIR / "Recording.m4a"
+
+ENDPOINTS = ("analyze_audio", "analyze_real", "generate_report")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a process (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, seconds, status):
+        if status == 200:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint][status] += 1
+
+
+async def timed_post(client, results, endpoint, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.post(f"/{endpoint}/", **kwargs)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        response, status = None, type(e).__name__
+    results.record(endpoint, time.perf_counter() - start, status)
+    return response if status == 200 else None
+
+
+async def run_assessment(client, results, photo, audio, endpoints):
+    headers = {}
+    if "analyze_audio" in endpoints:
+        response = await timed_post(client, results, "analyze_audio",
+                                    files={"file": ("Recording.m4a", audio, "audio/mp4")})
+        if response is None:
+            return
+        headers["X-Session-ID"] = response.headers["X-Session-ID"]
+
+    if "analyze_real" in endpoints:
+        response = await timed_post(client, results, "analyze_real", headers=headers,
+                                    files={"file": (photo.name, photo.read_bytes(), "image/jpeg")})
+        if response is None:
+            return
+        headers["X-Session-ID"] = response.headers["X-Session-ID"]
+
+    if "generate_report" in endpoints:
+        await timed_post(client, results, "generate_report", headers=headers,
+                         data={"indexes": "1,2,3"})
+
+
+async def run_load(api_url, concurrency, assessments, endpoints, timeout):
+    photos = sorted(IMAGES_DIR.glob("*.JPG")) + sorted(IMAGES_DIR.glob("*.jpg"))
+    audio = AUDIO_FIXTURE.read_bytes()
+    results = Results()
+    queue = asyncio.Queue()
+    for i in range(assessments):
+        queue.put_nowait(photos[i % len(photos)])
+
+    async def user(client):
+        while not queue.empty():
+            photo = queue.get_nowait()
+            await run_assessment(client, results, photo, audio, endpoints)
+
+    limits = httpx.Limits(max_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=api_url, timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(user(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def wait_until_up(url, process=None, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, work_dir, processes):
+    """Start the fake Gemini server and the API, adding both to processes."""
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    fake = subprocess.Popen([
+        sys.executable, str(Path(__file__).resolve().parent / "fake_gemini.py"),
+        "--port", str(args.fake_port),
+        "--text-latency-ms", str(args.text_latency_ms),
+        "--image-latency-ms", str(args.image_latency_ms),
+        "--latency-sigma", str(args.latency_sigma),
+        "--error-rate", str(args.error_rate),
+    ])
+    processes.append(fake)
+    wait_until_up(f"{fake_url}/docs", fake)
+
+    env = dict(
+        os.environ,
+        GEMINI_API_KEY="bench",
+        GEMINI_BASE_URL=f"{fake_url}/",
+        # Caches would turn every repeated fixture into a hit
+        GEMINI_CACHE_ENABLED="1" if args.with_caches else "0",
+        PHASH_REUSE_ENABLED="1" if args.with_caches else "0",
+        GEMINI_CACHE_DIR=os.path.join(work_dir, "gemini_cache"),
+        PHASH_INDEX_DIR=os.path.join(work_dir, "phash_index"),
+        ARTIFACT_DIR=os.path.join(work_dir, "artifacts"),
+        SESSION_DIR=os.path.join(work_dir, "sessions"),
+    )
+    env.update(setting.split("=", 1) for setting in args.api_env)
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(args.api_port), "--log-level", "warning"],
+        cwd=API_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    processes.append(api)
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    wait_until_up(f"{api_url}/analyze/", api)
+    return api, api_url
+
+
+def report(results, elapsed, assessments, rss_mb):
+    print(f"\n{assessments} assessments in {elapsed:.1f}s ({assessments / elapsed:.2f} assessments/s)\n")
+    print(f"{'endpoint':<18}{'ok':>6}{'errors':>8}{'req/s':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for endpoint in ENDPOINTS:
+        latencies = results.latencies.get(endpoint, [])
+        errors = results.errors.get(endpoint, {})
+        if not latencies and not errors:
+            continue
+        mean = statistics.mean(latencies) if latencies else float("nan")
+        print(f"{endpoint:<18}{len(latencies):>6}{sum(errors.values()):>8}{len(latencies) / elapsed:>8.2f}"
+              f"{mean:>8.2f}s{percentile(latencies, 50):>8.2f}s"
+              f"{percentile(latencies, 95):>8.2f}s{percentile(latencies, 99):>8.2f}s")
+        if errors:
+            print(f"{'':<18}errors by status: {dict(errors)}")
+    print(f"\nAPI peak RSS: {f'{rss_mb:.0f} MB' if rss_mb is not None else 'n/a'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=4, help="virtual users")
+    parser.add_argument("--assessments", type=int, default=20, help="total assessments to run")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help="comma-separated subset of " + ", ".join(ENDPOINTS))
+    parser.add_argument("--timeout", type=float, default=300, help="per-request timeout in seconds")
+    parser.add_argument("--api-url", help="test this running API instead of starting one")
+    parser.add_argument("--api-pid", type=int, help="PID of the running API, for peak RSS")
+    parser.add_argument("--api-port", type=int, default=8766)
+    parser.add_argument("--fake-port", type=int, default=8765)
+    parser.add_argument("--text-latency-ms", type=float, default=1000)
+    parser.add_argument("--image-latency-ms", type=float, default=5000)
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--api-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra API setting, e.g. GEMINI_IMG_GEN_RPM=600 (repeatable)")
+    parser.add_argument("--with-caches", action="store_true",
+                        help="keep the Gemini response cache and near-duplicate reuse enabled")
+    args = parser.parse_args()
+
+    endpoints = set(args.endpoints.split(","))
+    unknown = endpoints - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    processes = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            if args.api_url:
+                api_url, api_pid = args.api_url, args.api_pid
+            else:
+                api, api_url = start_servers(args, work_dir, processes)
+                api_pid = api.pid
+
+            results, elapsed = asyncio.run(run_load(
+                api_url, args.concurrency, args.assessments, endpoints, args.timeout))
+            rss_mb = peak_rss_mb(api_pid) if api_pid else None
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    report(results, elapsed, args.assessments, rss_mb)
+
+
+if __name__ == "__main__":
+    main()
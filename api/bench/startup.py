@@ -0,0 +1,167 @@
+"""
+Start-up benchmark for the API against the fake Gemini server.
+
+Measures how long `import server` takes in a fresh interpreter, then starts
+the API (uvicorn server:app) several times, with and without
+WARMUP_ENABLED, and reports the time until /ready answers 200 and the
+latency of the first two /analyze_real/ requests. The fake Gemini server
+answers at once, so the request latencies are the API's own work. Run from
+the api/ directory:
+
+    python bench/startup.py --runs 5
+
+With --import-profile N it also lists the N modules imported by server
+that take longest (from python -X importtime).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+API_DIR = Path(__file__).resolve().parent.parent
+IMAGES_DIR = API_DIR / "images"
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import server; print(time.perf_counter() - start)"
+
+
+def api_env(work_dir, fake_url, warmup):
+    return dict(
+        os.environ,
+        GEMINI_API_KEY="bench",
+        GEMINI_BASE_URL=f"{fake_url}/",
+        WARMUP_ENABLED="1" if warmup else "0",
+        # Otherwise the runs after the first would get cached replies (the API's own settings are the defaults)
+        GEMINI_CACHE_ENABLED="0",
+        PHASH_REUSE_ENABLED="0",
+        GEMINI_CACHE_DIR=os.path.join(work_dir, "gemini_cache"),
+        PHASH_INDEX_DIR=os.path.join(work_dir, "phash_index"),
+        ARTIFACT_DIR=os.path.join(work_dir, "artifacts"),
+        SESSION_DIR=os.path.join(work_dir, "sessions"),
+    )
+
+
+def time_imports(runs, env):
+    """Seconds `import server` takes in each of runs fresh interpreters."""
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=API_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return times
+
+
+def import_profile(env, top):
+    """The modules imported by server with the longest cumulative import time, from python -X importtime."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"], cwd=API_DIR, env=env,
+                            capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only what server imports itself, deeper imports are part of their parent's time
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def wait_until_ready(url, process, timeout=60):
+    """Poll url until it answers 200, return the seconds since the call."""
+    start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f"{url} was not ready within {timeout}s")
+
+
+def analyze(api_url, photo):
+    start = time.perf_counter()
+    response = httpx.post(f"{api_url}/analyze_real/", timeout=60,
+                          files={"file": (photo.name, photo.read_bytes(), "image/jpeg")})
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def start_once(args, env, photos):
+    """Start the API, return (seconds until ready, first request, second request)."""
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    start = time.perf_counter()
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(args.api_port), "--log-level", "warning"],
+        cwd=API_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_ready(f"{api_url}/ready", api)
+        ready = time.perf_counter() - start
+        return ready, analyze(api_url, photos[0]), analyze(api_url, photos[1])
+    finally:
+        api.terminate()
+        try:
+            api.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            api.kill()
+
+
+def summarize(values):
+    return f"{statistics.median(values):>8.2f}s{min(values):>8.2f}s{max(values):>8.2f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="interpreters / API starts per measurement")
+    parser.add_argument("--api-port", type=int, default=8766)
+    parser.add_argument("--fake-port", type=int, default=8765)
+    parser.add_argument("--import-profile", type=int, default=0, metavar="N",
+                        help="also list the N slowest imports of server")
+    args = parser.parse_args()
+
+    photos = (sorted(IMAGES_DIR.glob("*.JPG")) + sorted(IMAGES_DIR.glob("*.jpg")))[:2]
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    fake = subprocess.Popen([
+        sys.executable, str(Path(__file__).resolve().parent / "fake_gemini.py"),
+        "--port", str(args.fake_port),
+        "--text-latency-ms", "0", "--image-latency-ms", "0", "--latency-sigma", "0",
+    ])
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            wait_until_ready(f"{fake_url}/docs", fake)
+            imports = time_imports(args.runs, api_env(work_dir, fake_url, warmup=False))
+            profile = import_profile(api_env(work_dir, fake_url, warmup=False), args.import_profile) \
+                if args.import_profile else []
+            for warmup in (False, True):
+                env = api_env(work_dir, fake_url, warmup)
+                results[warmup] = list(zip(*(start_once(args, env, photos) for _ in range(args.runs))))
+        finally:
+            fake.terminate()
+            fake.wait(timeout=10)
+
+    print(f"\n{'':<34}{'median':>9}{'min':>9}{'max':>9}")
+    print(f"{'import server':<34}{summarize(imports)}")
+    for warmup, (ready, first, second) in results.items():
+        label = "warm-up" if warmup else "no warm-up"
+        print(f"{f'{label}: start until /ready':<34}{summarize(ready)}")
+        print(f"{f'{label}: first request':<34}{summarize(first)}")
+        print(f"{f'{label}: second request':<34}{summarize(second)}")
+    if profile:
+        print(f"\nSlowest imports of server ({args.import_profile}):")
+        for seconds, name in profile:
+            print(f"  {seconds:>6.3f}s  {name}")
+
+
+if __name__ == "__main__":
+    main()
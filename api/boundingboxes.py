@@ -1,24 +1,22 @@
-from google import genai
-from google.genai import types
+"""
+Ask Gemini where grab bars should go in a bathroom photo and show the boxes.
+
+    python boundingboxes.py images/caleb.jpg
+"""
+import argparse
+import os
 from pathlib import Path
-import json
+from schemas import extract_json
 from PIL import Image, ImageDraw, ImageFont
 from PIL import ImageColor
 
 from io import BytesIO
-from config import GEMINI_API_KEY
-
-client = genai.Client(api_key=GEMINI_API_KEY)
 
 # Model
 MODEL_ID = "gemini-2.5-pro-preview-03-25"
 
-# Create a path object
-p = Path("images") / "caleb.jpg"
-
-# Load and resize image
-img = Image.open(p)
-img = img.resize((800, int(800 * img.size[1] / img.size[0])), Image.Resampling.LANCZOS) # Resizing to speed-up rendering
+# Default photo
+IMG_PATH = Path("images") / "caleb.jpg"
 
 
 bounding_box_system_instructions = """
@@ -27,10 +25,10 @@ bounding_box_system_instructions = """
       """
 
 safety_settings = [
-    types.SafetySetting(
-        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-        threshold="BLOCK_ONLY_HIGH",
-    ),
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH",
+    },
 ]
 
 prompt = "Analyze the bathroom layout, identifying key fixtures: toilet, shower/bathtub, sink, walls. " \
@@ -41,36 +39,6 @@ prompt = "Analyze the bathroom layout, identifying key fixtures: toilet, shower/
 "Generate an output image that is identical to the input image, but with added bounding boxes. " \
 "These boxes should clearly demarcate the suggested areas for grab bar installation. Do not insert the handle bars yet."
 
-# Load and resize image
-im = Image.open(BytesIO(open(p, "rb").read()))
-im.thumbnail([1024,1024], Image.Resampling.LANCZOS)
-
-# Run model to find bounding boxes
-response = client.models.generate_content(
-    model=MODEL_ID,
-    contents=[prompt, im],
-    config = types.GenerateContentConfig(
-        system_instruction=bounding_box_system_instructions,
-        temperature=0.5,
-        safety_settings=safety_settings,
-    )
-)
-
-# Check output
-print(response.text)
-
-
-# @title Parsing JSON output
-def parse_json(json_output: str):
-    # Parsing out the markdown fencing
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i+1:])  # Remove everything before "```json"
-            json_output = json_output.split("```")[0]  # Remove everything after the closing "```"
-            break  # Exit the loop once "```json" is found
-    return json_output
-
 additional_colors = [colorname for (colorname, colorcode) in ImageColor.colormap.items()]
 
 def plot_bounding_boxes(im, bounding_boxes):
@@ -117,13 +85,13 @@ def plot_bounding_boxes(im, bounding_boxes):
     'silver',
     ] + additional_colors
 
-    # Parsing out the markdown fencing
-    bounding_boxes = parse_json(bounding_boxes)
+    # Parsing out the markdown fencing and any surrounding prose
+    bounding_boxes = extract_json(bounding_boxes)
 
     font = ImageFont.load_default()
 
     # Iterate over the bounding boxes
-    for i, bounding_box in enumerate(json.loads(bounding_boxes)):
+    for i, bounding_box in enumerate(bounding_boxes):
       # Select a color from the list
       color = colors[i % len(colors)]
 
@@ -152,5 +120,40 @@ def plot_bounding_boxes(im, bounding_boxes):
     img.show()
 
 
-plot_bounding_boxes(im, response.text)
-im
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", default=str(IMG_PATH), help="bathroom photo")
+    args = parser.parse_args()
+
+    # Imported here so importing this module stays cheap
+    from google import genai
+    from google.genai import types
+    try:
+        from config import GEMINI_API_KEY
+    except ImportError:
+        GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+    client = genai.Client(api_key=GEMINI_API_KEY)
+
+    # Load and resize image
+    im = Image.open(BytesIO(open(args.image, "rb").read()))
+    im.thumbnail([1024,1024], Image.Resampling.LANCZOS)
+
+    # Run model to find bounding boxes
+    response = client.models.generate_content(
+        model=MODEL_ID,
+        contents=[prompt, im],
+        config = types.GenerateContentConfig(
+            system_instruction=bounding_box_system_instructions,
+            temperature=0.5,
+            safety_settings=safety_settings,
+        )
+    )
+
+    # Check output
+    print(response.text)
+
+    plot_bounding_boxes(im, response.text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+from lazy_imports import LazyModule
+
+types = LazyModule("google.genai.types")
+
+DISPLAY_NAME_PREFIX = "assessable"
+
+
+def inline_prefix(prefix, contents, config):
+    """The request with prefix sent inline, before contents, and its system instruction in config."""
+    if prefix.system_instruction:
+        config = (config or types.GenerateContentConfig()).model_copy(
+            update={"system_instruction": prefix.system_instruction})
+    return [prefix.text] + list(contents), config
+
+
+class ContextCacheManager:
+    """
+    Keeps a Gemini context cache (cached_content) of each prompt prefix per model.
+
+    apply() turns a request whose contents follow a PromptPrefix (see
+    prompts.py) into the request to send: pointing at the prefix's cache when
+    there is one, otherwise with the prefix inline. Caches are created by
+    warm() at startup or on first use, get their TTL extended when less than
+    refresh_margin_seconds are left, and are replaced when the prefix's
+    version changes. A model that refuses to cache a prefix, e.g. because it
+    is shorter than the model's minimum, is asked again after retry_seconds
+    and gets the prefix inline meanwhile.
+    """
+
+    def __init__(self, ttl_seconds, refresh_margin_seconds, retry_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.retry_seconds = retry_seconds
+        self.cached_requests = 0
+        self.inline_requests = 0
+        self.created = 0
+        self.refreshed = 0
+        self.deleted = 0
+
+        # (prefix name, model) -> {"name", "version", "expires"}
+        self._entries = {}
+        # (prefix version, model) -> (monotonic time, reason)
+        self._refused = {}
+        self._locks = {}
+
+    @staticmethod
+    def display_name(prefix):
+        return f"{DISPLAY_NAME_PREFIX}-{prefix.name}-{prefix.version}"
+
+    def _entry(self, prefix, cache):
+        expires = cache.expire_time.timestamp() if cache.expire_time else time.time() + self.ttl_seconds
+        return {"name": cache.name, "version": prefix.version, "expires": expires}
+
+    async def _create(self, client, model, prefix):
+        cache = await client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+            contents=[prefix.text],
+            system_instruction=prefix.system_instruction,
+            display_name=self.display_name(prefix),
+            ttl=f"{self.ttl_seconds}s",
+        ))
+        self.created += 1
+        print(f"Created context cache {cache.name} for {prefix.name} on {model}")
+        return self._entry(prefix, cache)
+
+    async def _refresh(self, client, prefix, entry):
+        cache = await client.aio.caches.update(
+            name=entry["name"], config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        self.refreshed += 1
+        return self._entry(prefix, cache)
+
+    async def _delete(self, client, name):
+        try:
+            await client.aio.caches.delete(name=name)
+            self.deleted += 1
+        except Exception as e:
+            print(f"Could not delete context cache {name}: {e}")
+
+    def _recently_refused(self, model, prefix):
+        refused = self._refused.get((prefix.version, model))
+        return refused is not None and time.monotonic() - refused[0] < self.retry_seconds
+
+    async def cache_name(self, client, model, prefix):
+        """Name of a live cache of prefix for model, creating or refreshing it as needed, or None."""
+        key = (prefix.name, model)
+        if self._recently_refused(model, prefix):
+            return None
+
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            # Requests that waited for the lock need not ask again for what was just refused
+            if self._recently_refused(model, prefix):
+                return None
+            entry = self._entries.get(key)
+            if entry is not None and entry["version"] != prefix.version:
+                # The prompt changed since the cache was made
+                await self._delete(client, entry["name"])
+                entry = None
+
+            now = time.time()
+            if entry is not None and entry["expires"] - now > self.refresh_margin_seconds:
+                return entry["name"]
+
+            try:
+                if entry is not None and entry["expires"] > now:
+                    try:
+                        entry = await self._refresh(client, prefix, entry)
+                    except Exception as e:
+                        print(f"Could not refresh context cache {entry['name']}, creating a new one: {e}")
+                        entry = await self._create(client, model, prefix)
+                else:
+                    entry = await self._create(client, model, prefix)
+            except Exception as e:
+                self._entries.pop(key, None)
+                self._refused[(prefix.version, model)] = (time.monotonic(), " ".join(str(e).split())[:300])
+                print(f"No context cache for {prefix.name} on {model}, sending the prompt inline: {e}")
+                return None
+
+            self._entries[key] = entry
+            return entry["name"]
+
+    async def apply(self, client, model, prefix, contents, config):
+        """Return the (contents, config, cache name or None) to send for a request following prefix."""
+        name = await self.cache_name(client, model, prefix)
+        if name is None:
+            self.inline_requests += 1
+            return (*inline_prefix(prefix, contents, config), None)
+
+        self.cached_requests += 1
+        config = (config or types.GenerateContentConfig()).model_copy(update={"cached_content": name})
+        return list(contents), config, name
+
+    def invalidate(self, model, prefix):
+        """Forget the cache of prefix for model, e.g. after Gemini no longer found it."""
+        self._entries.pop((prefix.name, model), None)
+
+    async def warm(self, client, pairs):
+        """
+        Get caches ready for every (model, prefix) in pairs: adopt live ones of
+        the current prompt versions, delete ours of older versions and create
+        the missing ones.
+        """
+        versions = {prefix.name: prefix.version for _, prefix in pairs}
+        current = {(self.display_name(prefix), model): prefix for model, prefix in pairs}
+        try:
+            async for cache in await client.aio.caches.list():
+                parts = (cache.display_name or "").split("-")
+                if len(parts) != 3 or parts[0] != DISPLAY_NAME_PREFIX:
+                    continue
+                model = (cache.model or "").split("/")[-1]
+                prefix = current.get((cache.display_name, model))
+                if prefix is not None:
+                    self._entries.setdefault((prefix.name, model), self._entry(prefix, cache))
+                elif parts[1] in versions and parts[2] != versions[parts[1]]:
+                    print(f"Deleting context cache {cache.name} of an older {parts[1]} prompt")
+                    await self._delete(client, cache.name)
+        except Exception as e:
+            print(f"Could not list context caches: {e}")
+
+        for model, prefix in pairs:
+            await self.cache_name(client, model, prefix)
+
+    def stats(self):
+        now = time.time()
+        return {
+            "cached_requests": self.cached_requests,
+            "inline_requests": self.inline_requests,
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "deleted": self.deleted,
+            "caches": [
+                {"prompt": prompt, "model": model, "name": entry["name"], "version": entry["version"],
+                 "expires_in": round(entry["expires"] - now)}
+                for (prompt, model), entry in self._entries.items()
+            ],
+            "refused": [
+                {"version": version, "model": model, "reason": reason}
+                for (version, model), (_, reason) in self._refused.items()
+            ],
+        }
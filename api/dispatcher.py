@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import time
+from contextvars import ContextVar
+
+from lazy_imports import LazyModule
+
+errors = LazyModule("google.genai.errors")
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Priority of the Gemini calls made in the current request or job
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+# Admission of the current request, set in the request's own context so the
+# tasks it starts (streams, image calls) share it
+request_admission = ContextVar("request_admission", default=None)
+
+RETRYABLE_CODES = (429, 500, 503)
+
+
+class GeminiOverloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many Gemini calls waiting, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Admission:
+    """Set once a request got its first Gemini call through, its later calls are never shed."""
+
+    def __init__(self):
+        self.admitted = False
+
+
+class TokenBucket:
+    """Allows rate_per_minute calls on average with bursts of up to burst calls."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def retry_after_seconds(error):
+    """Delay the server asked for in a 429/503, from Retry-After or the RetryInfo detail."""
+    headers = getattr(error.response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    details = error.details.get("error", {}).get("details", []) if isinstance(error.details, dict) else []
+    for detail in details:
+        delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return float(delay[:-1])
+            except ValueError:
+                pass
+    return None
+
+
+class GeminiDispatcher:
+    """
+    Every Gemini call goes through here.
+
+    A call waits for one of max_in_flight slots and for a token of its
+    model's bucket (model_limits maps model -> (requests per minute, burst);
+    models without an entry are only bounded by the slots). Waiting calls are
+    served by priority, interactive before background, then in arrival order.
+
+    When max_queue_depth calls are already waiting, a new interactive request
+    is shed with GeminiOverloaded instead of queueing; calls of a request that
+    already got through, and background jobs, always queue. Calls failing with
+    429/500/503 are retried up to max_retries times with exponential backoff
+    and full jitter, waiting at least as long as the server's Retry-After.
+    """
+
+    def __init__(self, max_in_flight, model_limits, max_queue_depth,
+                 max_retries, base_delay=1.0, max_delay=60.0):
+        self.max_in_flight = max_in_flight
+        self.buckets = {model: TokenBucket(rpm, burst) for model, (rpm, burst) in model_limits.items()}
+        self.max_queue_depth = max_queue_depth
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.shed = 0
+        self._latency = 5.0  # moving average of call duration, for Retry-After estimates
+        self._waiters = []
+        self._order = itertools.count()
+        self._wakeup = None
+
+    def _dispatch(self):
+        """Hand free slots to waiting calls whose model has a token, best priority first."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        next_token = None
+        skipped = []
+        while self._waiters and self.in_flight < self.max_in_flight:
+            entry = heapq.heappop(self._waiters)
+            _, _, model, future = entry
+            if future.done():
+                continue
+            bucket = self.buckets.get(model)
+            if bucket is not None and not bucket.try_take():
+                wait = bucket.wait_time()
+                next_token = wait if next_token is None else min(next_token, wait)
+                skipped.append(entry)
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+        if next_token is not None and self.in_flight < self.max_in_flight:
+            self._wakeup = asyncio.get_running_loop().call_later(next_token, self._dispatch)
+
+    def _queue_depth(self):
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    def estimated_wait(self):
+        return max(1, math.ceil(self._queue_depth() * self._latency / self.max_in_flight))
+
+    async def _acquire(self, model):
+        priority = request_priority.get()
+        admission = request_admission.get()
+        if admission is None:
+            admission = Admission()
+            request_admission.set(admission)
+        if (priority == INTERACTIVE and not admission.admitted
+                and self._queue_depth() >= self.max_queue_depth):
+            self.shed += 1
+            raise GeminiOverloaded(self.estimated_wait())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), model, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller went away
+                self._release()
+            raise
+        admission.admitted = True
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def call(self, model, make_call):
+        """Run make_call() (returning a coroutine) for model under the limits, retrying transient errors."""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(model)
+            start = time.monotonic()
+            try:
+                self.calls += 1
+                result = await make_call()
+                self._latency = 0.8 * self._latency + 0.2 * (time.monotonic() - start)
+                return result
+            except errors.APIError as e:
+                if e.code not in RETRYABLE_CODES or attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                delay = max(delay, retry_after_seconds(e) or 0)
+                print(f"Gemini {model} returned {e.code}, retrying in {delay:.1f}s "
+                      f"(attempt {attempt + 1}/{self.max_retries})")
+                self.retries += 1
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self._queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "calls": self.calls,
+            "retries": self.retries,
+            "shed": self.shed,
+            "tokens": {model: round(bucket.tokens, 2) for model, bucket in self.buckets.items()},
+        }
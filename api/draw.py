@@ -1,29 +1,19 @@
-import json
+"""
+Draw saved bounding boxes (JSON from boundingboxes.py) on a photo.
+
+    python draw.py images/blurry.jpg caleb.json
+"""
+import argparse
+from overlays import normalize_boxes
+from schemas import extract_json
 from PIL import Image, ImageDraw, ImageFont
 from PIL import ImageColor
-from io import BytesIO
 from pathlib import Path
 
-# Create a path object
+# Default photo and boxes
 IMG_PATH = Path("images") / "blurry.jpg"
 JSON_PATH = Path("caleb.json")
 
-with open(JSON_PATH, 'r', encoding='utf-8') as f:
-    json_output = f.read()
-
-# Load and resize image
-im = Image.open(IMG_PATH)
-
-def parse_json(json_output: str):
-    # Parsing out the markdown fencing
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i+1:])  # Remove everything before "```json"
-            json_output = json_output.split("```")[0]  # Remove everything after the closing "```"
-            break  # Exit the loop once "```json" is found
-    return json_output
-
 additional_colors = [colorname for (colorname, colorcode) in ImageColor.colormap.items()]
 
 def plot_bounding_boxes(im, bounding_boxes):
@@ -70,27 +60,20 @@ def plot_bounding_boxes(im, bounding_boxes):
     'silver',
     ] + additional_colors
 
-    # Parsing out the markdown fencing
-    bounding_boxes = parse_json(bounding_boxes)
+    # Parsing out the markdown fencing and any surrounding prose
+    bounding_boxes = extract_json(bounding_boxes)
 
     font = ImageFont.load_default()
 
+    # Convert normalized coordinates to absolute coordinates, fixing swapped corners
+    _, absolute = normalize_boxes([bounding_box["box_2d"] for bounding_box in bounding_boxes], width, height)
+
     # Iterate over the bounding boxes
-    for i, bounding_box in enumerate(json.loads(bounding_boxes)):
+    for i, (bounding_box, pixels) in enumerate(zip(bounding_boxes, absolute)):
       # Select a color from the list
       color = colors[i % len(colors)]
 
-      # Convert normalized coordinates to absolute coordinates
-      abs_y1 = int(bounding_box["box_2d"][0]/1000 * height)
-      abs_x1 = int(bounding_box["box_2d"][1]/1000 * width)
-      abs_y2 = int(bounding_box["box_2d"][2]/1000 * height)
-      abs_x2 = int(bounding_box["box_2d"][3]/1000 * width)
-
-      if abs_x1 > abs_x2:
-        abs_x1, abs_x2 = abs_x2, abs_x1
-
-      if abs_y1 > abs_y2:
-        abs_y1, abs_y2 = abs_y2, abs_y1
+      abs_x1, abs_y1, abs_x2, abs_y2 = pixels["x1"], pixels["y1"], pixels["x2"], pixels["y2"]
 
       # Draw the bounding box
       draw.rectangle(
@@ -105,5 +88,17 @@ def plot_bounding_boxes(im, bounding_boxes):
     img.show()
 
 
-plot_bounding_boxes(im, json_output)
-im
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", default=str(IMG_PATH), help="photo to draw on")
+    parser.add_argument("boxes", nargs="?", default=str(JSON_PATH), help="JSON boxes from boundingboxes.py")
+    args = parser.parse_args()
+
+    with open(args.boxes, 'r', encoding='utf-8') as f:
+        json_output = f.read()
+
+    plot_bounding_boxes(Image.open(args.image), json_output)
+
+
+if __name__ == "__main__":
+    main()
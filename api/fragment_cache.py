@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    """
+    In-memory LRU cache of rendered report pages (pdf_report.PageFragment).
+
+    Keys identify what was rendered (results ZIP, recommendation index and
+    image settings), so a report with one more recommendation only renders
+    that one. The least recently used fragments are dropped once the cached
+    fragments add up to more than max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> fragment, least recently used first
+        self._fragments = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment):
+        with self._lock:
+            old = self._fragments.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old.size
+            self._fragments[key] = fragment
+            self._total_bytes += fragment.size
+
+            while self._total_bytes > self.max_bytes and len(self._fragments) > 1:
+                _, evicted = self._fragments.popitem(last=False)
+                self._total_bytes -= evicted.size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._fragments),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pydantic import TypeAdapter
+
+from lazy_imports import LazyModule
+
+types = LazyModule("google.genai.types")
+
+
+class GeminiCache:
+    """
+    Content-addressed on-disk cache for Gemini generate_content responses.
+
+    Each entry is a JSON file named after the SHA-256 of the request (model,
+    image bytes, prompt text, system instruction and generation config) and
+    holds the text and inline-image parts of the first candidate. Entries
+    expire after ttl_seconds and the least recently used ones are evicted once
+    the directory grows past max_bytes. The directory is read on first use,
+    or by load(). get and put do blocking file I/O, call them from a thread
+    when on an event loop; the index is shared between threads.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl_seconds):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self):
+        """Index the entries left by previous runs, once."""
+        with self._load_lock:
+            if self._loaded:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_index()
+            self._loaded = True
+
+    def _load_index(self):
+        # Rebuild the LRU order from file access times left by previous runs
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, filename))
+            entries.append((stat.st_atime, filename[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _forget_index_only(self, key):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._total_bytes -= size
+
+    def _forget(self, key):
+        self._forget_index_only(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            while self._total_bytes > self.max_bytes and self._entries:
+                key = next(iter(self._entries))
+                self._forget(key)
+                self.evictions += 1
+
+    @staticmethod
+    def make_key(model, contents, config=None):
+        """Hash everything that determines the model output into one key."""
+        digest = hashlib.sha256()
+        digest.update(f"model:{model}\n".encode())
+
+        for item in contents:
+            if isinstance(item, types.Part):
+                item = item.model_dump(exclude_none=True)
+            if isinstance(item, str):
+                digest.update(b"text:" + item.encode() + b"\n")
+            elif isinstance(item, dict) and "inline_data" in item:
+                data = item["inline_data"]["data"]
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                digest.update(f"blob:{item['inline_data']['mime_type']}:".encode())
+                digest.update(hashlib.sha256(data).digest() + b"\n")
+            elif isinstance(item, dict) and "text" in item:
+                digest.update(b"text:" + item["text"].encode() + b"\n")
+            else:
+                raise TypeError(f"Cannot build a cache key for content of type {type(item).__name__}")
+
+        if config is not None:
+            digest.update(b"config:" + config.model_dump_json(
+                exclude_none=True, exclude={"response_schema"}).encode())
+
+            # Response schemas may be given as Python types, which do not serialize
+            schema = config.response_schema
+            if isinstance(schema, types.Schema):
+                schema = schema.model_dump(mode="json", exclude_none=True)
+            elif schema is not None and not isinstance(schema, dict):
+                schema = TypeAdapter(schema).json_schema()
+            if schema is not None:
+                digest.update(b"schema:" + json.dumps(schema, sort_keys=True).encode())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss."""
+        self.load()
+        # Read the file even when it is not indexed, another worker may have written it
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        if time.time() - entry["created"] > self.ttl_seconds:
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        size = os.path.getsize(path)
+        os.utime(path)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = size
+                self._total_bytes += size
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        parts = []
+        for part in entry["parts"]:
+            if "text" in part:
+                parts.append(types.Part(text=part["text"]))
+            else:
+                parts.append(types.Part(inline_data=types.Blob(
+                    mime_type=part["mime_type"],
+                    data=base64.b64decode(part["data"]),
+                )))
+        return types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=parts))
+        ])
+
+    def put(self, key, response):
+        """Store the text and inline-image parts of a response."""
+        self.load()
+        if not response.candidates or not response.candidates[0].content:
+            return
+
+        parts = []
+        for part in response.candidates[0].content.parts or []:
+            if part.text is not None:
+                parts.append({"text": part.text})
+            elif part.inline_data is not None:
+                parts.append({
+                    "mime_type": part.inline_data.mime_type,
+                    "data": base64.b64encode(part.inline_data.data).decode(),
+                })
+        if not parts:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "parts": parts}, f)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._forget_index_only(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict()
+
+    def stats(self):
+        self.load()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+        }
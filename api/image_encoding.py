@@ -0,0 +1,145 @@
+import hashlib
+import io
+import mimetypes
+from dataclasses import dataclass
+
+from PIL import Image, features
+
+# format -> (Pillow format, file extension, MIME type)
+IMAGE_FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "avif": ("AVIF", "avif", "image/avif"),
+}
+
+# Lowest quality a byte budget may push lossy formats to before images are downscaled instead
+MIN_QUALITY = 40
+
+# Each step of downscaling to fit a byte budget shrinks both sides by this factor
+DOWNSCALE_STEP = 0.75
+
+THUMBNAIL_QUALITY = 70
+
+
+def content_type(filename):
+    """MIME type of a results file, by extension."""
+    extension = filename.rsplit(".", 1)[-1].lower()
+    for _, format_extension, mime_type in IMAGE_FORMATS.values():
+        if extension == format_extension:
+            return mime_type
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def supported_format(name):
+    """Return name, or webp when this Pillow build cannot write it (AVIF needs libavif)."""
+    if name == "avif" and not features.check("avif"):
+        print("AVIF is not supported by this Pillow build, using WebP")
+        return "webp"
+    return name
+
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    """How generated images are encoded for the app."""
+    format: str = "png"
+    quality: int = 80
+    # Per-image budget, 0 for none
+    max_bytes: int = 0
+    # Longest side of the preview thumbnail next to each image, 0 for none
+    thumbnail_size: int = 0
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.format][1]
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    extension: str
+    mime_type: str
+
+    @property
+    def sha256(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+
+def _save(image, pil_format, quality):
+    buffered = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffered, format="PNG")
+    elif pil_format == "JPEG":
+        image.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffered, format=pil_format, quality=quality)
+    return buffered.getvalue()
+
+
+def _fit_quality(image, pil_format, quality, max_bytes):
+    """Highest quality from MIN_QUALITY to quality whose encoding fits max_bytes, or None."""
+    data = _save(image, pil_format, quality)
+    if len(data) <= max_bytes:
+        return data
+
+    best = None
+    low, high = MIN_QUALITY, quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        data = _save(image, pil_format, middle)
+        if len(data) <= max_bytes:
+            best, low = data, middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def encode_image(image, encoding, quality=None, source=None):
+    """
+    Encode a PIL image as encoding.format and return an EncodedImage.
+
+    With a byte budget (encoding.max_bytes) lossy formats first lower their
+    quality down to MIN_QUALITY, then the image is downscaled step by step
+    until it fits; PNG is only downscaled. source, the bytes the image was
+    decoded from, is returned as is when it already has the requested
+    format and fits the budget.
+    """
+    pil_format, extension, mime_type = IMAGE_FORMATS[encoding.format]
+    quality = quality or encoding.quality
+    max_bytes = encoding.max_bytes
+
+    if (source is not None and getattr(image, "format", None) == pil_format
+            and (not max_bytes or len(source) <= max_bytes)):
+        return EncodedImage(source, extension, mime_type)
+
+    if pil_format in ("JPEG", "WEBP", "AVIF") and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    while True:
+        if not max_bytes:
+            data = _save(image, pil_format, quality)
+        elif pil_format == "PNG":
+            data = _save(image, pil_format, quality)
+            data = data if len(data) <= max_bytes else None
+        else:
+            data = _fit_quality(image, pil_format, quality, max_bytes)
+
+        if data is not None or min(image.size) <= 16:
+            return EncodedImage(data if data is not None else _save(image, pil_format, MIN_QUALITY),
+                                extension, mime_type)
+        image = image.resize((round(image.width * DOWNSCALE_STEP), round(image.height * DOWNSCALE_STEP)),
+                             Image.Resampling.LANCZOS)
+
+
+def encode_thumbnail(image, encoding):
+    """
+    Encode a preview of image no larger than encoding.thumbnail_size, or
+    return None. Previews of PNG results are JPEGs, lossless ones would often
+    outweigh the full image.
+    """
+    if not encoding.thumbnail_size:
+        return None
+    thumbnail = image.copy()
+    thumbnail.thumbnail([encoding.thumbnail_size, encoding.thumbnail_size], Image.Resampling.LANCZOS)
+    thumbnail_format = "jpeg" if encoding.format == "png" else encoding.format
+    return encode_image(thumbnail, ImageEncoding(format=thumbnail_format), quality=THUMBNAIL_QUALITY)
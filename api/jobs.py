@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import json
+import time
+import traceback
+import uuid
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    One background analysis. Progress is recorded as an ordered list of
+    events, and every ZIP member is kept in artifacts as soon as it exists so
+    clients can fetch it before the whole job is finished.
+    """
+
+    def __init__(self, session_id):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []
+        self.artifacts = {}
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def progress(self, stage, files=(), **data):
+        """Record a stage event, storing any (filename, bytes) members it produced."""
+        for filename, content in files:
+            self.artifacts[filename] = content
+        event = {"id": len(self.events), "stage": stage, "time": time.time(), **data}
+        if files:
+            event["files"] = [filename for filename, _ in files]
+        self.events.append(event)
+
+        # Wake up everyone waiting on the previous event and start a new one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "session_id": self.session_id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "events": self.events,
+            "artifacts": sorted(self.artifacts),
+        }
+
+    async def stream_events(self, last_event_id=-1, keepalive_seconds=15):
+        """Yield Server-Sent Events from last_event_id + 1 until the job finishes."""
+        next_id = last_event_id + 1
+        while True:
+            while next_id < len(self.events):
+                event = self.events[next_id]
+                yield f"id: {event['id']}\nevent: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+                next_id += 1
+
+            if self.finished:
+                return
+
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=keepalive_seconds)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+
+
+class JobManager:
+    """
+    Bounded pool of worker tasks running analyses in the background.
+
+    At most max_workers jobs run at once and at most max_queued wait for a
+    worker; submit raises JobQueueFull beyond that. Finished jobs are kept for
+    ttl_seconds so clients can still read their results. Each job runs in a
+    copy of the context it was submitted from, so request settings held in
+    context variables (e.g. a cache bypass) apply to that job only.
+    """
+
+    def __init__(self, max_workers, max_queued, ttl_seconds):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._queue = None
+        self._workers = []
+
+    def start(self):
+        """Create the queue and workers on the running event loop, from a startup hook."""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    def submit(self, session_id, run):
+        """
+        Queue run(progress) as a new job and return it.
+
+        run is an async callable that receives the job's progress method.
+        """
+        self.start()
+        self.purge_finished()
+
+        job = Job(session_id)
+        try:
+            self._queue.put_nowait((job, run, contextvars.copy_context()))
+        except asyncio.QueueFull:
+            raise JobQueueFull()
+        self._jobs[job.id] = job
+        job.progress("queued")
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def purge_finished(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job, run, context = await self._queue.get()
+            job.status = "running"
+            job.progress("started")
+            try:
+                await asyncio.create_task(run(job.progress), context=context)
+                job.status = "done"
+                job.finished_at = time.time()
+                job.progress("done")
+            except Exception as e:
+                traceback.print_exc()
+                job.status = "failed"
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.progress("failed", error=str(e))
+            finally:
+                self._queue.task_done()
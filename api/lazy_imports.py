@@ -0,0 +1,21 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    For google.genai, whose import is most of the server's start-up time:
+    `types = LazyModule("google.genai.types")` reads like the import it
+    replaces, and modules using it can be imported (by tools, report pool
+    workers, the start-up benchmark) without paying for it.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
@@ -0,0 +1,106 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+GEMINI_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+stage_seconds = Histogram(
+    "assessable_stage_seconds", "Time spent in each processing stage", ["stage"], buckets=STAGE_BUCKETS)
+gemini_call_seconds = Histogram(
+    "assessable_gemini_call_seconds", "Duration of Gemini calls, cache hits included",
+    ["model", "purpose", "cached"], buckets=GEMINI_BUCKETS)
+gemini_tokens = Counter(
+    "assessable_gemini_tokens", "Tokens reported in Gemini usage_metadata",
+    ["model", "purpose", "kind"])
+gemini_errors = Counter(
+    "assessable_gemini_errors", "Gemini calls that raised", ["model", "purpose"])
+route_decisions = Counter(
+    "assessable_route_decisions", "Outcome of each model tried for a pipeline stage",
+    ["stage", "model", "outcome"])
+
+# usage_metadata field -> kind label
+TOKEN_FIELDS = {
+    "prompt_token_count": "prompt",
+    "candidates_token_count": "output",
+    "thoughts_token_count": "thoughts",
+    "cached_content_token_count": "cached",
+    "total_token_count": "total",
+}
+
+
+class RequestMetrics:
+    """Stage timings and token counts of one request or background job."""
+
+    def __init__(self):
+        self.timings = {}
+        self.tokens = {}
+        self.routes = []
+        self.started = time.perf_counter()
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def add_tokens(self, model, counts):
+        model_tokens = self.tokens.setdefault(model, {})
+        for kind, count in counts.items():
+            model_tokens[kind] = model_tokens.get(kind, 0) + count
+
+    def server_timing(self):
+        """Server-Timing header value, one metric per stage plus the total so far."""
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.timings.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def summary(self):
+        return {
+            "timings_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()},
+            "tokens": self.tokens,
+            "routes": self.routes,
+        }
+
+
+# Metrics of the current request, tasks started by it share the same object
+current_metrics = ContextVar("current_metrics", default=None)
+
+
+@contextmanager
+def timed(stage):
+    """Time a block into the stage histogram and the current request's timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.labels(stage).observe(seconds)
+        request_metrics = current_metrics.get()
+        if request_metrics is not None:
+            request_metrics.add_time(stage, seconds)
+
+
+def record_gemini_call(model, purpose, seconds, response=None, cached=False):
+    """Record a Gemini call's duration and, unless served from cache, its token usage."""
+    gemini_call_seconds.labels(model, purpose, "1" if cached else "0").observe(seconds)
+    request_metrics = current_metrics.get()
+    if request_metrics is not None:
+        request_metrics.add_time(f"gemini-{purpose}", seconds)
+
+    usage = getattr(response, "usage_metadata", None)
+    if cached or usage is None:
+        return
+    counts = {kind: getattr(usage, field) for field, kind in TOKEN_FIELDS.items()
+              if getattr(usage, field, None)}
+    for kind, count in counts.items():
+        gemini_tokens.labels(model, purpose, kind).inc(count)
+    if request_metrics is not None:
+        request_metrics.add_tokens(model, counts)
+
+
+def record_route(stage, model, outcome):
+    """Record whether a stage's reply from model was accepted or escalated to the next model."""
+    route_decisions.labels(stage, model, outcome).inc()
+    request_metrics = current_metrics.get()
+    if request_metrics is not None:
+        request_metrics.routes.append({"stage": stage, "model": model, "outcome": outcome})
@@ -0,0 +1,79 @@
+import json
+
+# How the app should draw the boxes, the same as the PNG overlays
+OVERLAY_STYLE = {"color": "green", "line_width": 4}
+
+MANIFEST_FILENAME = "overlays.json"
+
+
+def image_filename(frame):
+    return f"image_{frame}.jpg"
+
+
+def thumbnail_filename(frame, extension):
+    return f"image_{frame}_thumb.{extension}"
+
+
+def normalize_boxes(boxes, width, height):
+    """
+    Clean up a batch of [ymin, xmin, ymax, xmax] boxes as returned by Gemini.
+
+    All boxes are handled in one pass: swapped corners are put back in order
+    and coordinates clamped to 0-1000, then scaled to a width x height image.
+    Returns (normalized, absolute), the normalized boxes in the same
+    [ymin, xmin, ymax, xmax] layout and the absolute ones as pixel
+    {"x1", "y1", "x2", "y2"} dicts.
+    """
+    normalized = [
+        [max(0, min(1000, value)) for value in (min(y1, y2), min(x1, x2), max(y1, y2), max(x1, x2))]
+        for y1, x1, y2, x2 in boxes
+    ]
+    absolute = [
+        {
+            "x1": int(x1 / 1000 * width),
+            "y1": int(y1 / 1000 * height),
+            "x2": int(x2 / 1000 * width),
+            "y2": int(y2 / 1000 * height),
+        }
+        for y1, x1, y2, x2 in normalized
+    ]
+    return normalized, absolute
+
+
+def build_manifest(located, sizes, thumbnails=None):
+    """
+    Return the overlay manifest as JSON text.
+
+    located is a list of (rec_idx, frame, box) for every recommendation with
+    a box, box being a {"box_2d", "label"} dict as returned by Gemini, and
+    sizes maps each frame number to its (width, height). The app draws each
+    box on image_<frame>.jpg itself instead of receiving one PNG per box.
+    thumbnails maps frame numbers to the filename of their preview, if any.
+    """
+    thumbnails = thumbnails or {}
+    recommendations = []
+    by_frame = {}
+    for entry in located:
+        by_frame.setdefault(entry[1], []).append(entry)
+
+    for frame, entries in by_frame.items():
+        width, height = sizes[frame]
+        normalized, absolute = normalize_boxes([box["box_2d"] for _, _, box in entries], width, height)
+        for (rec_idx, _, box), box_2d, pixels in zip(entries, normalized, absolute):
+            recommendations.append({
+                "index": rec_idx + 1,
+                "image": image_filename(frame),
+                "label": box.get("label"),
+                "box_2d": box_2d,
+                "box": pixels,
+            })
+
+    return json.dumps({
+        "images": [
+            {"frame": frame, "file": image_filename(frame), "thumbnail": thumbnails.get(frame),
+             "width": width, "height": height}
+            for frame, (width, height) in sorted(sizes.items())
+        ],
+        "style": OVERLAY_STYLE,
+        "recommendations": sorted(recommendations, key=lambda rec: rec["index"]),
+    }, indent=2)
@@ -1,15 +1,117 @@
 from fpdf import FPDF
+from dataclasses import dataclass
 from datetime import datetime
+from PIL import Image
+import hashlib
+import io
+import re
+import struct
+
+# Width images are printed at on the page
+IMAGE_WIDTH_MM = 180
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# How a page stream draws an image, "/I<n> Do"
+IMAGE_REFERENCE = re.compile(r"/I(\d+) Do")
+
+# Fonts the report uses, registered up front so every document numbers them the
+# same way and rendered pages can be moved between documents
+REPORT_FONTS = (("Arial", ""), ("Arial", "B"), ("Arial", "I"))
+
+
+def _png_info(data):
+    """
+    Build the FPDF image info for a PNG without decoding it.
+
+    PDF's FlateDecode with the PNG predictor reads IDAT data as is, so 8-bit
+    opaque, non-interlaced RGB, gray and palette PNGs can be embedded directly.
+    Returns None for anything else (alpha, 16-bit, interlaced, transparency).
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+
+    pos = len(PNG_SIGNATURE)
+    info = None
+    pal = b""
+    idat = []
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+        if chunk_type == b"IHDR":
+            w, h, bpc, ct, _, _, interlace = struct.unpack(">IIBBBBB", chunk)
+            colspace = {0: "DeviceGray", 2: "DeviceRGB", 3: "Indexed"}.get(ct)
+            if colspace is None or bpc != 8 or interlace:
+                return None
+            colors = 3 if colspace == "DeviceRGB" else 1
+            info = {"w": w, "h": h, "cs": colspace, "bpc": bpc, "f": "FlateDecode",
+                    "dp": f"/Predictor 15 /Colors {colors} /BitsPerComponent {bpc} /Columns {w}"}
+        elif chunk_type == b"PLTE":
+            pal = chunk
+        elif chunk_type == b"tRNS":
+            return None
+        elif chunk_type == b"IDAT":
+            idat.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+
+    if info is None or not idat or (info["cs"] == "Indexed" and not pal):
+        return None
+    info["pal"] = pal
+    info["trns"] = ""
+    info["data"] = b"".join(idat)
+    return info
+
+
+def _jpeg_info(data, image):
+    colspace = {"RGB": "DeviceRGB", "L": "DeviceGray", "CMYK": "DeviceCMYK"}.get(image.mode)
+    if colspace is None:
+        return None
+    w, h = image.size
+    return {"w": w, "h": h, "cs": colspace, "bpc": 8, "f": "DCTDecode", "data": data}
+
+
+@dataclass
+class PageFragment:
+    """Content streams of rendered report pages and the images they draw."""
+    pages: list
+    images: dict
+
+    @property
+    def size(self):
+        return sum(map(len, self.pages)) + sum(len(info["data"]) for info in self.images.values())
+
 
 class PDFReport(FPDF):
+    """
+    The home safety report.
+
+    Images can be given as PNG or JPEG bytes. By default they are embedded
+    without being decoded. With image_dpi set, images wider than
+    IMAGE_WIDTH_MM at that resolution are downsampled, and with jpeg_quality
+    set every image is re-encoded as a JPEG of that quality.
+    """
+
+    def __init__(self, *args, image_dpi=None, jpeg_quality=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.cover_page = None
+        for family, style in REPORT_FONTS:
+            self.set_font(family, style)
+        self.set_font(*REPORT_FONTS[0])
+
     def header(self):
         # Custom header for every page except the cover
-        if self.page_no() != 1:
+        if self.page != self.cover_page:
             self.set_font('Arial', 'B', 15)
             self.cell(0, 10, 'Fall Prevention Home Safety Report', align='C')
             self.ln(10)
 
     def add_cover_page(self):
+        self.cover_page = self.page + 1
         self.add_page()
         self.set_font('Arial', 'B', 24)
         self.cell(0, 80, '', ln=True)  # vertical space
@@ -29,11 +131,63 @@ class PDFReport(FPDF):
         self.set_font('Arial', '', 12)
         self.multi_cell(0, 10, 'This report contains home safety recommendations aimed at reducing fall risks for older adults. Each recommendation is supported by rationale, cost estimate, and installation notes.')
 
-    def add_image_and_description(self, img_path, text_data):
+    def _image_info(self, data):
+        image = Image.open(io.BytesIO(data))
+        max_width = round(IMAGE_WIDTH_MM / 25.4 * self.image_dpi) if self.image_dpi else None
+
+        if not self.jpeg_quality and (max_width is None or image.width <= max_width):
+            info = _png_info(data) if image.format == "PNG" else None
+            if image.format == "JPEG":
+                info = _jpeg_info(data, image)
+            if info is not None:
+                return info
+
+        # Decode only when resizing, re-encoding or the format cannot be embedded as is
+        image = image.convert("RGB")
+        if max_width is not None and image.width > max_width:
+            image.thumbnail([max_width, image.height], Image.Resampling.LANCZOS)
+        buffered = io.BytesIO()
+        if self.jpeg_quality:
+            image.save(buffered, format="JPEG", quality=self.jpeg_quality, optimize=True)
+            return _jpeg_info(buffered.getvalue(), image)
+        image.save(buffered, format="PNG")
+        return _png_info(buffered.getvalue())
+
+    def add_image_bytes(self, data, image_id=None):
+        """
+        Register in-memory image bytes and return the name to pass to image().
+
+        image_id sets the number the image is drawn under (/I<image_id>), it
+        must be unique within the final document. It is part of the name too,
+        so fragments with the same image bytes keep an entry each when joined.
+        """
+        name = "mem:" + hashlib.sha256(data).hexdigest()
+        if image_id is not None:
+            name = f"mem:{image_id}:" + name[len("mem:"):]
+        if name not in self.images:
+            info = self._image_info(data)
+            info["i"] = image_id or len(self.images) + 1
+            self.images[name] = info
+        return name
+
+    def fragment(self):
+        return PageFragment(
+            pages=[self.pages[n] for n in range(1, self.page + 1)],
+            images=dict(self.images),
+        )
+
+    def to_bytes(self):
+        # FPDF builds the document as a latin-1 str
+        return self.output(dest="S").encode("latin-1")
+
+    def add_image_and_description(self, image, text_data):
+        """Add a recommendation page. image is a file path, a name from add_image_bytes or PNG/JPEG bytes."""
         self.add_page()
 
         # Insert the image
-        self.image(img_path, x=10, y=20, w=180)
+        if isinstance(image, bytes):
+            image = self.add_image_bytes(image)
+        self.image(image, x=10, y=20, w=IMAGE_WIDTH_MM)
         self.ln(110)  # Adjust based on image size
 
         # Insert the text content
@@ -42,24 +196,63 @@ class PDFReport(FPDF):
         self.ln(5)
 
         self.set_font('Arial', 'B', 12)
-        self.multi_cell(0, 8, f"Rationale:", align="L")
+        self.multi_cell(0, 8, "Rationale:", align="L")
         self.set_font('Arial', '', 12)
         self.multi_cell(0, 8, text_data.get('rationale', 'N/A'))
         self.ln(5)
 
         self.set_font('Arial', 'B', 12)
-        self.multi_cell(0, 8, f"Modification:", align="L")
+        self.multi_cell(0, 8, "Modification:", align="L")
         self.set_font('Arial', '', 12)
         self.multi_cell(0, 8, text_data.get('modification', 'N/A'))
         self.ln(5)
 
         self.set_font('Arial', 'B', 12)
-        self.multi_cell(0, 8, f"Cost:", align="L")
+        self.multi_cell(0, 8, "Cost:", align="L")
         self.set_font('Arial', '', 12)
         self.multi_cell(0, 8, text_data.get('cost', 'N/A'))
         self.ln(5)
 
         self.set_font('Arial', 'B', 12)
-        self.multi_cell(0, 8, f"Installation:", align="L")
+        self.multi_cell(0, 8, "Installation:", align="L")
         self.set_font('Arial', '', 12)
-        self.multi_cell(0, 8, text_data.get('installation', 'N/A'))
\ No newline at end of file
+        self.multi_cell(0, 8, text_data.get('installation', 'N/A'))
+
+
+def render_cover_page():
+    pdf = PDFReport()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_cover_page()
+    return pdf.fragment()
+
+
+def render_recommendation_pages(image_bytes, text_data, image_id, image_dpi=None, jpeg_quality=None):
+    """
+    Render one recommendation on its own and return its pages as a PageFragment.
+
+    Module level so it can run in a process pool.
+    """
+    pdf = PDFReport(image_dpi=image_dpi, jpeg_quality=jpeg_quality)
+    pdf.set_auto_page_break(auto=True, margin=15)
+    name = pdf.add_image_bytes(image_bytes, image_id)
+    pdf.add_image_and_description(name, text_data)
+    return pdf.fragment()
+
+
+def assemble_report(fragments):
+    """Join rendered fragments, in order, into the final PDF bytes."""
+    pdf = PDFReport()
+    for fragment in fragments:
+        for name, info in fragment.images.items():
+            # Copied since writing the document stores object numbers in it
+            pdf.images[name] = dict(info)
+        for content in fragment.pages:
+            pdf.add_page()
+            pdf.pages[pdf.page] = content
+
+    # A page drawing an image the document lacks makes the whole PDF unreadable
+    drawn = {int(i) for content in pdf.pages.values() for i in IMAGE_REFERENCE.findall(content)}
+    missing = drawn - {info["i"] for info in pdf.images.values()}
+    if missing:
+        raise ValueError(f"Report pages draw images that are not in the document: {sorted(missing)}")
+    return pdf.to_bytes()
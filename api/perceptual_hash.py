@@ -0,0 +1,73 @@
+from PIL import Image
+
+
+def dhash(image, hash_size=8):
+    """
+    Difference hash of an image as a 64-bit int (for hash_size=8).
+
+    The image is shrunk to (hash_size + 1) x hash_size grayscale and each bit
+    records whether a pixel is brighter than its right neighbour, so small
+    changes in framing, scale or compression barely move the hash.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes for Hamming-distance range queries.
+
+    Each node keeps the values stored under its hash and its children keyed by
+    their distance to it, so a search only descends into children whose
+    distance lies within max_distance of the query's distance to the node.
+    """
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self._root is None:
+            self._root = (key, [value], {})
+            return
+
+        node = self._root
+        while True:
+            node_key, values, children = node
+            distance = hamming_distance(key, node_key)
+            if distance == 0:
+                values.append(value)
+                return
+            if distance not in children:
+                children[distance] = (key, [value], {})
+                return
+            node = children[distance]
+
+    def search(self, key, max_distance):
+        """Return (distance, value) pairs within max_distance, closest first."""
+        if self._root is None:
+            return []
+
+        found = []
+        stack = [self._root]
+        while stack:
+            node_key, values, children = stack.pop()
+            distance = hamming_distance(key, node_key)
+            if distance <= max_distance:
+                found.extend((distance, value) for value in values)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
@@ -0,0 +1,1021 @@
+"""
+The assessment pipeline: preprocess, recommend, localize, render and report.
+
+Used by the API (server.py) and by batch.py. Importing it does no work of its
+own: google.genai is imported, and the Gemini client created, on the first
+call, the caches and stores read their directories on first use and the
+report pool starts with the first report. Settings come from the environment,
+see each one below.
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from artifact_store import ArtifactStore
+from context_cache import ContextCacheManager, inline_prefix
+from dispatcher import GeminiDispatcher
+from fragment_cache import FragmentCache
+from gemini_cache import GeminiCache
+from image_encoding import IMAGE_FORMATS, ImageEncoding, content_type, encode_image, encode_thumbnail
+from lazy_imports import LazyModule
+from metrics import gemini_errors, record_gemini_call, record_route, timed
+from overlays import (MANIFEST_FILENAME, OVERLAY_STYLE, build_manifest, image_filename, normalize_boxes,
+                      thumbnail_filename)
+from preprocess import preview_part
+from prompts import (GENERAL_ROOM, PROMPT_PREFIXES, modification_suffix, recommendation_pack,
+                     recommendations_suffix)
+from schemas import (ROOM_TYPES, BoundingBoxList, FrameRecommendationList, LocatedFrameRecommendationList,
+                     JsonArrayStream, LocatedRecommendationList, RecommendationList, RoomClassification,
+                     parse_item, parse_response)
+from sessions import create_session_store
+
+# google.genai is imported on first use, it is most of the start-up time (see bench/startup.py)
+genai = LazyModule("google.genai")
+errors = LazyModule("google.genai.errors")
+types = LazyModule("google.genai.types")
+
+# Gemini Client, the key comes from config.py or the GEMINI_API_KEY environment variable
+try:
+    from config import GEMINI_API_KEY
+except ImportError:
+    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+
+# GEMINI_BASE_URL points the client at another endpoint, e.g. bench/fake_gemini.py
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+# Created by get_client() on first use
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None,
+        )
+    return client
+
+
+MODEL_ID = "gemini-2.5-pro-exp-03-25"
+MODEL_ID_IMG_GEN = "gemini-2.0-flash-exp-image-generation"
+FLASH_MODEL_ID = "gemini-2.0-flash"
+
+# Models per pipeline stage, set with MODEL_ROUTE_<STAGE>. Several comma-separated
+# models form a cascade: the next model is only tried when a reply fails
+# validation or the stage's confidence check, and the last one's reply is used
+MODEL_ROUTES = {
+    stage: os.environ.get(f"MODEL_ROUTE_{stage.upper()}", default).split(",")
+    for stage, default in {
+        "audio": FLASH_MODEL_ID,
+        "room": FLASH_MODEL_ID,
+        "recommendations": MODEL_ID,
+        "bounding_box": f"{FLASH_MODEL_ID},{MODEL_ID}",
+        "mod_image": MODEL_ID_IMG_GEN,
+    }.items()
+}
+
+# Every Gemini call of this worker goes through the dispatcher: at most
+# GEMINI_CONCURRENCY in flight, per-model requests per minute and bursts, retries
+# of 429/5xx replies, and a cap on waiting calls past which requests get a 503
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "4"))
+gemini_dispatcher = GeminiDispatcher(
+    max_in_flight=GEMINI_CONCURRENCY,
+    model_limits={
+        MODEL_ID: (int(os.environ.get("GEMINI_RPM", "60")),
+                   int(os.environ.get("GEMINI_BURST", "10"))),
+        MODEL_ID_IMG_GEN: (int(os.environ.get("GEMINI_IMG_GEN_RPM", "30")),
+                           int(os.environ.get("GEMINI_IMG_GEN_BURST", "6"))),
+        FLASH_MODEL_ID: (int(os.environ.get("GEMINI_FLASH_RPM", "300")),
+                         int(os.environ.get("GEMINI_FLASH_BURST", "20"))),
+    },
+    max_queue_depth=int(os.environ.get("GEMINI_MAX_QUEUE_DEPTH", "32")),
+    max_retries=int(os.environ.get("GEMINI_MAX_RETRIES", "4")),
+)
+
+# Gemini context caches of the static prompt prefixes (see prompts.py); prefixes
+# a model will not cache, e.g. below its minimum token count, are sent inline.
+# Off by default: the current prefixes are all below that minimum
+CONTEXT_CACHE_ENABLED = os.environ.get("CONTEXT_CACHE_ENABLED", "0") == "1"
+context_cache = ContextCacheManager(
+    ttl_seconds=int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", "3600")),
+    refresh_margin_seconds=int(os.environ.get("CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "600")),
+) if CONTEXT_CACHE_ENABLED else None
+
+# Response cache for deterministic (temperature=0) Gemini calls
+GEMINI_CACHE_ENABLED = os.environ.get("GEMINI_CACHE_ENABLED", "1") == "1"
+gemini_cache = GeminiCache(
+    cache_dir=os.environ.get("GEMINI_CACHE_DIR", ".gemini_cache"),
+    max_bytes=int(os.environ.get("GEMINI_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    ttl_seconds=int(os.environ.get("GEMINI_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+) if GEMINI_CACHE_ENABLED else None
+
+# Per-assessment state, keyed by the X-Session-ID header in the API
+session_store = create_session_store(
+    backend=os.environ.get("SESSION_BACKEND", "memory"),
+    ttl_seconds=int(os.environ.get("SESSION_TTL_SECONDS", str(24 * 3600))),
+    data_dir=os.environ.get("SESSION_DIR", "sessions"),
+    db_path=os.environ.get("SESSION_DB_PATH"),
+)
+
+# Content-addressed store of the generated ZIPs, images and PDFs, served by the
+# API from /artifacts/{id} with the hash as ETag (see artifact_store.py)
+artifact_store = ArtifactStore(
+    root=os.environ.get("ARTIFACT_DIR", "artifacts"),
+    max_bytes=int(os.environ.get("ARTIFACT_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+    max_age_seconds=int(os.environ.get("ARTIFACT_MAX_AGE_SECONDS", str(7 * 24 * 3600))),
+)
+
+# Report images: downsample to this resolution at the printed width and re-encode
+# as JPEG of this quality (0 keeps the PNGs from the results ZIP as they are)
+REPORT_IMAGE_DPI = int(os.environ.get("REPORT_IMAGE_DPI", "0"))
+REPORT_JPEG_QUALITY = int(os.environ.get("REPORT_JPEG_QUALITY", "0"))
+
+# Rendered report pages are cached per recommendation and cold ones rendered in a
+# pool of REPORT_WORKERS processes (0 renders in a thread of this worker instead)
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "2"))
+report_pool = None
+report_fragments = FragmentCache(
+    max_bytes=int(os.environ.get("REPORT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
+
+# Set by the API per request from the X-Cache-Bypass header, skips cache reads but still refreshes entries
+cache_bypass = ContextVar("cache_bypass", default=False)
+
+# BOX_MODE=combined asks the recommendation call for each box_2d in the same
+# response instead of one bounding-box call per recommendation (two_phase)
+BOX_MODE = os.environ.get("BOX_MODE", "two_phase")
+BOX_MODES = ("two_phase", "combined")
+
+# OVERLAY_MODE=manifest sends each image once plus overlays.json with the box
+# coordinates for the app to draw, instead of a full PNG per box (png, what
+# older app builds expect)
+OVERLAY_MODE = os.environ.get("OVERLAY_MODE", "png")
+OVERLAY_MODES = ("png", "manifest")
+
+# Encoding of the images in the results: png (lossless, what older app builds
+# expect), jpeg (progressive), webp or avif; ?image_format= overrides it per
+# request. IMAGE_MAX_BYTES caps each image (0 for no cap) and every image gets
+# a THUMBNAIL_SIZE preview next to it (0 for none). The PDF report is built
+# from the image model's original output, kept in the session directory.
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", "0"))
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "320"))
+ARTIFACTS_FILENAME = "artifacts.json"
+
+# The recommendations prompt is the pack of the photographed room (see
+# prompts.py), classified by the room stage's model unless ?room= names it.
+# With ROOM_CLASSIFIER=0 rooms not named get the DEFAULT_ROOM pack instead
+ROOM_CLASSIFIER = os.environ.get("ROOM_CLASSIFIER", "1") == "1"
+DEFAULT_ROOM = os.environ.get("DEFAULT_ROOM", "bathroom")
+
+# The prompt asks for at most this many recommendations
+MAX_RECOMMENDATIONS = 3
+
+# Total attempts for a Gemini call whose reply fails schema validation
+STRUCTURED_OUTPUT_ATTEMPTS = int(os.environ.get("STRUCTURED_OUTPUT_ATTEMPTS", "3"))
+
+# Stream the recommendation reply and start on each recommendation as soon as it is complete
+STREAM_RECOMMENDATIONS = os.environ.get("STREAM_RECOMMENDATIONS", "1") == "1"
+
+# Plain dicts, GenerateContentConfig turns them into SafetySettings
+safety_settings = [
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH",
+    },
+]
+
+
+class StructuredOutputError(Exception):
+    pass
+
+
+async def call_with_prefix(model, prefix, contents, config, call):
+    """
+    Run call(contents, config) for a request that follows prefix (a
+    PromptPrefix, or None for none), with the prefix taken from its context
+    cache when there is one and sent inline otherwise.
+    """
+    if prefix is None:
+        return await call(contents, config)
+
+    if context_cache is not None:
+        cached_contents, cached_config, cache_name = await context_cache.apply(
+            get_client(), model, prefix, contents, config)
+        if cache_name is not None:
+            try:
+                return await call(cached_contents, cached_config)
+            except errors.APIError as e:
+                if e.code not in (400, 403, 404):
+                    raise
+                # The cache expired or was deleted under us
+                print(f"Context cache {cache_name} failed ({e.code}), sending the prompt inline")
+                context_cache.invalidate(model, prefix)
+    return await call(*inline_prefix(prefix, contents, config))
+
+
+async def generate_content(model, contents, config=None, purpose="other", prefix=None, cache_if=None):
+    """
+    Call Gemini through the async client and gemini_dispatcher.
+
+    With a prefix (see prompts.py) contents are the per-request rest of the
+    prompt, sent after it. Calls with temperature=0 are served from
+    gemini_cache when possible, and their replies cached unless
+    cache_if(response) is false, e.g. for replies that fail validation and
+    would otherwise be replayed on every retry. Duration and token usage are
+    recorded under model and purpose.
+    """
+    start = time.perf_counter()
+    request_contents, request_config = contents, config
+    if prefix is not None:
+        # Cache keys are made of the whole prompt, whether or not its prefix comes from a context cache
+        contents, config = inline_prefix(prefix, contents, config)
+    cache_key = None
+    if gemini_cache is not None and config is not None and config.temperature == 0:
+        cache_key = gemini_cache.make_key(model, contents, config)
+        if cache_bypass.get():
+            gemini_cache.bypasses += 1
+        else:
+            cached = await asyncio.to_thread(gemini_cache.get, cache_key)
+            if cached is not None:
+                record_gemini_call(model, purpose, time.perf_counter() - start, cached, cached=True)
+                return cached
+
+    async def call(send_contents, send_config):
+        return await gemini_dispatcher.call(model, lambda: get_client().aio.models.generate_content(
+            model=model, contents=send_contents, config=send_config))
+
+    try:
+        response = await call_with_prefix(model, prefix, request_contents, request_config, call)
+    except Exception:
+        gemini_errors.labels(model, purpose).inc()
+        raise
+    record_gemini_call(model, purpose, time.perf_counter() - start, response)
+
+    if cache_key is not None and (cache_if is None or cache_if(response)):
+        await asyncio.to_thread(gemini_cache.put, cache_key, response)
+    return response
+
+
+class StreamInterrupted(Exception):
+    """A streamed reply failed after part of it was already passed on."""
+
+
+async def stream_content(model, contents, config=None, purpose="other", prefix=None, cache_if=None):
+    """
+    Stream a Gemini reply through gemini_dispatcher, yielding its text piece by piece.
+
+    The call keeps its dispatcher slot until the reply is complete. Transient
+    errors before the first piece are retried like any call, later ones raise
+    StreamInterrupted. Complete replies with temperature=0 are cached like
+    generate_content's, a cached reply is yielded in one piece. prefix and
+    cache_if are handled as in generate_content.
+    """
+    start = time.perf_counter()
+    request_contents, request_config = contents, config
+    if prefix is not None:
+        contents, config = inline_prefix(prefix, contents, config)
+    cache_key = None
+    if gemini_cache is not None and config is not None and config.temperature == 0:
+        cache_key = gemini_cache.make_key(model, contents, config)
+        if cache_bypass.get():
+            gemini_cache.bypasses += 1
+        else:
+            cached = await asyncio.to_thread(gemini_cache.get, cache_key)
+            if cached is not None:
+                record_gemini_call(model, purpose, time.perf_counter() - start, cached, cached=True)
+                yield cached.text or ""
+                return
+
+    pieces = asyncio.Queue()
+    text = []
+    last_chunk = None
+
+    async def read_stream(send_contents, send_config):
+        nonlocal last_chunk
+        stream = await get_client().aio.models.generate_content_stream(
+            model=model, contents=send_contents, config=send_config)
+        try:
+            async for chunk in stream:
+                last_chunk = chunk
+                if chunk.text:
+                    text.append(chunk.text)
+                    pieces.put_nowait(chunk.text)
+        except errors.APIError as e:
+            if not text:
+                raise
+            # Retrying would repeat text the caller already has
+            raise StreamInterrupted(f"{model} reply broke off after {sum(map(len, text))} characters: {e}") from e
+
+    async def run():
+        try:
+            await call_with_prefix(model, prefix, request_contents, request_config,
+                                   lambda *request: gemini_dispatcher.call(model, lambda: read_stream(*request)))
+        finally:
+            pieces.put_nowait(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while (piece := await pieces.get()) is not None:
+            yield piece
+        try:
+            await task
+        except Exception:
+            gemini_errors.labels(model, purpose).inc()
+            raise
+    finally:
+        task.cancel()
+    record_gemini_call(model, purpose, time.perf_counter() - start, last_chunk)
+
+    if cache_key is not None:
+        response = types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=[types.Part(text="".join(text))]))
+        ])
+        if cache_if is None or cache_if(response):
+            await asyncio.to_thread(gemini_cache.put, cache_key, response)
+
+
+def valid_reply(schema, check=None):
+    """cache_if for replies that must validate against schema, and pass check(value) if given, to be cached."""
+    def cache_if(response):
+        try:
+            value = parse_response(response.text, schema)
+        except ValueError:
+            return False
+        return check is None or bool(check(value))
+    return cache_if
+
+
+async def generate_validated(model, contents, config, schema, purpose="other", attempts=None, prefix=None,
+                             check=None):
+    """
+    Call Gemini and validate the reply against schema (see schemas.py).
+
+    Only this call is retried when the reply does not validate, with the
+    validation error appended to the prompt, up to attempts (by default
+    STRUCTURED_OUTPUT_ATTEMPTS) attempts in total. Returns the validated value
+    as plain dicts and lists. Only replies that validate, and pass
+    check(value) if given, are cached.
+    """
+    attempts = attempts or STRUCTURED_OUTPUT_ATTEMPTS
+    attempt_contents = list(contents)
+    for attempt in range(1, attempts + 1):
+        response = await generate_content(
+            model=model, contents=attempt_contents, config=config, purpose=purpose, prefix=prefix,
+            cache_if=valid_reply(schema, check))
+        try:
+            with timed("json_parse"):
+                return parse_response(response.text, schema)
+        except ValueError as e:
+            error = " ".join(str(e).split())[:500]
+            print(f"Invalid output from {model} (attempt {attempt}/{attempts}): {error}")
+            attempt_contents = list(contents) + [
+                f"Your previous reply could not be used because it did not match the required JSON format: {error}\n"
+                "Reply again with only the JSON."
+            ]
+
+    raise StructuredOutputError(f"{model} returned invalid output after {attempts} attempts: {error}")
+
+
+async def generate_routed(stage, contents, config=None, schema=None, check=None, prefix=None, models=None):
+    """
+    Run a pipeline stage on the models of its route (see MODEL_ROUTES).
+
+    With a schema the reply is validated as in generate_validated and the
+    validated value returned, otherwise the response itself. Every model but
+    the last gets a single attempt, and a reply that fails validation, raises
+    an API error or fails check(result) moves on to the next model. The last
+    model gets the full repair budget and its reply is used as is, but only
+    cached when it passed check. prefix, by default the stage's prompt
+    prefix if it has one, is sent before contents. models replaces the
+    stage's route, e.g. to skip a model already tried.
+    """
+    models = models or MODEL_ROUTES[stage]
+    prefix = prefix or PROMPT_PREFIXES.get(stage)
+    for position, model in enumerate(models):
+        last = position == len(models) - 1
+        try:
+            if schema is None:
+                result = await generate_content(model=model, contents=contents, config=config, purpose=stage,
+                                                prefix=prefix, cache_if=check)
+            else:
+                result = await generate_validated(model=model, contents=contents, config=config,
+                                                  schema=schema, purpose=stage, attempts=None if last else 1,
+                                                  prefix=prefix, check=check)
+        except (StructuredOutputError, errors.APIError):
+            if last:
+                record_route(stage, model, "failed")
+                raise
+            outcome = "escalated_invalid"
+        else:
+            if last or check is None or check(result):
+                record_route(stage, model, "accepted")
+                return result
+            outcome = "escalated_check"
+
+        record_route(stage, model, outcome)
+        print(f"{stage}: {model} {outcome.replace('_', ' ')}, trying {models[position + 1]}")
+
+
+def plausible_box(box_2d):
+    """Confidence check for a located modification: a real area, not the whole image."""
+    y1, x1, y2, x2 = box_2d
+    area = (y2 - y1) * (x2 - x1)
+    return y2 > y1 and x2 > x1 and 1000 <= area <= 950 * 950
+
+
+def plausible_recommendation(rec):
+    # Only combined-mode recommendations carry a box_2d
+    return "box_2d" not in rec or plausible_box(rec["box_2d"])
+
+
+def plausible_recommendations(recs):
+    """Confidence check for a recommendations reply: at least one, each with a plausible box if it has one."""
+    return bool(recs) and all(map(plausible_recommendation, recs))
+
+
+def has_text(response):
+    return bool((response.text or "").strip())
+
+
+def has_image(response):
+    parts = response.candidates[0].content.parts if response.candidates else None
+    return any(part.inline_data is not None for part in parts or [])
+
+
+async def process_recommendation(rec_idx, rec, prepared, progress=None, overlay="png",
+                                 encoding=ImageEncoding(), originals_dir=None):
+    """
+    Locate and visualize a single recommendation.
+
+    If the recommendation already carries a box_2d (BOX_MODE=combined) it is
+    used as is, otherwise a separate bounding-box call locates it.
+
+    The bounding box and the edited image only depend on the recommendation
+    itself, so both Gemini calls are issued concurrently. Returns the list of
+    (filename, bytes) ZIP members for this recommendation, empty if Gemini did
+    not return a bounding box, and the box. With overlay "png" the box is
+    drawn on a copy of the image, with "manifest" it is only returned.
+    progress(stage, files=..., index=...) is called as soon as the box and the
+    edited image are ready.
+
+    Images are encoded as encoding says (see image_encoding.py). The edited
+    image as generated is also written to originals_dir, if given, for the
+    PDF report.
+    """
+    mod = rec['Modification']
+    rationale = rec['Rationale']
+    cost = rec['Cost']
+    installation = rec['Installation']
+
+    # Both prompts share their static part through a context cache (see prompts.py)
+    prompt_suffix = modification_suffix(mod)
+
+    # Call Gemini for the bounding box and the edited image at the same time
+    mod_task = asyncio.create_task(generate_routed(
+        "mod_image",
+        contents=[
+            prompt_suffix,
+            prepared.part
+        ],
+        config=types.GenerateContentConfig(
+            temperature=0,
+            response_modalities=['TEXT', 'IMAGE'],
+            safety_settings=safety_settings,
+        ),
+        check=has_image,
+    ))
+    try:
+        if "box_2d" in rec:
+            # Combined mode, the recommendation call already located the modification
+            parsed_json_bb = [{"box_2d": rec["box_2d"], "label": mod}]
+        else:
+            parsed_json_bb = await generate_routed(
+                "bounding_box",
+                contents=[
+                    prompt_suffix,
+                    prepared.part
+                ],
+                config=types.GenerateContentConfig(
+                    temperature=0,
+                    safety_settings=safety_settings,
+                    response_mime_type="application/json",
+                    response_schema=BoundingBoxList,
+                ),
+                schema=BoundingBoxList,
+                check=lambda boxes: bool(boxes) and plausible_box(boxes[0]["box_2d"]),
+            )
+    except BaseException:
+        mod_task.cancel()
+        raise
+
+    members = []
+    if not parsed_json_bb:
+        mod_task.cancel()
+        return members, None
+
+    box = parsed_json_bb[0]
+
+    if overlay == "png":
+        with timed("draw"):
+            # Copy image
+            img_copy = prepared.image.copy()
+            draw = ImageDraw.Draw(img_copy)
+
+            _, (pixels,) = normalize_boxes([box["box_2d"]], *prepared.image.size)
+            draw.rectangle([(pixels["x1"], pixels["y1"]), (pixels["x2"], pixels["y2"])],
+                           outline=OVERLAY_STYLE["color"], width=OVERLAY_STYLE["line_width"])
+
+        with timed("image_encode"):
+            members += await asyncio.to_thread(encode_members, f"bb_image_{rec_idx + 1}", img_copy, encoding)
+
+    # Create a dictionary that combines all 4 text parts
+    combined_data = {
+        "rationale": rationale,
+        "modification": mod,
+        "cost": cost,
+        "installation": installation
+    }
+    if "Frame" in rec:
+        combined_data["frame"] = rec["Frame"]
+    members.append((f"text_{rec_idx+1}.json", json.dumps(combined_data, indent=2)))
+    if progress is not None:
+        progress("box_done", files=members, index=rec_idx + 1)
+
+    # Parse the response to get the generated image
+    response_mod = await mod_task
+    for part in response_mod.candidates[0].content.parts:
+        if part.inline_data is not None:
+            handlebar_img = Image.open(BytesIO(part.inline_data.data))
+
+            with timed("image_encode"):
+                mod_members = await asyncio.to_thread(
+                    encode_members, f"mod_image_{rec_idx+1}", handlebar_img, encoding, part.inline_data.data)
+            if originals_dir is not None and mod_members[0][1] is not part.inline_data.data:
+                await asyncio.to_thread(keep_original, originals_dir, f"mod_image_{rec_idx+1}",
+                                        handlebar_img.format, part.inline_data.data)
+            members += mod_members
+            if progress is not None:
+                progress("mod_image_done", files=mod_members, index=rec_idx + 1)
+
+    return members, box
+
+
+def encode_members(name, image, encoding, source=None):
+    """(filename, bytes) ZIP members for an image and its thumbnail."""
+    encoded = encode_image(image, encoding, source=source)
+    members = [(f"{name}.{encoded.extension}", encoded.data)]
+    thumbnail = encode_thumbnail(image, encoding)
+    if thumbnail is not None:
+        members.append((f"{name}_thumb.{thumbnail.extension}", thumbnail.data))
+    return members
+
+
+def reset_originals(directory):
+    """
+    Return the originals directory next to a results ZIP, emptied: originals
+    are only kept for re-encoded images, ones left by an earlier results ZIP
+    would end up in the report of the next.
+    """
+    originals_dir = os.path.join(directory, "originals")
+    shutil.rmtree(originals_dir, ignore_errors=True)
+    return originals_dir
+
+
+def keep_original(originals_dir, name, image_format, data):
+    os.makedirs(originals_dir, exist_ok=True)
+    with open(os.path.join(originals_dir, f"{name}.{(image_format or 'png').lower()}"), "wb") as f:
+        f.write(data)
+
+
+async def classify_room(frames):
+    """
+    Return the room type shown in frames, one of ROOM_TYPES.
+
+    A single call to the room stage's (small) model with previews of the
+    frames, the general pack's room when it fails.
+    """
+    with timed("preprocess"):
+        contents = [preview_part(frame) for frame in frames]
+    try:
+        result = await generate_routed(
+            "room",
+            contents=contents,
+            config=types.GenerateContentConfig(
+                temperature=0,
+                safety_settings=safety_settings,
+                response_mime_type="application/json",
+                response_schema=RoomClassification,
+            ),
+            schema=RoomClassification,
+        )
+    except (StructuredOutputError, errors.APIError) as e:
+        print(f"Could not classify the room, using the general prompt: {e}")
+        return GENERAL_ROOM
+    return result["room"]
+
+
+async def resolve_room(session_id, frames, room=None, progress=None):
+    """
+    Pick the recommendations prompt pack: room if given, else the classified
+    room type (or DEFAULT_ROOM with ROOM_CLASSIFIER off). The room and the
+    pack's version are stored with the session.
+    """
+    if room is None:
+        room = await classify_room(frames) if ROOM_CLASSIFIER else DEFAULT_ROOM
+    pack = recommendation_pack(room)
+    print(f"Room: {room}, using prompt pack {pack.name} ({pack.version})")
+    session_store.update(session_id, room=room, prompt_pack={"name": pack.name, "version": pack.version})
+    if progress is not None:
+        progress("room_classified", room=room, prompt_pack=pack.name, version=pack.version)
+    return room
+
+
+def recommendation_request(frames, problems_text, box_mode=None, room=None):
+    """
+    Build the recommendation call, returns (contents, config, schema, prefix).
+
+    frames is a list of PreparedImage, one for a photo or several keyframes of
+    a video walkthrough; with several frames each recommendation names the
+    Frame it is about. With box_mode "combined" each recommendation also
+    carries its box_2d, requested through a response schema in the same call.
+    prefix is the prompt pack of room, sent before contents.
+    """
+    box_mode = box_mode or BOX_MODE
+    if len(frames) > 1:
+        schema = LocatedFrameRecommendationList if box_mode == "combined" else FrameRecommendationList
+        image_contents = []
+        for frame_idx, frame in enumerate(frames):
+            image_contents += [f"Frame {frame_idx + 1}:", frame.part]
+    else:
+        schema = LocatedRecommendationList if box_mode == "combined" else RecommendationList
+        image_contents = [frames[0].part]
+    # The rubric is the room's cached prompt pack, only the resident's problems vary
+    prompt_recs = recommendations_suffix(problems_text, frames=len(frames) > 1, combined=box_mode == "combined")
+
+    config = types.GenerateContentConfig(
+        temperature=0,
+        safety_settings=safety_settings,
+        response_mime_type="application/json",
+        response_schema=schema,
+    )
+    return [prompt_recs] + image_contents, config, schema, recommendation_pack(room)
+
+
+def store_recommendations(session_id, recs, progress=None):
+    print("Called Gemini, parsed_recs:", recs)
+    session_store.update(session_id, recommendations=recs)
+    if progress is not None:
+        progress("recommendations_parsed", count=len(recs))
+
+
+async def get_recommendations(session_id, frames, problems_text, box_mode=None, progress=None, room=None,
+                              models=None):
+    """
+    Ask Gemini for up to three recommendations and store them with the session.
+
+    See recommendation_request for the arguments, room is classified first
+    when not given (see resolve_room). progress, if given, is called once the
+    room is known and once the recommendations are parsed. models, by
+    default the recommendations route, are tried as in generate_routed.
+    """
+    if room is None:
+        room = await resolve_room(session_id, frames, progress=progress)
+    contents, config, schema, prefix = recommendation_request(frames, problems_text, box_mode, room)
+
+    print("Parsed image, calling Gemini")
+    # Call Gemini, the reply is validated against the schema
+    parsed_json_recs = await generate_routed(
+        "recommendations",
+        contents=contents,
+        config=config,
+        schema=schema,
+        check=plausible_recommendations,
+        prefix=prefix,
+        models=models,
+    )
+    parsed_json_recs = parsed_json_recs[:MAX_RECOMMENDATIONS]
+    store_recommendations(session_id, parsed_json_recs, progress)
+    return parsed_json_recs
+
+
+async def stream_recommendations(session_id, frames, problems_text, box_mode=None, progress=None, room=None):
+    """
+    Yield the recommendations one by one, each as soon as its JSON object has
+    streamed in, so locating and visualizing it can start while Gemini is
+    still writing the next one. They are stored with the session once the
+    reply is complete.
+
+    Streams from the first model of the recommendations route. Invalid
+    objects, and ones whose box_2d fails plausible_box, are skipped; when the
+    reply holds no valid recommendation at all this falls back to
+    get_recommendations with the rest of the route, with its model cascade
+    and repair attempts. With STREAM_RECOMMENDATIONS off it is
+    get_recommendations with the whole route. room is resolved first as in
+    get_recommendations.
+    """
+    room = await resolve_room(session_id, frames, room, progress)
+    if not STREAM_RECOMMENDATIONS:
+        for rec in await get_recommendations(session_id, frames, problems_text, box_mode, progress, room):
+            yield rec
+        return
+
+    contents, config, schema, prefix = recommendation_request(frames, problems_text, box_mode, room)
+    model = MODEL_ROUTES["recommendations"][0]
+    parser = JsonArrayStream()
+    reply = []
+    recs = []
+
+    print("Parsed image, streaming recommendations from Gemini")
+    try:
+        async for piece in stream_content(model, contents, config, purpose="recommendations", prefix=prefix,
+                                          cache_if=valid_reply(schema, plausible_recommendations)):
+            reply.append(piece)
+            for value in parser.feed(piece):
+                if len(recs) == MAX_RECOMMENDATIONS:
+                    continue
+                try:
+                    if value is JsonArrayStream.INVALID:
+                        raise ValueError("not valid JSON")
+                    rec = parse_item(value, schema)
+                    if not plausible_recommendation(rec):
+                        raise ValueError(f"implausible box_2d {rec['box_2d']}")
+                except ValueError as e:
+                    print(f"Skipping invalid recommendation from {model}: {' '.join(str(e).split())[:500]}")
+                    continue
+                recs.append(rec)
+                yield rec
+    except StreamInterrupted as e:
+        if not recs:
+            raise
+        # Keep what already streamed in, later recommendations are dropped
+        print(e)
+
+    if not recs and not parser.done:
+        # Not a JSON array after all, e.g. a lone object
+        try:
+            with timed("json_parse"):
+                recs = [rec for rec in parse_response("".join(reply), schema)
+                        if plausible_recommendation(rec)][:MAX_RECOMMENDATIONS]
+        except ValueError:
+            pass
+        for rec in recs:
+            yield rec
+
+    if not recs:
+        record_route("recommendations", model, "stream_fallback")
+        # The next models of the route, or the same one with its repair attempts if it is the only one
+        fallback = MODEL_ROUTES["recommendations"][1:] or [model]
+        print(f"No valid recommendation streamed from {model}, retrying without streaming on {', '.join(fallback)}")
+        for rec in await get_recommendations(session_id, frames, problems_text, box_mode, progress, room,
+                                             fallback):
+            yield rec
+        return
+
+    record_route("recommendations", model, "accepted")
+    store_recommendations(session_id, recs, progress)
+
+
+async def iter_result_members(recs, frames, progress=None, overlay="png",
+                              encoding=ImageEncoding(), originals_dir=None):
+    """
+    Process the recommendations of the async iterable recs concurrently, each
+    starting as soon as it arrives, and yield their (filename, bytes) ZIP
+    members in rec_idx order, each recommendation as soon as it and all
+    earlier ones are done. Each recommendation is drawn on the frame it names.
+
+    With overlay "manifest" each frame that has a box is sent once as
+    image_<frame>.jpg and the boxes follow in overlays.json at the end.
+    encoding and originals_dir are passed on to process_recommendation.
+    """
+    tasks = []
+    started = asyncio.Queue()
+
+    async def start_tasks():
+        try:
+            rec_idx = 0
+            async for rec in recs:
+                print(f"Locating and visualizing recommendation {rec_idx + 1}")
+                frame = min(rec.get("Frame", 1), len(frames))
+                task = asyncio.create_task(process_recommendation(
+                    rec_idx, rec, frames[frame - 1], progress, overlay, encoding, originals_dir))
+                tasks.append(task)
+                started.put_nowait((rec_idx, frame, task))
+                rec_idx += 1
+        finally:
+            started.put_nowait(None)
+
+    located = []
+    sizes = {}
+    thumbnails = {}
+    producer = asyncio.create_task(start_tasks())
+    try:
+        while (item := await started.get()) is not None:
+            rec_idx, frame, task = item
+            members, box = await task
+            if overlay == "manifest" and box is not None:
+                if frame not in sizes:
+                    # The JPEG already sent to Gemini, nothing is re-encoded
+                    sizes[frame] = frames[frame - 1].image.size
+                    image_members = [(image_filename(frame), frames[frame - 1].jpeg_bytes)]
+                    with timed("image_encode"):
+                        thumbnail = await asyncio.to_thread(encode_thumbnail, frames[frame - 1].image, encoding)
+                    if thumbnail is not None:
+                        thumbnails[frame] = thumbnail_filename(frame, thumbnail.extension)
+                        image_members.append((thumbnails[frame], thumbnail.data))
+                    if progress is not None:
+                        progress("image_ready", files=image_members, frame=frame)
+                    for member in image_members:
+                        yield member
+                located.append((rec_idx, frame, box))
+            for member in members:
+                yield member
+        # Raises if the recommendation call failed
+        await producer
+
+        if overlay == "manifest":
+            manifest_member = (MANIFEST_FILENAME, build_manifest(located, sizes, thumbnails))
+            if progress is not None:
+                progress("overlays_ready", files=[manifest_member])
+            yield manifest_member
+    finally:
+        # The client went away or a call failed, stop the remaining work
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def with_artifact_hashes(members, progress=None):
+    """
+    Pass members through and add artifacts.json with the SHA-256, size and
+    type of each. Images are also put in the artifact store, their entries
+    carry the URL to fetch them by hash.
+    """
+    artifacts = {}
+    async for filename, data in members:
+        content = data.encode() if isinstance(data, str) else data
+        artifacts[filename] = {
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "bytes": len(content),
+            "content_type": content_type(filename),
+        }
+        if artifacts[filename]["content_type"].startswith("image/"):
+            artifact_id = await asyncio.to_thread(
+                artifact_store.put_bytes, content, os.path.splitext(filename)[1][1:].lower())
+            artifacts[filename]["url"] = f"/artifacts/{artifact_id}"
+        yield filename, data
+
+    member = (ARTIFACTS_FILENAME, json.dumps(artifacts, indent=2))
+    if progress is not None:
+        progress("artifacts_ready", files=[member])
+    yield member
+
+
+def check_analysis_options(box_mode, overlay, image_format, room=None):
+    """Raise ValueError for an option that is given but not one of its choices."""
+    if box_mode is not None and box_mode not in BOX_MODES:
+        raise ValueError(f"box_mode must be one of {', '.join(BOX_MODES)}")
+    if overlay is not None and overlay not in OVERLAY_MODES:
+        raise ValueError(f"overlay must be one of {', '.join(OVERLAY_MODES)}")
+    if image_format is not None and image_format not in IMAGE_FORMATS:
+        raise ValueError(f"image_format must be one of {', '.join(IMAGE_FORMATS)}")
+    if room is not None and room not in ROOM_TYPES:
+        raise ValueError(f"room must be one of {', '.join(ROOM_TYPES)}")
+
+
+def report_fragment_key(zip_path, idx):
+    """Identify a recommendation's rendered pages by its results ZIP version, index and image settings."""
+    stat = os.stat(zip_path)
+    key = f"{zip_path}:{stat.st_mtime_ns}:{stat.st_size}:{idx}:{REPORT_IMAGE_DPI}:{REPORT_JPEG_QUALITY}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def read_report_image(zip_ref, originals_dir, idx):
+    """
+    The edited image of recommendation idx: the image model's original output
+    when it was kept, otherwise the ZIP member in whatever format it was sent.
+    """
+    name = f"mod_image_{idx}"
+    if os.path.isdir(originals_dir):
+        for filename in os.listdir(originals_dir):
+            if os.path.splitext(filename)[0] == name:
+                with open(os.path.join(originals_dir, filename), "rb") as f:
+                    return f.read()
+    for filename in zip_ref.namelist():
+        if os.path.splitext(filename)[0] == name:
+            return zip_ref.read(filename)
+    raise KeyError(name)
+
+
+def read_report_members(zip_path, index_list):
+    """Return {idx: (image bytes, text data)} for the recommendations found in the ZIP."""
+    members = {}
+    originals_dir = os.path.join(os.path.dirname(zip_path), "originals")
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for idx in index_list:
+            text_filename = f"text_{idx}.json"
+
+            try:
+                image_bytes = read_report_image(zip_ref, originals_dir, idx)
+            except KeyError:
+                print(f"Image file mod_image_{idx} not found in ZIP!")
+                continue
+
+            try:
+                with zip_ref.open(text_filename) as text_file:
+                    text_data = json.load(text_file)
+            except KeyError:
+                print(f"Text file {text_filename} not found in ZIP!")
+                text_data = {}
+
+            members[idx] = (image_bytes, text_data)
+    return members
+
+
+def get_report_pool():
+    global report_pool
+    if report_pool is None:
+        # Spawned rather than forked so workers do not inherit the server's sockets and event loop
+        report_pool = ProcessPoolExecutor(
+            max_workers=REPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return report_pool
+
+
+def shutdown_report_pool():
+    # Otherwise the pool's worker processes outlive this one
+    if report_pool is not None:
+        report_pool.shutdown(cancel_futures=True)
+
+
+def replace_report_pool(broken):
+    global report_pool
+    # Concurrent renders all see the same broken pool, only the first replaces it
+    if report_pool is broken:
+        print("Report pool broken, starting a new one")
+        report_pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_in_pool(func, *args):
+    # PIL/FPDF work is CPU-bound, run it in the process pool (or a thread with REPORT_WORKERS=0)
+    if REPORT_WORKERS == 0:
+        return await asyncio.to_thread(func, *args)
+    loop = asyncio.get_running_loop()
+    pool = get_report_pool()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory), which breaks the whole pool: retry once in a new one
+        replace_report_pool(pool)
+        return await loop.run_in_executor(get_report_pool(), func, *args)
+
+
+async def build_report(zip_path, index_list):
+    """
+    Build the PDF for the chosen recommendations from cached page fragments.
+
+    Only recommendations (and the cover page) not rendered before are read
+    from the results ZIP and rendered, concurrently in the process pool.
+    """
+    # fpdf is only loaded once a report is asked for (or by the warm-up)
+    from pdf_report import assemble_report, render_cover_page, render_recommendation_pages
+
+    cover_key = f"cover:{datetime.date.today().isoformat()}"
+    keys = {idx: report_fragment_key(zip_path, idx) for idx in dict.fromkeys(index_list)}
+    fragments = {key: report_fragments.get(key) for key in [cover_key, *keys.values()]}
+    cached = sum(1 for fragment in fragments.values() if fragment is not None)
+
+    cold = [idx for idx, key in keys.items() if fragments[key] is None]
+    members = await asyncio.to_thread(read_report_members, zip_path, cold) if cold else {}
+
+    async def render(key, func, *args):
+        fragments[key] = await render_in_pool(func, *args)
+        report_fragments.put(key, fragments[key])
+
+    renders = [
+        render(keys[idx], render_recommendation_pages, image_bytes, text_data,
+               int(keys[idx][:8], 16), REPORT_IMAGE_DPI, REPORT_JPEG_QUALITY)
+        for idx, (image_bytes, text_data) in members.items()
+    ]
+    if fragments[cover_key] is None:
+        renders.append(render(cover_key, render_cover_page))
+    await asyncio.gather(*renders)
+    print(f"Report: rendered {len(renders)} fragments, {cached} from cache, "
+          f"{len(cold) - len(members)} missing from the ZIP")
+
+    ordered = [fragments[cover_key]] + [fragments[keys[idx]] for idx in index_list
+                                        if fragments[keys[idx]] is not None]
+    return await asyncio.to_thread(assemble_report, ordered)
+
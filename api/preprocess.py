@@ -0,0 +1,70 @@
+import io
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+from lazy_imports import LazyModule
+from perceptual_hash import dhash
+
+types = LazyModule("google.genai.types")
+
+# Longest side of the image sent to Gemini and drawn on
+MAX_IMAGE_SIZE = 1024
+
+# Longest side of the previews sent for quick questions such as the room type,
+# Gemini bills an image this small as a single tile
+PREVIEW_SIZE = 384
+
+
+@dataclass
+class PreparedImage:
+    """An uploaded photo decoded once and encoded once for every Gemini call."""
+    image: Image.Image
+    jpeg_bytes: bytes
+    part: "types.Part"
+    # dHash of the image, used to find earlier assessments of the same room
+    phash: int
+
+
+def prepare_image(contents, max_size=MAX_IMAGE_SIZE):
+    """
+    Decode, orient and downscale an uploaded photo, then encode the model input.
+
+    For JPEGs the decoder is put in draft mode first, so a 12 MP phone photo is
+    decoded at a reduced scale (still at least max_size) instead of at full
+    resolution. EXIF orientation is applied so the boxes Gemini returns match
+    the image we draw on.
+    """
+    image = Image.open(io.BytesIO(contents))
+    if image.format == "JPEG":
+        image.draft("RGB", (max_size, max_size))
+
+    image = ImageOps.exif_transpose(image)
+    return prepare_frame(image, max_size)
+
+
+def prepare_frame(image, max_size=MAX_IMAGE_SIZE):
+    """Downscale an already decoded image (a photo or a video frame) and encode it once."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail([max_size, max_size], Image.Resampling.LANCZOS)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG")
+    jpeg_bytes = buffered.getvalue()
+
+    return PreparedImage(
+        image=image,
+        jpeg_bytes=jpeg_bytes,
+        part=types.Part.from_bytes(data=jpeg_bytes, mime_type="image/jpeg"),
+        phash=dhash(image),
+    )
+
+
+def preview_part(prepared, max_size=PREVIEW_SIZE):
+    """Encode a small JPEG of a prepared image for cheap model calls."""
+    image = prepared.image.copy()
+    image.thumbnail([max_size, max_size], Image.Resampling.LANCZOS)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=80)
+    return types.Part.from_bytes(data=buffered.getvalue(), mime_type="image/jpeg")
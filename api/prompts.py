@@ -0,0 +1,194 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    """
+    The static start of a prompt, the same for every request of a pipeline
+    stage (or, for recommendations, of a room type).
+
+    Requests send it first, before their own suffix (health problems,
+    modification, images), so it can be served from a Gemini context cache
+    (see context_cache.py). Its version changes with its text, which is what
+    retires caches of an older prompt.
+    """
+    name: str
+    text: str
+    system_instruction: Optional[str] = None
+
+    @property
+    def version(self):
+        digest = hashlib.sha256(self.text.encode())
+        digest.update((self.system_instruction or "").encode())
+        return digest.hexdigest()[:12]
+
+
+RECOMMENDATIONS_ROLE = """
+            Role: You are an occupational therapist / interior designer specialized in accessible home design, guided by ADA principles adapted for residential settings.
+            Task: Analyze the provided images of the house interior. Based on Americans with Disabilities Act (ADA) guidelines and best practices for aging-in-place, fall prevention, and universal design, identify potential hazards and suggest specific, actionable modifications to improve safety, accessibility, and ease of use for this resident.
+            Analyze these aspects within the image and provide suggestions:"""
+
+RECOMMENDATIONS_OUTPUT = """
+            Output Format: Please provide multiple suggestions as a clear, prioritized list. Store each suggestion as a separate JSON object (maximum 3). For each suggestion:
+            Clearly state the recommended modification, specific enough for an architect to know where on the image they should draw the changes. (Modification)
+            Explain why it's important for someone with mobility/balance issues, referencing ADA principles or fall prevention where applicable. (Rationale)
+            Estimate the cost of such an implementation in terms of the number of dollar signs. (Cost)
+            Briefly speaking, how will the installation process look like. (Installation)
+"""
+
+# Room -> the aspects its recommendations look at, only the pack of the
+# photographed room is sent (see classify_room in pipeline.py)
+ROOM_ASPECTS = {
+    "bathroom": """
+            Toilet Area:
+                Analyze: Current toilet height (estimate standard vs. comfort height), clear floor space surrounding it (for transfers from walker/wheelchair), presence and placement of any existing grab bars, accessibility of toilet paper holder.
+                Suggest: Installing a taller "comfort height" toilet or raised seat, ensuring adequate clear transfer space, installing appropriately placed grab bars (specify locations like rear wall, side wall – consider types like straight, L-shaped), relocating toilet paper holder for easier reach.
+            Sink & Vanity Area:
+                Analyze: Sink/counter height, clear knee space underneath (for potential seated use), faucet control type (knobs, single lever, etc.), mirror height and visibility (standing/seated), reachability of soap/towels, general counter clutter.
+                Suggest: Modifying vanity for knee space, installing lever-handle or touchless faucets (easier operation), lowering/tilting mirror, ensuring essential items are within easy reach without leaning/stretching, organizing storage.
+            Bathing Area (Shower and/or Tub):
+                Analyze: Method of entry (step-over tub wall, shower curb height), presence and location of grab bars, availability and type of seating (built-in/portable), shower controls (reachability from seated/standing, ease of use, anti-scald features?), shower head type (fixed/handheld, adjustable height?), slip resistance of the floor surface inside.
+                Suggest: Creating a curbless/zero-entry shower, installing a tub cut-out or transfer bench for tub access, adding strategically placed grab bars (vertical at entry, horizontal/angled inside), installing a secure fold-down or fixed shower seat, ensuring easy-to-operate controls with clear temperature markings, installing a handheld shower head on an adjustable slide bar, applying non-slip treatments or ensuring high-traction surfaces.
+            Flooring:
+                Analyze: Main bathroom floor material type, perceived slip resistance (especially when potentially wet), presence and type of any mats or rugs (potential trip hazards).
+                Suggest: Installing high-traction, non-slip flooring (e.g., matte finish tiles with appropriate COF rating, textured vinyl), removing loose rugs entirely, or using only securely adhered, low-profile, non-slip mats if absolutely necessary. Emphasize non-slip surfaces throughout.""",
+    "bedroom": """
+            Bed Area:
+                Analyze: Bed height relative to the resident's knees, firmness of the edge for sitting, clear floor space on the exit side (for a walker/wheelchair), anything to hold on to when standing up.
+                Suggest: Raising or lowering the bed to knee height, adding a bed rail or floor-to-ceiling transfer pole, clearing a 36-inch path on the exit side.
+            Night Path & Lighting:
+                Analyze: Route from the bed to the door or bathroom, reachability of light switches from the bed, trip hazards along the way (cords, rugs, clutter).
+                Suggest: Motion-sensor night lights along the path, a bedside lamp or switch within reach, removing rugs and securing cords.
+            Storage & Dressing:
+                Analyze: Closet rod and shelf heights, drawer handles, a place to sit while dressing.
+                Suggest: Lowering closet rods, D-shaped drawer pulls, a sturdy chair with armrests for dressing.""",
+    "kitchen": """
+            Counters & Work Areas:
+                Analyze: Counter height, a place to work seated, clear floor space in front of sink, cooktop and fridge, reach to frequently used items.
+                Suggest: A lowered or pull-out work surface with knee space, moving daily items between hip and shoulder height, clearing a turning space.
+            Appliances & Controls:
+                Analyze: Cooktop control location (front vs. rear), oven door type and height, microwave height, faucet type.
+                Suggest: Front-mounted cooktop controls, a wall oven or side-opening door at counter height, a microwave drawer, a lever or touchless faucet.
+            Storage & Flooring:
+                Analyze: Deep lower cabinets, high shelves that need a step stool, floor material and mats near the sink.
+                Suggest: Pull-out shelves and drawers instead of deep cabinets, eliminating step-stool storage, non-slip flooring and removing loose mats.""",
+    "stairs": """
+            Handrails:
+                Analyze: Handrails on one or both sides, continuity from top to bottom, graspable profile and height, extension past the top and bottom steps.
+                Suggest: Continuous handrails on both sides at 34-38 inches, a round 1.25-2 inch graspable profile, 12-inch extensions at the top and bottom.
+            Treads & Risers:
+                Analyze: Tread depth and riser height consistency, nosing visibility, slip resistance, loose carpet or runners.
+                Suggest: High-contrast non-slip nosing strips, securing or removing runners, repairing uneven steps.
+            Lighting & Alternatives:
+                Analyze: Lighting at the top and bottom, switches at both ends, whether the resident should avoid the stairs entirely.
+                Suggest: Three-way switches or motion lighting at both ends, a stair lift, or moving daily living to one floor.""",
+    "entrance": """
+            Approach & Threshold:
+                Analyze: Steps up to the door, threshold height, landing size on both sides of the door, path surface to the door.
+                Suggest: A ramp with 1:12 slope or a sloped walkway, a beveled low-profile threshold, a level 5x5 foot landing, even non-slip paving.
+            Door:
+                Analyze: Door clear width (for walker/wheelchair), handle type, force needed to open, a place to set things down while unlocking.
+                Suggest: Widening to 32-36 inches or offset hinges, lever handles or a keyless lock, an automatic or lightweight door closer, a shelf or bench beside the door.
+            Lighting & Support:
+                Analyze: Outdoor lighting, house number and lock visibility, rails along steps or the ramp.
+                Suggest: Motion-activated lighting, handrails on both sides of steps or the ramp, a grab bar beside the door.""",
+    "living_area": """
+            Seating & Transfers:
+                Analyze: Seat height and depth of chairs and sofas, armrests to push up from, clear space in front of seating.
+                Suggest: Firm seating at 18-20 inch height with armrests, furniture risers, a lift chair if needed.
+            Pathways & Flooring:
+                Analyze: Clear width of walking paths, rugs, cords, low furniture and clutter in the way, changes in floor level.
+                Suggest: 36-inch clear paths, removing or taping down rugs, rerouting cords, marking or ramping level changes.
+            Lighting & Controls:
+                Analyze: Light levels, glare, switch and outlet heights, reach to windows and blinds.
+                Suggest: Brighter even lighting, rocker switches at the entry, raised outlets, motorized or wand-operated blinds.""",
+    "other": """
+            Pathways & Flooring:
+                Analyze: Clear width of walking paths, floor material and slip resistance, rugs, cords, clutter and changes in floor level.
+                Suggest: 36-inch clear paths, non-slip flooring, removing loose rugs and cords, marking or ramping level changes.
+            Support & Reach:
+                Analyze: Places where the resident needs to stand up, turn or step without anything to hold on to, reach to frequently used items and controls.
+                Suggest: Grab bars or sturdy rails where support is needed, moving items and controls between hip and shoulder height, lever handles.
+            Lighting:
+                Analyze: Light levels, dark corners, switches reachable at room entrances.
+                Suggest: Brighter even lighting, motion-sensor lights, switches at every entrance.""",
+}
+
+# Room type -> its recommendations prompt pack, each a versioned prefix of its own
+RECOMMENDATION_PACKS = {
+    room: PromptPrefix(f"recommendations_{room}", RECOMMENDATIONS_ROLE + aspects + RECOMMENDATIONS_OUTPUT)
+    for room, aspects in ROOM_ASPECTS.items()
+}
+
+# Rooms without a pack of their own use this one
+GENERAL_ROOM = "other"
+
+
+def recommendation_pack(room):
+    """The recommendations prompt pack for a room type, the general one for unknown rooms."""
+    return RECOMMENDATION_PACKS.get(room, RECOMMENDATION_PACKS[GENERAL_ROOM])
+
+
+ROOM_PREFIX = PromptPrefix("room", f"""
+    Task: Classify the room shown in the image(s) of a home as one of: {", ".join(ROOM_ASPECTS)}.
+    Use stairs for staircases and landings, entrance for front or back doors, porches and hallways to them,
+    living_area for living, dining and family rooms, and other for anything else.
+""")
+
+
+frame_prompt = """
+            Frames: The images are keyframes of a video walkthrough of the same home, labelled Frame 1, Frame 2, ... For each suggestion also return the number of the frame that shows the area to modify best as Frame.
+"""
+
+combined_box_prompt = """
+            Location: For each suggestion also return the area of the image where the modification should be placed as box_2d, a bounding box [ymin, xmin, ymax, xmax] with coordinates normalized to 0-1000.
+"""
+
+
+def recommendations_suffix(problems_text, frames=False, combined=False):
+    """The per-request end of the recommendations prompt, the images follow it."""
+    prompt = f"""
+            Context: The resident of this home is an elderly individual experiencing significant challenges with physical mobility: {problems_text}. This increases their risk of falls.
+"""
+    if frames:
+        prompt += frame_prompt
+    if combined:
+        prompt += combined_box_prompt
+    return prompt
+
+
+BOUNDING_BOX_PREFIX = PromptPrefix("bounding_box", """
+    Role: Act as an OT/Interior Designer specializing in accessible home modifications for seniors with significant mobility/balance issues and fall risk, using adapted ADA principles.
+    Task: Edit the input image(s) to realistically WHERE the accessibility modifications defined in the Modification JSON object should be placed
+    Output Requirements: coordinates for 1 bounding box
+""", system_instruction="""
+    Return bounding boxes as a JSON array with labels.
+""")
+
+MOD_IMAGE_PREFIX = PromptPrefix("mod_image", """
+    Role: Act as an OT/Interior Designer specializing in accessible home modifications for seniors with significant mobility/balance issues and fall risk, using adapted ADA principles.
+    Task: Edit the input image to realistically visualize the accessibility modifications defined in the Modification JSON object.
+    Output Requirements:
+    Generate photorealistic edited image.
+    Modifications must be seamlessly integrated (lighting, perspective).
+    Accurately reflect JSON specifications (type, location, details).
+    Ensure visualized changes are contextually appropriate for accessibility needs.
+""")
+
+
+def modification_suffix(mod):
+    """The per-request end of the bounding-box and image-edit prompts."""
+    return f"""
+    "Modification": {mod}
+    """
+
+
+# Pipeline stage (see MODEL_ROUTES in pipeline.py) -> its prompt prefix, the
+# recommendations stage picks one of RECOMMENDATION_PACKS per request
+PROMPT_PREFIXES = {
+    "room": ROOM_PREFIX,
+    "bounding_box": BOUNDING_BOX_PREFIX,
+    "mod_image": MOD_IMAGE_PREFIX,
+}
@@ -0,0 +1,183 @@
+import json
+import re
+from enum import Enum
+from typing import Annotated, List, Optional, get_args
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+
+# Normalized 0-1000 coordinate, as returned by Gemini
+Coordinate = Annotated[int, Field(ge=0, le=1000)]
+Box2D = Annotated[List[Coordinate], Field(min_length=4, max_length=4)]
+
+
+class Recommendation(BaseModel):
+    Modification: str
+    Rationale: str
+    Cost: str
+    Installation: str
+
+
+class LocatedRecommendation(Recommendation):
+    """A recommendation that also carries where it goes in the image."""
+    box_2d: Box2D
+
+
+class FrameRecommendation(Recommendation):
+    """A recommendation for a video walkthrough, pointing at the keyframe it is about."""
+    Frame: int = Field(ge=1)
+
+
+class LocatedFrameRecommendation(LocatedRecommendation):
+    Frame: int = Field(ge=1)
+
+
+# Rooms with a recommendations prompt pack of their own (see prompts.py), other for the rest
+ROOM_TYPES = ("bathroom", "bedroom", "kitchen", "stairs", "entrance", "living_area", "other")
+RoomType = Enum("RoomType", {room: room for room in ROOM_TYPES}, type=str)
+
+
+class RoomClassification(BaseModel):
+    model_config = ConfigDict(use_enum_values=True)
+
+    room: RoomType
+
+
+class BoundingBox(BaseModel):
+    box_2d: Box2D
+    label: Optional[str] = None
+
+
+# Top-level response schemas, plain lists since Gemini rejects constrained ones
+RecommendationList = list[Recommendation]
+LocatedRecommendationList = list[LocatedRecommendation]
+FrameRecommendationList = list[FrameRecommendation]
+LocatedFrameRecommendationList = list[LocatedFrameRecommendation]
+BoundingBoxList = list[BoundingBox]
+
+_FENCE = re.compile(r"```(?:json)?\s*\n(.*?)```", re.DOTALL)
+
+
+def extract_json(text: str):
+    """
+    Pull the first JSON value out of a model response.
+
+    Handles plain JSON, ```json fenced blocks and JSON surrounded by prose.
+    Raises ValueError if no JSON value can be found.
+    """
+    if text is None:
+        raise ValueError("Empty response")
+
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    # Fall back to the first array or object that decodes cleanly
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"[\[{]", text):
+        try:
+            value, _ = decoder.raw_decode(text, match.start())
+            return value
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("No JSON found in response")
+
+
+def parse_response(text: str, schema):
+    """
+    Extract and validate a model response against schema (a type such as
+    RecommendationList). Returns plain dicts/lists so callers can keep indexing
+    by key. Raises ValueError (pydantic's ValidationError included) on failure.
+    """
+    value = extract_json(text)
+
+    # A lone object where a list was asked for is a common legacy output
+    adapter = TypeAdapter(schema)
+    if isinstance(value, dict) and adapter.json_schema().get("type") == "array":
+        value = [value]
+
+    validated = adapter.validate_python(value)
+    return adapter.dump_python(validated, exclude_none=True)
+
+
+
+def parse_item(value, schema):
+    """
+    Validate one decoded element of a list schema such as RecommendationList,
+    for replies parsed while they stream in. Returns a plain dict, raises
+    ValueError like parse_response.
+    """
+    adapter = TypeAdapter(get_args(schema)[0])
+    return adapter.dump_python(adapter.validate_python(value), exclude_none=True)
+
+
+class JsonArrayStream:
+    """
+    Incremental parser for a JSON array that arrives in pieces.
+
+    feed() takes the next piece of text and returns the decoded elements of
+    the top-level array that it completes. Text before the opening bracket
+    (a ```json fence, prose) and after the closing one is ignored. Elements
+    that do not decode are returned as JsonArrayStream.INVALID.
+    """
+
+    INVALID = object()
+
+    def __init__(self):
+        self.depth = 0  # 0 before the array, 1 between elements, more inside one
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+        self._element = []
+
+    def _finish_element(self):
+        text = "".join(self._element).strip()
+        self._element = []
+        if not text:
+            return []
+        try:
+            return [json.loads(text)]
+        except json.JSONDecodeError:
+            return [self.INVALID]
+
+    def feed(self, text):
+        elements = []
+        for char in text:
+            if self.done:
+                break
+            if self.depth == 0:
+                if char == "[":
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                self._element.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if self.depth == 1 and char in ",]":
+                # End of a scalar element, objects and arrays are finished on their closing bracket
+                elements += self._finish_element()
+                self.done = char == "]"
+                continue
+
+            self._element.append(char)
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.depth == 1:
+                    elements += self._finish_element()
+        return elements
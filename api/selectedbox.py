@@ -1,51 +1,32 @@
-from google import genai
-from google.genai import types
+"""
+Ask Gemini to draw a grab bar inside one of the boxes found by boundingboxes.py.
+
+    python selectedbox.py images/caleb.jpg caleb.json --box 2
+"""
+import argparse
 from pathlib import Path
-import IPython
 import json
-import random
-from PIL import Image, ImageDraw, ImageFont
-from PIL import ImageColor
-
-import io
 import os
-import requests
-from io import BytesIO
-from config import GEMINI_API_KEY
+from PIL import Image
 
-client = genai.Client(api_key=GEMINI_API_KEY)
+from io import BytesIO
 
 # Model
 MODEL_ID = "gemini-2.0-flash-exp-image-generation"
 
-# Create a path object
+# Default photo and boxes
 IMG_PATH = Path("images") / "caleb.jpg"
 JSON_PATH = Path("caleb.json")
 
-# Open json
-with open(JSON_PATH, 'r', encoding='utf-8') as f:
-    json_output = json.load(f)
-# Read first box
-selected_box = json_output[2]
-print(selected_box)
-
-# Load and resize image
-img = Image.open(IMG_PATH)
-im = img.resize((800, int(800 * img.size[1] / img.size[0])), Image.Resampling.LANCZOS) # Resizing to speed-up rendering
-
-# # Load and resize image
-# im = Image.open(BytesIO(open(IMG_PATH, "rb").read()))
-# im.thumbnail([1024,1024], Image.Resampling.LANCZOS)
-
 safety_settings = [
-    types.SafetySetting(
-        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-        threshold="BLOCK_ONLY_HIGH",
-    ),
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH",
+    },
 ]
 
-prompt = f"""
-You are given an image of a bathroom and a bounding box: {selected_box["box_2d"]}.
+PROMPT = """
+You are given an image of a bathroom and a bounding box: {box_2d}.
 Inside this bounding box, draw a single grab bar suitable for elderly support, oriented horizontally or vertically depending on the shape of the box.
 Do not modify anything outside of the bounding box. Keep the original image intact except for the grab bar.
 Return only the modified image.
@@ -56,21 +37,50 @@ Given the input image:
 """
 
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", default=str(IMG_PATH), help="bathroom photo")
+    parser.add_argument("boxes", nargs="?", default=str(JSON_PATH), help="JSON boxes from boundingboxes.py")
+    parser.add_argument("--box", type=int, default=2, help="index of the box to draw the grab bar in")
+    args = parser.parse_args()
+
+    # Imported here so importing this module stays cheap
+    from google import genai
+    from google.genai import types
+    try:
+        from config import GEMINI_API_KEY
+    except ImportError:
+        GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+    client = genai.Client(api_key=GEMINI_API_KEY)
+
+    # Open json
+    with open(args.boxes, 'r', encoding='utf-8') as f:
+        json_output = json.load(f)
+    selected_box = json_output[args.box]
+    print(selected_box)
 
-# Run model to find bounding boxes
-response = client.models.generate_content(
-    model=MODEL_ID,
-    contents=[prompt, im],
-    config = types.GenerateContentConfig(
-        response_modalities=['TEXT', 'IMAGE'],
-        temperature=0.5,
-        safety_settings=safety_settings,
+    # Load and resize image
+    img = Image.open(args.image)
+    im = img.resize((800, int(800 * img.size[1] / img.size[0])), Image.Resampling.LANCZOS) # Resizing to speed-up rendering
+
+    # Run model to draw the grab bar
+    response = client.models.generate_content(
+        model=MODEL_ID,
+        contents=[PROMPT.format(box_2d=selected_box["box_2d"]), im],
+        config = types.GenerateContentConfig(
+            response_modalities=['TEXT', 'IMAGE'],
+            temperature=0.5,
+            safety_settings=safety_settings,
+        )
     )
-)
 
-for part in response.candidates[0].content.parts:
-  if part.text is not None:
-    print(part.text)
-  elif part.inline_data is not None:
-    image = Image.open(BytesIO(part.inline_data.data))
-    image.show()
\ No newline at end of file
+    for part in response.candidates[0].content.parts:
+      if part.text is not None:
+        print(part.text)
+      elif part.inline_data is not None:
+        image = Image.open(BytesIO(part.inline_data.data))
+        image.show()
+
+
+if __name__ == "__main__":
+    main()
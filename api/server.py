@@ -1,18 +1,35 @@
-from config import GEMINI_API_KEY
-from fastapi import FastAPI, UploadFile, File, Response, Form, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
-from google import genai
-from google.genai import types
-from PIL import Image, ImageDraw
-import io
-from io import BytesIO
-import base64
+from fastapi import FastAPI, UploadFile, File, Response, Form, Header, HTTPException
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+import asyncio
+import datetime
+import hashlib
 import json
 import os
+import shutil
+import tempfile
+import time
 import zipfile
-from typing import List
+from collections import OrderedDict
+from typing import Optional
 import logging
-from pdf_report import PDFReport
+from jobs import JobManager, JobQueueFull
+from zip_stream import ZipStream
+from image_encoding import ImageEncoding, content_type, supported_format
+from preprocess import prepare_frame, prepare_image
+from video import VideoDecodeError, select_keyframes
+from audio import AudioTooLarge, spool_upload
+from dispatcher import BACKGROUND, Admission, GeminiOverloaded, request_admission, request_priority
+from metrics import RequestMetrics, current_metrics, timed
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from similar_assessments import SimilarAssessmentIndex
+from prompts import PROMPT_PREFIXES, RECOMMENDATION_PACKS
+# The assessment itself, this module only serves it
+import pipeline
+from pipeline import (BOX_MODE, IMAGE_FORMAT, IMAGE_MAX_BYTES, IMAGE_QUALITY, MODEL_ROUTES, OVERLAY_MODE,
+                      REPORT_IMAGE_DPI, REPORT_JPEG_QUALITY, REPORT_WORKERS, THUMBNAIL_SIZE, StructuredOutputError,
+                      artifact_store, build_report, cache_bypass, context_cache, gemini_cache, gemini_dispatcher,
+                      generate_routed, get_client, has_text, iter_result_members, render_in_pool, report_fragments,
+                      reset_originals, session_store, stream_recommendations, types, with_artifact_hashes)
 
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
@@ -20,301 +37,751 @@ logger.setLevel(logging.DEBUG)
 
 app = FastAPI()
 
-# Gemini Client
-client = genai.Client(api_key=GEMINI_API_KEY)
-MODEL_ID = "gemini-2.5-pro-exp-03-25"
-MODEL_ID_IMG_GEN = "gemini-2.0-flash-exp-image-generation"
+# With ARTIFACT_ACCEL_REDIRECT, an internal nginx location aliased to ARTIFACT_DIR,
+# nginx sends artifacts itself (sendfile) instead of this worker
+ARTIFACT_ACCEL_REDIRECT = os.environ.get("ARTIFACT_ACCEL_REDIRECT", "")
+# Artifact IDs never change meaning, but they are photos of someone's home
+ARTIFACT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+# Video walkthroughs: keyframes sent to Gemini, decoder sampling rate and upload limit
+MAX_VIDEO_FRAMES = int(os.environ.get("MAX_VIDEO_FRAMES", "4"))
+VIDEO_SAMPLE_FPS = float(os.environ.get("VIDEO_SAMPLE_FPS", "2"))
+MAX_VIDEO_BYTES = int(os.environ.get("MAX_VIDEO_BYTES", str(200 * 1024 * 1024)))
+
+# Recordings up to AUDIO_INLINE_MAX_BYTES are sent inline, larger ones (up to
+# MAX_AUDIO_BYTES) are uploaded through the Gemini Files API
+AUDIO_INLINE_MAX_BYTES = int(os.environ.get("AUDIO_INLINE_MAX_BYTES", str(10 * 1024 * 1024)))
+MAX_AUDIO_BYTES = int(os.environ.get("MAX_AUDIO_BYTES", str(200 * 1024 * 1024)))
+AUDIO_PROCESSING_TIMEOUT_SECONDS = int(os.environ.get("AUDIO_PROCESSING_TIMEOUT_SECONDS", "120"))
+
+# Tee each streamed results ZIP to the session directory, needed by /generate_report/
+SAVE_RESULTS_ZIP = os.environ.get("SAVE_RESULTS_ZIP", "1") == "1"
+
+# Reuse the results of an earlier photo whose dHash is within PHASH_MAX_DISTANCE bits
+# (out of 64) and that was assessed for the same health problems
+PHASH_REUSE_ENABLED = os.environ.get("PHASH_REUSE_ENABLED", "1") == "1"
+similar_assessments = SimilarAssessmentIndex(
+    data_dir=os.environ.get("PHASH_INDEX_DIR", "phash_index"),
+    max_distance=int(os.environ.get("PHASH_MAX_DISTANCE", "6")),
+    ttl_seconds=int(os.environ.get("PHASH_TTL_SECONDS", str(30 * 24 * 3600))),
+    artifact_store=artifact_store,
+    max_entries=int(os.environ.get("PHASH_MAX_ENTRIES", "10000")),
+) if PHASH_REUSE_ENABLED else None
+
+# Background analyses started with /analyze_real/?mode=async
+job_manager = JobManager(
+    max_workers=int(os.environ.get("JOB_WORKERS", "2")),
+    max_queued=int(os.environ.get("JOB_QUEUE_SIZE", "20")),
+    ttl_seconds=int(os.environ.get("JOB_TTL_SECONDS", "3600")),
+)
+
+# Finished reports: report key -> artifact ID of the PDF, most recent last
+report_artifacts = OrderedDict()
+MAX_REPORT_ARTIFACTS = 1024
+
+# Test ZIP served by /analyze/ and used by /generate_report/ when no session is given
+TEST_ZIP_PATH = os.path.join(os.getcwd(), "actual.zip")
+
+@app.exception_handler(GeminiOverloaded)
+async def gemini_overloaded_handler(request, exc):
+    return JSONResponse(status_code=503, content={"detail": "Too many analyses in progress, try again later"},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(StructuredOutputError)
+async def structured_output_error_handler(request, exc):
+    return JSONResponse(status_code=502, content={"detail": str(exc)})
+
+
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def resolve_session(session_id):
+    """Return (session_id, state) for an X-Session-ID header, starting a new session if none was sent."""
+    if not session_id:
+        return session_store.create(), {}
+
+    state = session_store.get(session_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return session_id, state
+
+
+@app.middleware("http")
+async def record_request_metrics(request, call_next):
+    """Collect this request's stage timings and return them as a Server-Timing header."""
+    request_metrics = RequestMetrics()
+    token = current_metrics.set(request_metrics)
+    try:
+        response = await call_next(request)
+    finally:
+        current_metrics.reset(token)
+    # Streamed responses only include the stages done before the body started
+    response.headers["Server-Timing"] = request_metrics.server_timing()
+    return response
+
+
+@app.middleware("http")
+async def track_gemini_admission(request, call_next):
+    # Shared by the tasks the request starts, so a response that is already
+    # streaming never has its later Gemini calls shed
+    token = request_admission.set(Admission())
+    try:
+        return await call_next(request)
+    finally:
+        request_admission.reset(token)
+
+
+@app.middleware("http")
+async def read_cache_bypass_header(request, call_next):
+    bypass = request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
+    token = cache_bypass.set(bypass)
+    try:
+        return await call_next(request)
+    finally:
+        cache_bypass.reset(token)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/gemini/stats")
+async def get_gemini_stats():
+    return {**gemini_dispatcher.stats(), "routes": MODEL_ROUTES}
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    context_stats = context_cache.stats() if context_cache is not None else {"enabled": False}
+    if gemini_cache is None:
+        return {"enabled": False, "context_caches": context_stats}
+    return {"enabled": True, **gemini_cache.stats(), "context_caches": context_stats}
+
+
+# With WARMUP_ENABLED the start-up loads what the first requests would otherwise
+# wait for: the cache and artifact indexes, google.genai and fpdf, the report
+# pool's processes and a connection to Gemini. /ready answers 503 until then
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "0") == "1"
+warmup_task = None
+warmup_seconds = None
+
+
+def load_for_warmup():
+    for store in (gemini_cache, artifact_store, similar_assessments):
+        if store is not None:
+            store.load()
+    import pdf_report  # noqa: F401
+    get_client()
+
+
+async def warm_up():
+    global warmup_seconds
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(load_for_warmup)
+        if REPORT_WORKERS > 0:
+            await asyncio.gather(*(render_in_pool(os.getpid) for _ in range(REPORT_WORKERS)))
+        # Any cheap call opens the connection (DNS, TLS) the first request would wait on
+        await get_client().aio.models.get(model=MODEL_ROUTES["recommendations"][0])
+    except Exception as e:
+        # Not fatal, whatever is missing is loaded by the first request instead
+        print(f"Warm-up incomplete: {e}")
+    warmup_seconds = time.perf_counter() - start
+    print(f"Warm-up done in {warmup_seconds:.2f}s")
+
 
-bounding_box_system_instructions = """
-    Return bounding boxes as a JSON array with labels.
-"""
+@app.on_event("startup")
+async def start_warmup():
+    global warmup_task
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(warm_up())
 
-safety_settings = [
-    types.SafetySetting(
-        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-        threshold="BLOCK_ONLY_HIGH",
-    ),
-]
 
+@app.on_event("shutdown")
+def stop_warmup():
+    if warmup_task is not None:
+        warmup_task.cancel()
 
-def parse_json(json_output: str):
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i + 1:])
-            json_output = json_output.split("```")[0]
-            break
-    return json_output
+
+# Context caches are made by the warm-up when there is one, otherwise by the
+# first requests that need them, so a default start never calls Gemini
+context_cache_warmup = None
+
+
+@app.on_event("startup")
+async def warm_context_caches():
+    global context_cache_warmup
+    if context_cache is None or not WARMUP_ENABLED:
+        return
+    pairs = [(model, PROMPT_PREFIXES[stage]) for stage, models in MODEL_ROUTES.items()
+             if stage in PROMPT_PREFIXES for model in models]
+    pairs += [(model, pack) for pack in RECOMMENDATION_PACKS.values() for model in MODEL_ROUTES["recommendations"]]
+    # In the background, requests before it is done create or skip caches themselves
+    context_cache_warmup = asyncio.create_task(context_cache.warm(get_client(), pairs))
+
+
+@app.on_event("shutdown")
+def stop_context_cache_warmup():
+    if context_cache_warmup is not None:
+        context_cache_warmup.cancel()
+
+
+@app.get("/ready")
+async def get_ready():
+    if WARMUP_ENABLED and warmup_seconds is None:
+        return JSONResponse(status_code=503, content={"ready": False}, headers={"Retry-After": "1"})
+    return {"ready": True, "warmup_seconds": warmup_seconds}
+
+
+@app.get("/phash/stats")
+async def get_phash_stats():
+    if similar_assessments is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(similar_assessments.stats)}
+
+
+@app.get("/report/stats")
+async def get_report_stats():
+    return report_fragments.stats()
+
+
+@app.get("/artifacts/stats")
+async def get_artifact_stats():
+    return artifact_store.stats()
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def artifact_response(artifact_id, if_none_match=None, filename=None, headers=None, media_type=None):
+    """
+    Serve a stored artifact with its hash as strong ETag: 304 when the client
+    already has it, otherwise the file, with Range requests answered by
+    FileResponse, or an X-Accel-Redirect for nginx to send it.
+    """
+    path = artifact_store.get(artifact_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    media_type = media_type or content_type(artifact_id)
+
+    etag = f'"{artifact_id.split(".")[0]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": ARTIFACT_CACHE_CONTROL,
+        "Content-Location": f"/artifacts/{artifact_id}",
+        **(headers or {}),
+    }
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if ARTIFACT_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = f"{ARTIFACT_ACCEL_REDIRECT.rstrip('/')}/{artifact_id[:2]}/{artifact_id}"
+        return Response(media_type=media_type, headers=headers)
+    return FileResponse(path=path, media_type=media_type, headers=headers)
+
+
+@app.api_route("/artifacts/{artifact_id}", methods=["GET", "HEAD"])
+async def get_artifact(artifact_id: str, if_none_match: Optional[str] = Header(None)):
+    return artifact_response(artifact_id, if_none_match)
 
 
 @app.get("/analyze/")
 async def do_nothing():
     return {"error": "GET not defined for analyze/, use POST method"}
 
+async def upload_audio_file(audio_file, mime_type):
+    """Upload a recording through the Gemini Files API and wait until it can be used."""
+    uploaded = await get_client().aio.files.upload(
+        file=audio_file, config=types.UploadFileConfig(mime_type=mime_type))
+    deadline = time.monotonic() + AUDIO_PROCESSING_TIMEOUT_SECONDS
+    while uploaded.state == types.FileState.PROCESSING and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+        uploaded = await get_client().aio.files.get(name=uploaded.name)
+
+    if uploaded.state != types.FileState.ACTIVE:
+        await delete_audio_file(uploaded)
+        raise HTTPException(status_code=502, detail=f"Gemini could not process the recording ({uploaded.state})")
+    return uploaded
+
+
+async def delete_audio_file(uploaded):
+    # Files expire on their own after 48 hours, a failed delete is not worth failing the request
+    try:
+        await get_client().aio.files.delete(name=uploaded.name)
+    except Exception as e:
+        print(f"Could not delete uploaded file {uploaded.name}: {e}")
+
+
+async def transcribe_audio(file, prompt):
+    """
+    Send an uploaded recording with prompt to Gemini and return the reply text.
+
+    The upload is streamed to a spooled temporary file and its real MIME type
+    sniffed from the first bytes. Clips up to AUDIO_INLINE_MAX_BYTES are sent
+    inline, longer recordings go through the Files API.
+    """
+    try:
+        with timed("upload_read"):
+            audio_file, size, mime_type = await spool_upload(file, MAX_AUDIO_BYTES)
+    except AudioTooLarge:
+        raise HTTPException(status_code=413, detail="Recording is too large")
+
+    uploaded = None
+    with audio_file:
+        print(f"Received {size} bytes of {mime_type}")
+        if size <= AUDIO_INLINE_MAX_BYTES:
+            audio_part = types.Part.from_bytes(data=audio_file.read(), mime_type=mime_type)
+        else:
+            uploaded = await upload_audio_file(audio_file, mime_type)
+            audio_part = types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+
+    try:
+        response = await generate_routed("audio", contents=[prompt, audio_part], check=has_text)
+    finally:
+        if uploaded is not None:
+            await delete_audio_file(uploaded)
+    return response.text
+
+
 @app.post("/analyze_audio/")
-async def analyze_audio(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-
-    # Send audio bytes to Gemini
-    response = client.models.generate_content(
-        model = MODEL_ID,
-        contents=[
-            "Create a list of physical health problems fleshed out in this audio file, separate them with commas. Do not use commas anywhere else in the text, I should be able to split the text by commas and get short point form statements.",
-            types.Part.from_bytes(
-                data=audio_bytes,
-                mime_type='audio/mp3',  # Automatically pick mime type e.g., 'audio/mp3'
-            ),
-        ]
+async def analyze_audio(
+    file: UploadFile = File(...),
+    x_session_id: Optional[str] = Header(None),
+):
+    session_id, _ = resolve_session(x_session_id)
+
+    # Send the recording to Gemini
+    problems = await transcribe_audio(
+        file,
+        "Create a list of physical health problems fleshed out in this audio file, separate them with commas. Do not use commas anywhere else in the text, I should be able to split the text by commas and get short point form statements.",
     )
-    
-    with open("problems.txt", "w", encoding="utf-8") as f:
-        f.write(response.text)
 
-    return FileResponse(
-        path="problems.txt",
+    session_store.update(session_id, problems=problems)
+
+    return Response(
+        content=problems,
         media_type="text/plain",
-        filename="problems.txt"
+        headers={
+            "Content-Disposition": "attachment; filename=problems.txt",
+            "X-Session-ID": session_id,
+        }
     )
 
 @app.post("/analyze_text/")
 async def analyze_audio(file: UploadFile = File(...)):
-    audio_bytes = await file.read()
-
-    # Send audio bytes to Gemini
-    response = client.models.generate_content(
-        model = MODEL_ID,
-        contents=[
-            "Create a list of physical health problems fleshed out in this audio file, separate them with commas",
-            types.Part.from_bytes(
-                data=audio_bytes,
-                mime_type='audio/mp3',  # Automatically pick mime type e.g., 'audio/mp3'
-            ),
-        ]
+    # Send the recording to Gemini
+    problems = await transcribe_audio(
+        file,
+        "Create a list of physical health problems fleshed out in this audio file, separate them with commas",
     )
-    
-    print(response.text)
 
-    return FileResponse(
-        path="problems.txt",
-        media_type="text/plain",
-        filename="problems.txt"
+    print(problems)
+
+    return Response(content=problems, media_type="text/plain")
+
+
+async def wait_for_first(items):
+    """Wait for the first item of an async iterator, return an async iterator over all of them."""
+    first = await anext(items, None)
+
+    async def all_items():
+        if first is not None:
+            yield first
+            async for item in items:
+                yield item
+
+    return all_items()
+
+
+def results_zip_path(session_id):
+    return os.path.join(session_store.session_dir(session_id), 'results_bounding_boxes.zip')
+
+
+def record_results_zip(session_id, local_path):
+    """Record a finished results ZIP with the session and add it to the artifact store."""
+    # Results ZIPs are only ever replaced whole, the artifact can be a hard link
+    artifact_id = artifact_store.put_file(local_path, "zip", link=True)
+    session_store.update(session_id, results_zip=local_path, results_artifact=artifact_id)
+    return artifact_id
+
+
+async def stream_results_zip(session_id, members, on_saved=None):
+    """
+    Yield the results ZIP in chunks as members arrive.
+
+    With SAVE_RESULTS_ZIP the bytes are also tee'd to the session's results
+    ZIP, which is only recorded (and its artifact ID passed to on_saved) once
+    the archive is complete.
+    """
+    tee = None
+    if SAVE_RESULTS_ZIP:
+        local_path = results_zip_path(session_id)
+        tee = open(f"{local_path}.partial", "wb")
+
+    completed = False
+    try:
+        zip_stream = ZipStream(tee=tee)
+        async for filename, data in members:
+            with timed("zip_write"):
+                chunk = zip_stream.write(filename, data)
+            yield chunk
+        with timed("zip_write"):
+            chunk = zip_stream.close()
+        yield chunk
+        completed = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if completed:
+                os.replace(tee.name, local_path)
+                artifact_id = record_results_zip(session_id, local_path)
+                print(f"Saved zip locally to {local_path}")
+                record_assessment_usage(session_id)
+                if on_saved is not None:
+                    await asyncio.to_thread(on_saved, artifact_id)
+            else:
+                os.remove(tee.name)
+
+
+def record_assessment_usage(session_id):
+    """Log the finished assessment's stage timings and store its token usage with the session."""
+    request_metrics = current_metrics.get()
+    if request_metrics is None:
+        return
+    summary = request_metrics.summary()
+    print(f"Assessment {session_id} metrics: {json.dumps(summary)}")
+    session_store.update(session_id, usage=summary["tokens"])
+
+
+async def save_results_zip(session_id, members, on_saved=None):
+    """Write the results ZIP straight to the session directory."""
+    local_path = results_zip_path(session_id)
+    with zipfile.ZipFile(f"{local_path}.partial", "w", zipfile.ZIP_DEFLATED) as zip_file:
+        async for filename, data in members:
+            with timed("zip_write"):
+                zip_file.writestr(filename, data)
+    os.replace(f"{local_path}.partial", local_path)
+    artifact_id = record_results_zip(session_id, local_path)
+    print(f"Saved zip locally to {local_path}")
+    record_assessment_usage(session_id)
+    if on_saved is not None:
+        await asyncio.to_thread(on_saved, artifact_id)
+
+
+def assessment_options(overlay, image_format, room, box_mode):
+    """The options an earlier assessment must have been made with to be reused."""
+    # room None means the room is classified, which gives the same answer for a near-identical photo
+    return {"overlay": overlay, "image_format": image_format, "room": room, "box_mode": box_mode or BOX_MODE}
+
+
+async def find_similar_assessment(frames, problems_text, options):
+    """Return (distance, entry) for an earlier assessment of a near-identical photo, or None."""
+    # Only single photos are indexed, and X-Cache-Bypass forces a fresh analysis
+    if similar_assessments is None or len(frames) != 1 or cache_bypass.get():
+        return None
+    return await asyncio.to_thread(similar_assessments.lookup, frames[0].phash, problems_text, options)
+
+
+def index_assessment(session_id, frames, problems_text, options):
+    """
+    Return an on_saved callback that adds the finished assessment to the
+    similar-photo index, it writes the index and is run in a thread.
+    """
+    if similar_assessments is None or len(frames) != 1:
+        return None
+
+    def on_saved(artifact_id):
+        recs = (session_store.get(session_id) or {}).get("recommendations", [])
+        similar_assessments.add(frames[0].phash, problems_text, recs, artifact_id, options)
+
+    return on_saved
+
+
+def read_zip_members(zip_path):
+    with zipfile.ZipFile(zip_path) as zip_file:
+        return [(name, zip_file.read(name)) for name in zip_file.namelist()]
+
+
+def reuse_assessment(session_id, distance, entry, mode):
+    """
+    Serve an earlier assessment's results for this session without calling
+    Gemini. Returns None when its results ZIP left the artifact store since
+    the lookup.
+    """
+    stored_zip = artifact_store.get(entry["artifact"])
+    if stored_zip is None:
+        return None
+    print(f"Reusing assessment {entry['id']} (hash distance {distance})")
+    local_path = results_zip_path(session_id)
+    # The reused ZIP's images are used for the report as they are
+    reset_originals(os.path.dirname(local_path))
+    # Replaced rather than overwritten, an earlier results ZIP may be linked from the artifact store
+    shutil.copyfile(stored_zip, f"{local_path}.partial")
+    os.replace(f"{local_path}.partial", local_path)
+    session_store.update(session_id, recommendations=entry["recommendations"])
+    artifact_id = record_results_zip(session_id, local_path)
+    headers = {"X-Session-ID": session_id, "X-Reused-Assessment": entry["id"],
+               "X-Reused-Distance": str(distance)}
+
+    if mode == "async":
+        async def run(progress):
+            progress("recommendations_parsed", count=len(entry["recommendations"]))
+            progress("reused", files=read_zip_members(local_path),
+                     assessment=entry["id"], distance=distance)
+
+        try:
+            job = job_manager.submit(session_id, run)
+        except JobQueueFull:
+            raise HTTPException(status_code=503, detail="Too many analyses queued, try again later",
+                                headers={"Retry-After": "30"})
+        return JSONResponse(
+            status_code=202,
+            content={
+                "job_id": job.id,
+                "session_id": session_id,
+                "status_url": f"/jobs/{job.id}",
+                "events_url": f"/jobs/{job.id}/events",
+            },
+            headers=headers,
+        )
+
+    return artifact_response(artifact_id, filename="bounding_boxes.zip", headers=headers,
+                             media_type="application/x-zip-compressed")
+
+
+async def respond_with_analysis(session_id, frames, problems_text, mode, box_mode, overlay=None,
+                                image_format=None, room=None):
+    """
+    Start the analysis as a background job (mode=async) or stream its results ZIP.
+
+    A photo that is a near-duplicate of an earlier one assessed for the same
+    problems with the same options gets that assessment's results instead.
+    """
+    overlay = overlay or OVERLAY_MODE
+    encoding = ImageEncoding(format=supported_format(image_format or IMAGE_FORMAT), quality=IMAGE_QUALITY,
+                             max_bytes=IMAGE_MAX_BYTES, thumbnail_size=THUMBNAIL_SIZE)
+    options = assessment_options(overlay, encoding.format, room, box_mode)
+    similar = await find_similar_assessment(frames, problems_text, options)
+    if similar is not None:
+        response = reuse_assessment(session_id, *similar, mode)
+        if response is not None:
+            return response
+    on_saved = index_assessment(session_id, frames, problems_text, options)
+    originals_dir = reset_originals(session_store.session_dir(session_id))
+
+    if mode == "async":
+        async def run(progress):
+            # Background jobs give way to interactive requests for Gemini calls
+            request_priority.set(BACKGROUND)
+            current_metrics.set(RequestMetrics())
+            recs = stream_recommendations(session_id, frames, problems_text, box_mode, progress, room)
+            members = iter_result_members(recs, frames, progress, overlay, encoding, originals_dir)
+            await save_results_zip(session_id, with_artifact_hashes(members, progress), on_saved)
+
+        try:
+            job = job_manager.submit(session_id, run)
+        except JobQueueFull:
+            raise HTTPException(status_code=503, detail="Too many analyses queued, try again later",
+                                headers={"Retry-After": "30"})
+
+        return JSONResponse(
+            status_code=202,
+            content={
+                "job_id": job.id,
+                "session_id": session_id,
+                "status_url": f"/jobs/{job.id}",
+                "events_url": f"/jobs/{job.id}/events",
+            },
+            headers={"X-Session-ID": session_id},
+        )
+
+    # Errors from the recommendation call still surface as a normal error response,
+    # the ZIP only starts streaming once the first recommendation is in
+    recs = await wait_for_first(stream_recommendations(session_id, frames, problems_text, box_mode, room=room))
+
+    print("Streaming zip file")
+    members = iter_result_members(recs, frames, overlay=overlay, encoding=encoding, originals_dir=originals_dir)
+    # Return the zip file as a response
+    return StreamingResponse(
+        stream_results_zip(session_id, with_artifact_hashes(members), on_saved),
+        media_type="application/x-zip-compressed",
+        headers={
+            "Content-Disposition": "attachment; filename=bounding_boxes.zip",
+            "X-Session-ID": session_id,
+        }
     )
 
 
+def check_analysis_options(box_mode, overlay, image_format, room=None):
+    try:
+        pipeline.check_analysis_options(box_mode, overlay, image_format, room)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/analyze_real/")
 # @app.post("/analyze/")
 async def analyze_image(
     file: UploadFile = File(...),
     # descriptions: List[str] = Form(...)
+    x_session_id: Optional[str] = Header(None),
+    mode: str = "sync",
+    box_mode: Optional[str] = None,
+    overlay: Optional[str] = None,
+    image_format: Optional[str] = None,
+    room: Optional[str] = None,
 ):
+    """
+    Analyze one photo. With ?mode=async the analysis runs as a background job
+    and the response is the job ID to poll at /jobs/{job_id} or stream from
+    /jobs/{job_id}/events. ?box_mode=, ?overlay= and ?image_format= override
+    BOX_MODE, OVERLAY_MODE and IMAGE_FORMAT for this request, ?room= skips
+    the room classification (one of ROOM_TYPES).
+    """
+    check_analysis_options(box_mode, overlay, image_format, room)
+    session_id, session = resolve_session(x_session_id)
 
-    # Read uploaded image and resize
+    # Read uploaded image, decode and resize it once
     print("Starting /analyze")
-    contents = await file.read()
-    original_image = Image.open(io.BytesIO(contents))
-    original_image.thumbnail([1024, 1024], Image.Resampling.LANCZOS)
-
-    # Prepare base64 image for Gemini
-    buffered = io.BytesIO()
-    original_image.save(buffered, format="JPEG")
-    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-
-    # Open and read problems.txt
-    with open("problems.txt", "r", encoding="utf-8") as f:
-        problems_text = f.read()
-
-    prompt_recs = (f"""
-            Role: You are an occupational therapist / interior designer specialized in accessible home design, guided by ADA principles adapted for residential settings.
-            Context: The resident of this home is an elderly individual experiencing significant challenges with physical mobility: {problems_text}. This increases their risk of falls.
-            Task: Analyze the provided images of the house interior. Based on Americans with Disabilities Act (ADA) guidelines and best practices for aging-in-place, fall prevention, and universal design, identify potential hazards and suggest specific, actionable modifications to improve safety, accessibility, and ease of use for this resident.
-            Analyze these aspects within the image and provide suggestions:
-            Toilet Area:
-                Analyze: Current toilet height (estimate standard vs. comfort height), clear floor space surrounding it (for transfers from walker/wheelchair), presence and placement of any existing grab bars, accessibility of toilet paper holder.
-                Suggest: Installing a taller "comfort height" toilet or raised seat, ensuring adequate clear transfer space, installing appropriately placed grab bars (specify locations like rear wall, side wall – consider types like straight, L-shaped), relocating toilet paper holder for easier reach.
-            Sink & Vanity Area:
-                Analyze: Sink/counter height, clear knee space underneath (for potential seated use), faucet control type (knobs, single lever, etc.), mirror height and visibility (standing/seated), reachability of soap/towels, general counter clutter.
-                Suggest: Modifying vanity for knee space, installing lever-handle or touchless faucets (easier operation), lowering/tilting mirror, ensuring essential items are within easy reach without leaning/stretching, organizing storage.
-            Bathing Area (Shower and/or Tub):
-                Analyze: Method of entry (step-over tub wall, shower curb height), presence and location of grab bars, availability and type of seating (built-in/portable), shower controls (reachability from seated/standing, ease of use, anti-scald features?), shower head type (fixed/handheld, adjustable height?), slip resistance of the floor surface inside.
-                Suggest: Creating a curbless/zero-entry shower, installing a tub cut-out or transfer bench for tub access, adding strategically placed grab bars (vertical at entry, horizontal/angled inside), installing a secure fold-down or fixed shower seat, ensuring easy-to-operate controls with clear temperature markings, installing a handheld shower head on an adjustable slide bar, applying non-slip treatments or ensuring high-traction surfaces.
-            Flooring:
-                Analyze: Main bathroom floor material type, perceived slip resistance (especially when potentially wet), presence and type of any mats or rugs (potential trip hazards).
-                Suggest: Installing high-traction, non-slip flooring (e.g., matte finish tiles with appropriate COF rating, textured vinyl), removing loose rugs entirely, or using only securely adhered, low-profile, non-slip mats if absolutely necessary. Emphasize non-slip surfaces throughout.
-            Output Format: Please provide multiple suggestions as a clear, prioritized list. Store each suggestion as a separate JSON object (maximum 3). For each suggestion:
-            Clearly state the recommended modification, specific enough for an architect to know where on the image they should draw the changes. (Modification)
-            Explain why it's important for someone with mobility/balance issues, referencing ADA principles or fall prevention where applicable. (Rationale)
-            Estimate the cost of such an implementation in terms of the number of dollar signs. (Cost)
-            Briefly speaking, how will the installation process look like. (Installation)
+    with timed("upload_read"):
+        contents = await file.read()
+    with timed("preprocess"):
+        prepared = prepare_image(contents)
+
+    # Health problems recorded by /analyze_audio/ for this session
+    problems_text = session.get("problems") or "no specific problems reported"
+
+    return await respond_with_analysis(session_id, [prepared], problems_text, mode, box_mode, overlay,
+                                       image_format, room)
+
+
+@app.post("/analyze_video/")
+async def analyze_video(
+    file: UploadFile = File(...),
+    x_session_id: Optional[str] = Header(None),
+    mode: str = "sync",
+    box_mode: Optional[str] = None,
+    overlay: Optional[str] = None,
+    image_format: Optional[str] = None,
+    room: Optional[str] = None,
+):
     """
+    Analyze a video walkthrough. Up to MAX_VIDEO_FRAMES sharp, distinct
+    keyframes are picked and sent through the same pipeline as /analyze_real/,
+    with the same mode, box_mode, overlay, image_format and room options.
+    """
+    check_analysis_options(box_mode, overlay, image_format, room)
+    session_id, session = resolve_session(x_session_id)
+
+    print("Starting /analyze_video")
+    # Stream the upload to disk, videos are large and the decoder needs a seekable file
+    suffix = os.path.splitext(file.filename or "")[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as video_file:
+        size = 0
+        with timed("upload_read"):
+            while chunk := await file.read(1024 * 1024):
+                size += len(chunk)
+                if size > MAX_VIDEO_BYTES:
+                    raise HTTPException(status_code=413, detail="Video is too large")
+                video_file.write(chunk)
+            video_file.flush()
+
+        # Decoding is CPU-bound, keep it off the event loop
+        try:
+            with timed("keyframes"):
+                keyframes = await asyncio.to_thread(
+                    select_keyframes, video_file.name, MAX_VIDEO_FRAMES, VIDEO_SAMPLE_FPS)
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Video support requires PyAV (pip install av)")
+        except VideoDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Could not read video: {e}")
+
+    print(f"Selected keyframes at {[round(k.time, 1) for k in keyframes]}s")
+    with timed("preprocess"):
+        frames = [prepare_frame(keyframe.image) for keyframe in keyframes]
+
+    problems_text = session.get("problems") or "no specific problems reported"
+    return await respond_with_analysis(session_id, frames, problems_text, mode, box_mode, overlay,
+                                       image_format, room)
+
+
+@app.on_event("startup")
+def start_job_workers():
+    # Here rather than in the first ?mode=async request, whose context the workers would keep
+    job_manager.start()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = get_job_or_404(job_id)
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    job = get_job_or_404(job_id)
+    start = int(last_event_id) if last_event_id and last_event_id.isdigit() else -1
+    return StreamingResponse(
+        job.stream_events(start),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    print("Parsed image, calling Gemini")
-    # Call Gemini
-    response_recs = client.models.generate_content(
-        model=MODEL_ID,
-        contents=[
-            {"inline_data": {"mime_type": "image/jpeg", "data": img_base64}},
-            prompt_recs
-        ],
-        config=types.GenerateContentConfig(
-            temperature=0,
-            safety_settings=safety_settings
-        )
-    )
-    print("Called Gemini")
-
-    # Parse json file
-    print("response_recs.text:", response_recs.text)
-    parsed_recs = parse_json(response_recs.text)
-    print("parsed_recs:", parsed_recs)
-    parsed_json_recs = json.loads(parsed_recs)
-
-    with open("recommendations.json", "w", encoding="utf-8") as f:
-        json.dump(parsed_json_recs, f, ensure_ascii=False, indent=4)
-
-    print("Parsed bboxes, creating zip file")
-    # 1) Create the zip BUFFER and ZIP FILE one time
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-
-        # Loop over all json objects
-        for rec_idx, rec in enumerate(parsed_json_recs):
-            mod = parsed_json_recs[rec_idx]['Modification']
-            rationale = parsed_json_recs[rec_idx]['Rationale']
-            cost = parsed_json_recs[rec_idx]['Cost']
-            installation = parsed_json_recs[rec_idx]['Installation']
-
-            prompt_bb = (f"""
-            Role: Act as an OT/Interior Designer specializing in accessible home modifications for seniors with significant mobility/balance issues and fall risk, using adapted ADA principles.
-            Task: Edit the input image(s) to realistically WHERE the accessibility modifications defined in the Modification JSON object should be placed
-            Output Requirements: coordinates for 1 bounding box
-            "Modification": {mod}
-            """)
-
-            # Call Gemini
-            response_bb = client.models.generate_content(
-                model=MODEL_ID,
-                contents=[
-                    {"inline_data": {"mime_type": "image/jpeg", "data": img_base64}},
-                    prompt_bb
-                ],
-                config=types.GenerateContentConfig(
-                    system_instruction=bounding_box_system_instructions,
-                    temperature=0,
-                    safety_settings=safety_settings
-                )
-            )
-
-            # Parse bounding boxes
-            parsed_bb = parse_json(response_bb.text)
-            parsed_json_bb = json.loads(parsed_bb)
-
-            width, height = original_image.size
-
-            if parsed_json_bb:
-
-                box = parsed_json_bb[0]
-                y1, x1, y2, x2 = box["box_2d"]
-
-                # Copy image
-                img_copy = original_image.copy()
-                draw = ImageDraw.Draw(img_copy)
-
-                y1, x1, y2, x2 = box["box_2d"]
-                abs_x1 = int(x1 / 1000 * width)
-                abs_y1 = int(y1 / 1000 * height)
-                abs_x2 = int(x2 / 1000 * width)
-                abs_y2 = int(y2 / 1000 * height)
-
-                draw.rectangle([(abs_x1, abs_y1), (abs_x2, abs_y2)],
-                               outline="green", width=4)
-
-                # Save this image to bytes
-                img_bytes = io.BytesIO()
-                img_copy.save(img_bytes, format='PNG')
-                img_bytes.seek(0)
-
-                # Write image into the zip file
-                zip_file.writestr(f"bb_image_{rec_idx + 1}.png", img_bytes.read())
-
-                # Create a dictionary that combines all 4 text parts
-                combined_data = {
-                    "rationale": rationale,
-                    "modification": mod,
-                    "cost": cost,
-                    "installation": installation
-                }
-
-                # Write it into the zip file as a JSON file
-                zip_file.writestr(f"text_{rec_idx+1}.json", json.dumps(combined_data, indent=2))
-
-                # Prepare second prompt
-                prompt_mod = f"""
-                Role: Act as an OT/Interior Designer specializing in accessible home modifications for seniors with significant mobility/balance issues and fall risk, using adapted ADA principles.
-                Task: Edit the input image to realistically visualize the accessibility modifications defined in the Modification JSON object.
-                Output Requirements:
-                Generate photorealistic edited image.
-                Modifications must be seamlessly integrated (lighting, perspective).
-                Accurately reflect JSON specifications (type, location, details).
-                Ensure visualized changes are contextually appropriate for accessibility needs.
-
-                "Modification": {mod}
-                """
-
-                # Save the original (without red box) for second call
-                clean_img_buffer = io.BytesIO()
-                original_image.save(clean_img_buffer, format="JPEG")
-                clean_base64 = base64.b64encode(clean_img_buffer.getvalue()).decode()
-
-                response_mod = client.models.generate_content(
-                    model=MODEL_ID_IMG_GEN,
-                    contents=[
-                        {"inline_data": {"mime_type": "image/jpeg", "data": clean_base64}},
-                        prompt_mod
-                    ],
-                    config=types.GenerateContentConfig(
-                        temperature=0,
-                        response_modalities=['TEXT', 'IMAGE'],
-                        safety_settings=safety_settings,
-                    )
-                )
-
-            # Parse the response to get the generated image
-                for part in response_mod.candidates[0].content.parts:
-                    if part.inline_data is not None:
-                        handlebar_img = Image.open(BytesIO(part.inline_data.data))
-
-                        # Save the handlebar image into bytes
-                        img_handlebar_bytes = io.BytesIO()
-                        handlebar_img.save(img_handlebar_bytes, format="PNG")
-                        img_handlebar_bytes.seek(0)
-
-                        # Add to zip
-                        zip_file.writestr(
-                            f"mod_image_{rec_idx+1}.png", img_handlebar_bytes.read())
-
-    # Move the buffer to the beginning
-    zip_buffer.seek(0)
-
-    print("Saving zip file locally")
-    # Save zip to local directory as well
-    local_path = os.path.join(os.getcwd(), 'results_bounding_boxes.zip')
-    with open(local_path, 'wb') as f:
-        f.write(zip_buffer.getvalue())
-    print(f"Saved zip locally to {local_path}")
 
-    print("Done creating zip file, returning response")
-    # Return the zip file as a response
-    return Response(
-        content=zip_buffer.getvalue(),
-        media_type="application/x-zip-compressed",
-        headers={
-            "Content-Disposition": "attachment; filename=bounding_boxes.zip"
-        }
-    )
+@app.get("/jobs/{job_id}/artifacts/{filename}")
+async def get_job_artifact(job_id: str, filename: str, if_none_match: Optional[str] = Header(None)):
+    job = get_job_or_404(job_id)
+    if filename not in job.artifacts:
+        raise HTTPException(status_code=404, detail="Artifact not ready")
+
+    content = job.artifacts[filename]
+    body = content.encode() if isinstance(content, str) else content
+    etag = f'"{hashlib.sha256(body).hexdigest()}"'
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type=content_type(filename), headers={"ETag": etag})
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, if_none_match: Optional[str] = Header(None)):
+    job = get_job_or_404(job_id)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+
+    session = session_store.get(job.session_id)
+    if session is None or not os.path.exists(session.get("results_zip", "")):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    # Evicted from the artifact store (or saved before it existed), add it again
+    artifact_id = session.get("results_artifact")
+    if artifact_id is None or artifact_store.get(artifact_id) is None:
+        artifact_id = await asyncio.to_thread(record_results_zip, job.session_id, session["results_zip"])
+    return artifact_response(artifact_id, if_none_match, filename="bounding_boxes.zip",
+                             headers={"X-Session-ID": job.session_id},
+                             media_type="application/x-zip-compressed")
+
+
+@app.on_event("shutdown")
+def shutdown_report_pool():
+    pipeline.shutdown_report_pool()
+
 
 @app.post("/generate_report/")
-async def generate_report(indexes: str = Form(...)):
+async def generate_report(
+    indexes: str = Form(...),
+    x_session_id: Optional[str] = Header(None),
+):
     print("generate report called")
     try:
         # Split the string by commas, strip spaces, and convert to integers
@@ -324,69 +791,57 @@ async def generate_report(indexes: str = Form(...)):
     
     print("Received indexes:", index_list)
 
-    # Path to your zip file
-    zip_path = os.path.join(os.getcwd(), "actual.zip")
-    if not os.path.exists(zip_path):
-        raise HTTPException(status_code=404, detail="Test ZIP not found")
-
-    # Create PDF Object
-    pdf = PDFReport()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_cover_page()
-
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        for idx in index_list:
-            image_filename = f"mod_image_{idx}.png"
-            text_filename = f"text_{idx}.json"
-
-            try:
-                with zip_ref.open(image_filename) as file:
-                    img = Image.open(file)
-                    img_width, img_height = img.size
-
-                    width_mm = img_width * 0.264583
-                    height_mm = img_height * 0.264583
-
-                    temp_img_path = f"temp_image_{idx}.png"
-                    img.save(temp_img_path)
-            except KeyError:
-                print(f"Image file {image_filename} not found in ZIP!")
-                continue
-
-            try:
-                with zip_ref.open(text_filename) as text_file:
-                    text_data = json.load(text_file)
-            except KeyError:
-                print(f"Text file {text_filename} not found in ZIP!")
-                text_data = {}
-
-            pdf.add_image_and_description(temp_img_path, text_data)
-
-            # Clean up temp image
-            os.remove(temp_img_path)
-
-    output_pdf_path = os.path.join(os.getcwd(), "output.pdf")
-    pdf.output(output_pdf_path)
-
-    return FileResponse(
-        path=output_pdf_path,
-        media_type="application/pdf",
-        filename="home_safety_report.pdf"
-    )
+    # Results of this session, or the test ZIP for clients that do not send a session
+    if x_session_id:
+        session_id, session = resolve_session(x_session_id)
+        zip_path = session.get("results_zip")
+        if not zip_path or not os.path.exists(zip_path):
+            raise HTTPException(status_code=404, detail="No results for this session yet")
+    else:
+        session_id = None
+        zip_path = TEST_ZIP_PATH
+        if not os.path.exists(zip_path):
+            raise HTTPException(status_code=404, detail="Test ZIP not found")
+
+    # The same recommendations of the same results on the same day make the same report
+    stat = os.stat(zip_path)
+    report_key = (f"{zip_path}:{stat.st_mtime_ns}:{stat.st_size}:{index_list}:{datetime.date.today()}:"
+                  f"{REPORT_IMAGE_DPI}:{REPORT_JPEG_QUALITY}")
+    artifact_id = report_artifacts.get(report_key)
+    if artifact_id is None or artifact_store.get(artifact_id) is None:
+        with timed("pdf_render"):
+            pdf_bytes = await build_report(zip_path, index_list)
+        artifact_id = await asyncio.to_thread(artifact_store.put_bytes, pdf_bytes, "pdf")
+        report_artifacts[report_key] = artifact_id
+        while len(report_artifacts) > MAX_REPORT_ARTIFACTS:
+            report_artifacts.popitem(last=False)
+    else:
+        report_artifacts.move_to_end(report_key)
+        print(f"Report: serving {artifact_id} from the artifact store")
+
+    headers = {"X-Session-ID": session_id} if session_id else {}
+    return artifact_response(artifact_id, filename="home_safety_report.pdf", headers=headers,
+                             media_type="application/pdf")
 
 @app.post("/analyze/")
-async def analyze_image_test(file: UploadFile = File(...),):
+async def analyze_image_test(
+    file: UploadFile = File(...),
+    x_session_id: Optional[str] = Header(None),
+):
     print("analyze_image_test called")
-    zip_path = os.path.join(os.getcwd(), "actual.zip")
+    zip_path = TEST_ZIP_PATH
     if not os.path.exists(zip_path):
         raise HTTPException(404, "Test ZIP not found")
 
+    # Point the session at the test results so /generate_report/ can use them
+    session_id, _ = resolve_session(x_session_id)
+    session_store.update(session_id, results_zip=zip_path)
+
+    # Copied rather than linked, the test ZIP may be rewritten in place
+    artifact_id = await asyncio.to_thread(artifact_store.put_file, zip_path, "zip")
     print("returning file response with local ")
-    return FileResponse(
-        path=zip_path,
-        media_type="application/zip",
-        filename="actual.zip",
-    )
+    return artifact_response(artifact_id, filename="actual.zip", headers={"X-Session-ID": session_id},
+                             media_type="application/zip")
 
 if __name__ == "__main__":
     import uvicorn
@@ -6,9 +6,9 @@ from google.genai import types
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 import io
 import base64
-import json
 
 from config import GEMINI_API_KEY
+from schemas import extract_json
 
 app = FastAPI()
 
@@ -39,15 +39,6 @@ prompt = (
     "These boxes should clearly demarcate the suggested areas for grab bar installation. Do not insert the handle bars yet."
 )
 
-def parse_json(json_output: str):
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i + 1:])
-            json_output = json_output.split("```")[0]
-            break
-    return json_output
-
 @app.post("/analyze/")
 async def analyze_image(file: UploadFile = File(...)):
     # Read uploaded file
@@ -77,8 +68,7 @@ async def analyze_image(file: UploadFile = File(...)):
     )
 
     # Parse bounding boxes
-    parsed = parse_json(response.text)
-    parsed_json = json.loads(parsed)
+    parsed_json = extract_json(response.text)
 
     # Draw bounding boxes
     draw = ImageDraw.Draw(image)
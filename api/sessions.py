@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class SessionStore:
+    """
+    In-process assessment state with TTL expiry.
+
+    A session holds the small JSON state of one assessment (health problems,
+    recommendations, where its results ZIP lives). Larger artifacts are written
+    to a per-session directory under data_dir, which is removed together with
+    the session when it expires.
+    """
+
+    def __init__(self, ttl_seconds, data_dir):
+        self.ttl_seconds = ttl_seconds
+        self.data_dir = data_dir
+        self._sessions = {}  # session_id -> (expires_at, state)
+        self._lock = threading.Lock()
+
+    def session_dir(self, session_id):
+        """Directory for this session's files, created on first use."""
+        path = os.path.join(self.data_dir, session_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def create(self):
+        self.purge_expired()
+        session_id = uuid.uuid4().hex
+        self._save(session_id, {})
+        return session_id
+
+    def get(self, session_id):
+        """Return the state dict of a live session, or None."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        if entry is None or entry[0] < time.time():
+            return None
+        return dict(entry[1])
+
+    def update(self, session_id, **fields):
+        """Merge fields into the session state and push its expiry back."""
+        state = self.get(session_id)
+        if state is None:
+            raise KeyError(session_id)
+        state.update(fields)
+        self._save(session_id, state)
+        return state
+
+    def _save(self, session_id, state):
+        with self._lock:
+            self._sessions[session_id] = (time.time() + self.ttl_seconds, state)
+
+    def _expired_ids(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._sessions.items() if expires_at < now]
+            for sid in expired:
+                del self._sessions[sid]
+        return expired
+
+    def purge_expired(self):
+        """Drop expired sessions and their directories."""
+        expired = self._expired_ids()
+        for session_id in expired:
+            shutil.rmtree(os.path.join(self.data_dir, session_id), ignore_errors=True)
+        return len(expired)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SessionStore backed by a SQLite database so several uvicorn workers can
+    share sessions. data_dir must be on a filesystem all workers can see.
+    """
+
+    def __init__(self, ttl_seconds, data_dir, db_path):
+        super().__init__(ttl_seconds, data_dir)
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, expires_at REAL NOT NULL, state TEXT NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state FROM sessions WHERE id = ? AND expires_at >= ?",
+                (session_id, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, session_id, state):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, expires_at, state) VALUES (?, ?, ?)",
+                (session_id, time.time() + self.ttl_seconds, json.dumps(state)),
+            )
+
+    def _expired_ids(self):
+        now = time.time()
+        with self._connect() as conn:
+            expired = [row[0] for row in conn.execute(
+                "SELECT id FROM sessions WHERE expires_at < ?", (now,))]
+            conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        return expired
+
+
+def create_session_store(backend, ttl_seconds, data_dir, db_path=None):
+    if backend == "memory":
+        return SessionStore(ttl_seconds, data_dir)
+    if backend == "sqlite":
+        return SqliteSessionStore(ttl_seconds, data_dir, db_path or os.path.join(data_dir, "sessions.db"))
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from perceptual_hash import BKTree
+
+
+class SimilarAssessmentIndex:
+    """
+    Finds earlier assessments of a near-identical photo so their results can be reused.
+
+    Each completed single-photo assessment is stored under its dHash with the
+    artifact ID of its results ZIP in artifact_store (see artifact_store.py)
+    and its recommendations. Recommendations depend on the reported health
+    problems as well as the photo, so there is one BK-tree per problems text
+    and a lookup only matches assessments made for the same problems. A
+    lookup also only matches assessments made with the same options (overlay
+    layout, image format, room, box mode). Entries live in data_dir/index.jsonl
+    and expire after ttl_seconds, or earlier when the artifact store drops
+    their ZIP. Expired entries, and the oldest ones past max_entries, are
+    dropped when the index is loaded (on first use or by load()) and at most
+    every compact_interval_seconds while entries are added. load, lookup, add
+    and stats do blocking file I/O, call them from a thread when on an event
+    loop.
+    """
+
+    def __init__(self, data_dir, max_distance, ttl_seconds, artifact_store, max_entries=10000,
+                 compact_interval_seconds=3600, latency_window=1000):
+        self.data_dir = data_dir
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self.artifact_store = artifact_store
+        self.max_entries = max_entries
+        self.compact_interval_seconds = compact_interval_seconds
+        self.lookups = 0
+        self.hits = 0
+        self.dropped = 0
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._last_compact = 0.0
+
+        # problems digest -> BKTree of image hash -> entry dict
+        self._trees = {}
+        self._entries = 0
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.data_dir, "index.jsonl")
+
+    @staticmethod
+    def problems_key(problems_text):
+        # Case and whitespace differences in the transcript do not change the advice
+        normalized = " ".join(problems_text.lower().split())
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def _insert(self, entry):
+        tree = self._trees.setdefault(entry["problems"], BKTree())
+        tree.add(entry["hash"], entry)
+        self._entries += 1
+
+    def _live(self, entry, now):
+        return (now - entry["created_at"] <= self.ttl_seconds
+                and os.path.exists(self.artifact_store.path(entry["artifact"])))
+
+    def load(self):
+        """Read the index left by previous runs, once."""
+        with self._load_lock:
+            if self._loaded:
+                return
+            os.makedirs(self.data_dir, exist_ok=True)
+            with self._lock:
+                self._compact()
+            self._loaded = True
+
+    def _compact(self):
+        """Rebuild the index from index.jsonl without dead entries, keeping the newest max_entries."""
+        self._last_compact = time.monotonic()
+        if not os.path.exists(self._index_path):
+            return
+
+        now = time.time()
+        entries = []
+        with open(self._index_path) as index_file:
+            for line in index_file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        live = [entry for entry in entries if "artifact" in entry and self._live(entry, now)]
+        live = sorted(live, key=lambda entry: entry["created_at"])[-self.max_entries:]
+        self.dropped += len(entries) - len(live)
+
+        with open(f"{self._index_path}.partial", "w") as index_file:
+            for entry in live:
+                index_file.write(json.dumps(entry) + "\n")
+        os.replace(f"{self._index_path}.partial", self._index_path)
+
+        self._trees = {}
+        self._entries = 0
+        for entry in live:
+            self._insert(entry)
+
+    def lookup(self, image_hash, problems_text, options):
+        """Return (distance, entry) for the closest live entry within max_distance made with options, or None."""
+        self.load()
+        start = time.perf_counter()
+        with self._lock:
+            tree = self._trees.get(self.problems_key(problems_text))
+            matches = tree.search(image_hash, self.max_distance) if tree is not None else []
+
+            now = time.time()
+            match = next(((distance, entry) for distance, entry in matches
+                          if entry["options"] == options and self._live(entry, now)), None)
+
+            self.lookups += 1
+            if match is not None:
+                self.hits += 1
+            self._latencies.append(time.perf_counter() - start)
+        return match
+
+    def add(self, image_hash, problems_text, recommendations, artifact_id, options):
+        """Store a completed assessment whose results ZIP is the artifact artifact_id."""
+        self.load()
+        entry = {
+            "id": uuid.uuid4().hex,
+            "hash": image_hash,
+            "problems": self.problems_key(problems_text),
+            "recommendations": recommendations,
+            "artifact": artifact_id,
+            "options": options,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            with open(self._index_path, "a") as index_file:
+                index_file.write(json.dumps(entry) + "\n")
+            self._insert(entry)
+            if (self._entries > self.max_entries
+                    or time.monotonic() - self._last_compact > self.compact_interval_seconds):
+                self._compact()
+        return entry
+
+    def stats(self):
+        self.load()
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if latencies:
+            mean_ms = sum(latencies) / len(latencies) * 1000
+            p95_ms = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        else:
+            mean_ms = p95_ms = 0.0
+        return {
+            "entries": self._entries,
+            "max_entries": self.max_entries,
+            "dropped": self.dropped,
+            "max_distance": self.max_distance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "lookup_ms_mean": round(mean_ms, 3),
+            "lookup_ms_p95": round(p95_ms, 3),
+        }
@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+
+from PIL import Image, ImageFilter, ImageStat
+
+from perceptual_hash import dhash, hamming_distance
+from preprocess import MAX_IMAGE_SIZE
+
+# Side of the grayscale thumbnail used to detect scene changes
+SIGNATURE_SIZE = 32
+
+
+class VideoDecodeError(Exception):
+    pass
+
+
+@dataclass
+class Keyframe:
+    time: float
+    sharpness: float
+    image: Image.Image
+    hash: int = 0
+
+
+def iter_sampled_frames(path, sample_fps, max_size=MAX_IMAGE_SIZE):
+    """
+    Decode a video lazily and yield (time, image) about sample_fps times per second.
+
+    Frames are scaled down to max_size by the decoder's scaler, and only one
+    decoded frame is alive at a time.
+    """
+    # PyAV is only needed for video uploads, import it on first use
+    import av
+
+    try:
+        with av.open(path) as container:
+            if not container.streams.video:
+                raise VideoDecodeError("No video stream found")
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+
+            next_time = 0.0
+            for frame in container.decode(stream):
+                time = frame.time or 0.0
+                if time < next_time:
+                    continue
+                next_time = time + 1 / sample_fps
+
+                scale = min(1.0, max_size / max(frame.width, frame.height))
+                yield time, frame.to_image(
+                    width=max(1, int(frame.width * scale)),
+                    height=max(1, int(frame.height * scale)),
+                )
+    except av.FFmpegError as e:
+        raise VideoDecodeError(str(e)) from e
+
+
+def _signature(image):
+    return image.convert("L").resize((SIGNATURE_SIZE, SIGNATURE_SIZE), Image.Resampling.BILINEAR).tobytes()
+
+
+def _difference(a, b):
+    """Mean absolute difference of two signatures, from 0 (same) to 1."""
+    return sum(abs(x - y) for x, y in zip(a, b)) / (255 * len(a))
+
+
+def sharpness(image):
+    """Variance of the edge map, higher for sharper, less blurry frames."""
+    gray = image.convert("L")
+    gray.thumbnail((256, 256))
+    return ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).var[0]
+
+
+def _keep(kept, candidate, duplicate_distance, max_candidates):
+    """Add a scene's best frame, replacing a near-duplicate or the least sharp frame."""
+    candidate.hash = dhash(candidate.image)
+    for i, other in enumerate(kept):
+        if hamming_distance(candidate.hash, other.hash) <= duplicate_distance:
+            if candidate.sharpness > other.sharpness:
+                kept[i] = candidate
+            return
+
+    kept.append(candidate)
+    if len(kept) > max_candidates:
+        kept.remove(min(kept, key=lambda k: k.sharpness))
+
+
+def select_keyframes(path, max_frames, sample_fps=2.0, scene_threshold=0.12, duplicate_distance=10):
+    """
+    Pick at most max_frames keyframes from a video walkthrough.
+
+    Sampled frames are split into scenes whenever they differ from the start
+    of the current scene by more than scene_threshold, and the sharpest frame
+    of each scene is kept. Near-duplicate keyframes (dHash within
+    duplicate_distance bits) are collapsed into the sharper one. At most
+    2 * max_frames candidates are held at any time; the sharpest max_frames
+    are returned in time order.
+    """
+    kept = []
+    best = None
+    scene_signature = None
+
+    for time, image in iter_sampled_frames(path, sample_fps):
+        signature = _signature(image)
+        if scene_signature is None:
+            scene_signature = signature
+        elif _difference(scene_signature, signature) > scene_threshold:
+            _keep(kept, best, duplicate_distance, 2 * max_frames)
+            best = None
+            scene_signature = signature
+
+        score = sharpness(image)
+        if best is None or score > best.sharpness:
+            best = Keyframe(time=time, sharpness=score, image=image)
+
+    if best is not None:
+        _keep(kept, best, duplicate_distance, 2 * max_frames)
+    if not kept:
+        raise VideoDecodeError("No frames could be decoded")
+
+    selected = sorted(kept, key=lambda k: k.sharpness, reverse=True)[:max_frames]
+    return sorted(selected, key=lambda k: k.time)
@@ -0,0 +1,47 @@
+import io
+import zipfile
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Unseekable sink that hands written bytes back out, optionally copying them to tee."""
+
+    def __init__(self, tee=None):
+        self._chunks = []
+        self.tee = tee
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        if self.tee is not None:
+            self.tee.write(data)
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """
+    Build a ZIP archive one member at a time without keeping the archive in memory.
+
+    write() and close() return the bytes produced so far, ready to be sent to
+    the client. Because the output is not seekable, zipfile writes sizes in data
+    descriptors after each member, so only one compressed member is ever held.
+    """
+
+    def __init__(self, tee=None):
+        self._buffer = _ChunkBuffer(tee)
+        self._zip = zipfile.ZipFile(self._buffer, "w", zipfile.ZIP_DEFLATED)
+
+    def write(self, filename, data):
+        self._zip.writestr(filename, data)
+        return self._buffer.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._buffer.drain()